@@ -36,7 +36,7 @@ config_path = os.path.abspath(os.path.join("Configs", "config.yaml"))
 models_path = os.path.abspath(os.path.join("Models", "model.pth"))
 #######################################################################################################
 voice_path = os.path.join("Demo", "Audio")
-model = StyleTTS2(config_path, models_path).eval().to(device)
+model = StyleTTS2(config_path, models_path, thread_profile=(device == 'cpu')).eval().to(device)
 
 eg_texts = [
     "Beneath layers of bureaucracy and forgotten policies, the school still held a quiet magic—whispers of chalk dust, scuffed floors, and dreams once declared aloud in voices full of belief.",
@@ -31,7 +31,7 @@ def main():
     device = 'cuda' if torch.cuda.is_available() else 'cpu' #setup GPU
     config_path = str(Path("Configs") / "config.yaml")
     models_path = str(Path('Models') / 'Finetune/base_model.pth')
-    model = StyleTTS2(config_path, models_path).eval().to(device)
+    model = StyleTTS2(config_path, models_path, thread_profile=(device == 'cpu')).eval().to(device)
     
     text = 'Nearly 300 scholars currently working in the United States have applied for positions at Aix Marseille University in France.'
     phonemes = phonemize(text=text, lang="en-us")
@@ -3,7 +3,7 @@ import torch.nn.functional as F
 import torch.nn as nn
 from torch.nn import Conv1d, ConvTranspose1d, AvgPool1d, Conv2d
 from torch.nn.utils import weight_norm, remove_weight_norm, spectral_norm
-from .utils import init_weights, get_padding
+from .utils import init_weights, get_padding, style_affine, length_mask, masked_instance_norm, decode_chunked, conv_step, conv_transpose_step, align_step, running_instance_norm, trim_window, trim_lengths, trim_pieces
 
 import math
 import random
@@ -18,11 +18,21 @@ class AdaIN1d(nn.Module):
         self.norm = nn.InstanceNorm1d(num_features, affine=False)
         self.fc = nn.Linear(style_dim, num_features*2)
 
-    def forward(self, x, s):
-        h = self.fc(s)
+    def forward(self, x, s, lengths=None):
+        h = style_affine(self, s)
         h = h.view(h.size(0), h.size(1), 1)
         gamma, beta = torch.chunk(h, chunks=2, dim=1)
-        return (1 + gamma) * self.norm(x) + beta
+        if lengths is None:
+            return (1 + gamma) * self.norm(x) + beta
+        mask = length_mask(x, lengths) #padded batch, statistics and output only cover each row's own steps
+        return ((1 + gamma) * masked_instance_norm(x, mask, self.norm.eps) + beta) * mask
+
+    def step(self, x, s, cache):
+        #forward() on a stream, the statistics are running ones (running_instance_norm)
+        h = style_affine(self, s)
+        h = h.view(h.size(0), h.size(1), 1)
+        gamma, beta = torch.chunk(h, chunks=2, dim=1)
+        return (1 + gamma) * running_instance_norm(x, cache, self, self.norm.eps) + beta
 
 class AdaINResBlock1(torch.nn.Module):
     def __init__(self, channels, kernel_size=3, dilation=(1, 3, 5), style_dim=64):
@@ -63,17 +73,30 @@ class AdaINResBlock1(torch.nn.Module):
         self.alpha2 = nn.ParameterList([nn.Parameter(torch.ones(1, channels, 1)) for i in range(len(self.convs2))])
 
 
-    def forward(self, x, s):
+    def forward(self, x, s, lengths=None):
         for c1, c2, n1, n2, a1, a2 in zip(self.convs1, self.convs2, self.adain1, self.adain2, self.alpha1, self.alpha2):
-            xt = n1(x, s)
+            xt = n1(x, s, lengths)
             xt = xt + (1 / a1) * (torch.sin(a1 * xt) ** 2)  # Snake1D
             xt = c1(xt)
-            xt = n2(xt, s)
+            xt = n2(xt, s, lengths)
             xt = xt + (1 / a2) * (torch.sin(a2 * xt) ** 2)  # Snake1D
             xt = c2(xt)
             x = xt + x
         return x
 
+    def step(self, x, s, cache, final=False):
+        #forward() on a stream, the convs keep their left context in cache and the skip path waits for their delay
+        for c1, c2, n1, n2, a1, a2 in zip(self.convs1, self.convs2, self.adain1, self.adain2, self.alpha1, self.alpha2):
+            xt = n1.step(x, s, cache)
+            xt = xt + (1 / a1) * (torch.sin(a1 * xt) ** 2)  # Snake1D
+            xt = conv_step(c1, xt, cache, final)
+            xt = n2.step(xt, s, cache)
+            xt = xt + (1 / a2) * (torch.sin(a2 * xt) ** 2)  # Snake1D
+            xt = conv_step(c2, xt, cache, final)
+            xt, x = align_step([xt, x], cache, (c2, 'skip'))
+            x = xt + x
+        return x
+
     def remove_weight_norm(self):
         for l in self.convs1:
             remove_weight_norm(l)
@@ -335,9 +358,10 @@ class SineGen(torch.nn.Module):
         uv = (f0 > self.voiced_threshold).type(torch.float32)
         return uv
 
-    def _f02sine(self, f0_values):
+    def _f02sine(self, f0_values, phase0=None):
         """ f0_values: (batchsize, length, dim)
             where dim indicates fundamental tone and overtones
+            phase0: (batchsize, 1, dim) phase already reached when f0_values is a window of a longer curve
         """
         # convert to F0 in rad. The interger part n can be ignored
         # because 2 * np.pi * n doesn't affect phase
@@ -373,6 +397,8 @@ class SineGen(torch.nn.Module):
 #             cumsum_shift[:, 1:, :] = tmp_over_one_idx * -1.0
     
             phase = torch.cumsum(rad_values, dim=1) * 2 * np.pi
+            if phase0 is not None:
+                phase = phase + phase0
             phase = torch.nn.functional.interpolate(phase.transpose(1, 2) * self.upsample_scale, 
                                                     scale_factor=self.upsample_scale, mode="linear").transpose(1, 2)
             sines = torch.sin(phase)
@@ -407,7 +433,66 @@ class SineGen(torch.nn.Module):
             sines = torch.cos(i_phase * 2 * np.pi)
         return sines
 
-    def forward(self, f0):
+    def cycles_at(self, f0, n):
+        """ turns every harmonic makes over the first n steps of f0 (batchsize, length),
+            one step per upsample_scale samples, in float64: (batchsize, 1, dim)
+        """
+        fn = torch.multiply(f0[:, :n, None], torch.FloatTensor([[range(1, self.harmonic_num + 2)]]).to(f0.device))
+        return ((fn / self.sampling_rate) % 1).double().sum(1, keepdim=True)
+
+    def phase_at(self, f0, n):
+        """ phase0 of a window of f0 (batchsize, length) starting at step n: the phase
+            the sines reach after the first n steps
+        """
+        cycles = self.cycles_at(f0, n) * self.upsample_scale
+        return ((cycles % 1) / self.upsample_scale * 2 * np.pi).float() #phase is scaled by upsample_scale later, wrap before that
+
+    def seek(self, f0, n, cache):
+        """ starts the stream of step() at step n of f0 (batchsize, length) instead of
+            its beginning, with the phase the first n steps reach
+        """
+        cache[self] = {'f0': f0[:, :0], 'cycles': f0.new_zeros(f0.shape[0], 0, self.dim).double(), 'total': self.cycles_at(f0, n), 'prev': None}
+        return cache[self]
+
+    def step(self, f0, cache, final=False):
+        """ forward() on a stream of f0 (batchsize, length) at one value per upsample_scale
+            samples, the cumulative phase is carried in cache. A step's samples are interpolated
+            towards the next step's phase: the last step given waits for the next call until final
+        """
+        scale = int(self.upsample_scale)
+        fn = torch.multiply(f0[:, :, None], torch.FloatTensor([[range(1, self.harmonic_num + 2)]]).to(f0.device))
+        state = cache.get(self) or self.seek(f0, 0, cache)
+        total = state['total'] + torch.cumsum(((fn / self.sampling_rate) % 1).double(), dim=1) #turns so far, in float64
+        cycles = torch.cat([state['cycles'], total], dim=1)
+        f0 = torch.cat([state['f0'], f0], dim=1)
+        n = f0.shape[1] if final else max(f0.shape[1] - 1, 0)
+
+        window = cycles if state['prev'] is None else torch.cat([state['prev'], cycles], dim=1)
+        skip = 0 if state['prev'] is None else 1
+        if n > 0:
+            #same interpolation as _f02sine, shifted by a whole number of turns once scaled so float32 keeps its precision
+            base = torch.floor(window[:, :1] * scale) / scale
+            phase = ((window - base) * 2 * np.pi).float()
+            phase = torch.nn.functional.interpolate(phase.transpose(1, 2) * self.upsample_scale, 
+                                                    scale_factor=self.upsample_scale, mode="linear").transpose(1, 2)
+            sines = torch.sin(phase[:, skip*scale:(skip + n)*scale]) * self.sine_amp
+        else:
+            sines = fn.new_zeros(fn.shape[0], 0, self.dim)
+
+        uv = self._f02uv(f0[:, :n, None]).repeat_interleave(scale, dim=1)
+        noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
+        noise = noise_amp * torch.randn_like(sines)
+        sine_waves = sines * uv + noise
+
+        cache[self] = {
+            'f0': f0[:, n:],
+            'cycles': cycles[:, n:],
+            'total': total[:, -1:] if total.shape[1] else state['total'],
+            'prev': cycles[:, n-1:n] if n > 0 else state['prev'],
+        }
+        return sine_waves, uv, noise
+
+    def forward(self, f0, phase0=None):
         """ sine_tensor, uv = forward(f0)
         input F0: tensor(batchsize=1, length, dim=1)
                   f0 for unvoiced steps should be 0
@@ -420,7 +505,7 @@ class SineGen(torch.nn.Module):
         fn = torch.multiply(f0, torch.FloatTensor([[range(1, self.harmonic_num + 2)]]).to(f0.device))
 
         # generate sine waveforms
-        sine_waves = self._f02sine(fn) * self.sine_amp
+        sine_waves = self._f02sine(fn, phase0) * self.sine_amp
 
         # generate uv signal
         # uv = torch.ones(f0.shape)
@@ -472,7 +557,7 @@ class SourceModuleHnNSF(torch.nn.Module):
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, phase0=None):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
         F0_sampled (batchsize, length, 1)
@@ -481,12 +566,20 @@ class SourceModuleHnNSF(torch.nn.Module):
         """
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x)
+            sine_wavs, uv, _ = self.l_sin_gen(x, phase0)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
 
         # source for noise branch, in the same shape as uv
         noise = torch.randn_like(uv) * self.sine_amp / 3
         return sine_merge, noise, uv
+
+    def step(self, x, cache, final=False):
+        #forward() on a stream of f0 (batchsize, length) at one value per upsample_scale samples, see SineGen.step
+        with torch.no_grad():
+            sine_wavs, uv, _ = self.l_sin_gen.step(x, cache, final)
+        sine_merge = self.l_tanh(self.l_linear(sine_wavs))
+        noise = torch.randn_like(uv) * self.sine_amp / 3
+        return sine_merge, noise, uv
 def padDiff(x):
     return F.pad(F.pad(x, (0,0,-1,1), 'constant', 0) - x, (0,0,0,-1), 'constant', 0)
 
@@ -497,6 +590,7 @@ class Generator(torch.nn.Module):
 
         self.num_kernels = len(resblock_kernel_sizes)
         self.num_upsamples = len(upsample_rates)
+        self.upsample_rates = upsample_rates
         resblock = AdaINResBlock1
 
         self.m_source = SourceModuleHnNSF(
@@ -532,27 +626,46 @@ class Generator(torch.nn.Module):
                 
                 
         self.post_n_fft = gen_istft_n_fft
+        self.hop_size = gen_istft_hop_size
         self.conv_post = weight_norm(Conv1d(ch, self.post_n_fft + 2, 7, 1, padding=3))
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
         self.reflection_pad = torch.nn.ReflectionPad1d((1, 0))
         #self.stft = TorchSTFT(filter_length=gen_istft_n_fft, hop_length=gen_istft_hop_size, win_length=gen_istft_n_fft)
         self.stft = CustomSTFT(filter_length=gen_istft_n_fft, hop_length=gen_istft_hop_size, win_length=gen_istft_n_fft)
+
+        #input steps an output sample sees on either side: every stage's convs counted at that stage's rate, then the ISTFT window
+        reach = (3 + gen_istft_n_fft / gen_istft_hop_size / 2) / np.prod(upsample_rates)
+        for i, k in enumerate(upsample_kernel_sizes):
+            blocks = list(zip(resblock_kernel_sizes, resblock_dilation_sizes)) + [(11 if i + 1 == len(upsample_rates) else 7, [1,3,5])]
+            reach += (k / 2 + max((kernel - 1) * (sum(d) + len(d)) / 2 for kernel, d in blocks)) / np.prod(upsample_rates[:i+1])
+        self.context = int(np.ceil(reach)) + 1
         
         
-    def forward(self, x, s, f0):
+    def forward(self, x, s, f0, lengths=None, phase0=None):
         with torch.no_grad():
+            if lengths is not None:
+                f0 = f0 * length_mask(f0, lengths)[:, 0] #0 Hz past the end keeps each row's integrated sine phase flat there
             f0 = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
 
-            har_source, noi_source, uv = self.m_source(f0)
+            har_source, noi_source, uv = self.m_source(f0, phase0)
             har_source = har_source.transpose(1, 2).squeeze(1)
+            if lengths is not None: #repeat each row's last valid sample, the STFT's replicate padding sees what it would unbatched
+                n_samples = lengths * int(np.prod(self.upsample_rates)) * self.hop_size
+                index = torch.arange(har_source.shape[-1], device=har_source.device).unsqueeze(0)
+                har_source = har_source.gather(1, torch.minimum(index, (n_samples - 1).unsqueeze(1)))
             har_spec, har_phase = self.stft.transform(har_source)
             har = torch.cat([har_spec, har_phase], dim=1)
+            if lengths is not None:
+                har = har * length_mask(har, n_samples // self.hop_size + 1)
         
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, LRELU_SLOPE)
+            if lengths is not None:
+                x = x * length_mask(x, lengths)
+                lengths = lengths * self.upsample_rates[i] + (1 if i == self.num_upsamples - 1 else 0) #+1 from the reflection pad
             x_source = self.noise_convs[i](har)
-            x_source = self.noise_res[i](x_source, s)
+            x_source = self.noise_res[i](x_source, s, lengths)
 
             x = self.ups[i](x)
             if i == self.num_upsamples - 1:
@@ -562,16 +675,100 @@ class Generator(torch.nn.Module):
             xs = None
             for j in range(self.num_kernels):
                 if xs is None:
-                    xs = self.resblocks[i*self.num_kernels+j](x, s)
+                    xs = self.resblocks[i*self.num_kernels+j](x, s, lengths)
                 else:
-                    xs += self.resblocks[i*self.num_kernels+j](x, s)
+                    xs += self.resblocks[i*self.num_kernels+j](x, s, lengths)
             x = xs / self.num_kernels
         x = F.leaky_relu(x)
+        if lengths is not None:
+            x = x * length_mask(x, lengths)
         x = self.conv_post(x)
         spec = torch.exp(x[:,:self.post_n_fft // 2 + 1, :])
         phase = torch.sin(x[:, self.post_n_fft // 2 + 1:, :])
+        if lengths is not None:
+            spec = spec * length_mask(spec, lengths) #silent padded frames, the overlap-add would spill them into each row's tail
         return self.stft.inverse(spec, phase)
+
+    def stream(self, x, s, f0, chunk=160, context=None, fade=4, parallel=1, trim=0):
+        #forward() in windows of `chunk` steps, yields the cross-faded waveform piece by piece. Each window's sine source
+        #starts at the phase the whole f0 curve reaches there, the pitch stays continuous across the cuts
+        def run(lo, hi):
+            return self(x[..., lo:hi], s, f0[..., lo:hi], phase0=self.m_source.l_sin_gen.phase_at(f0, lo))
+        context = self.context if context is None else context
+        yield from decode_chunked(run, x.shape[-1], int(np.prod(self.upsample_rates)) * self.hop_size, chunk, context, fade, parallel, trim)
     
+    def step(self, x, s, f0, cache, final=False):
+        #forward() on a stream: x (bs, c, n) and f0 (bs, n) are the next n steps, returns the samples they complete.
+        #Every conv keeps the inputs its next outputs still need in cache, the sine source its phase, the norms running statistics
+        #and the STFTs their last frames, the ISTFT overlap-add tail is recomputed from those. No step is computed twice, the
+        #samples lag the input by the convs' and the ISTFT window's right reach until final flushes them
+        n_fft, hop = self.stft.n_fft, self.stft.hop_length
+        with torch.no_grad():
+            har_source, _, _ = self.m_source.step(f0, cache, final)
+            har_source = har_source.transpose(1, 2).squeeze(1)
+            har = conv_step(lambda w: torch.cat(self.stft.transform(w), dim=1), har_source, cache, final,
+                            geometry=(n_fft, hop, n_fft // 2, self.post_n_fft + 2), key=self.stft)
+
+        for i in range(self.num_upsamples):
+            x = F.leaky_relu(x, LRELU_SLOPE)
+            x_source = conv_step(self.noise_convs[i], har, cache, final)
+            x_source = self.noise_res[i].step(x_source, s, cache, final)
+
+            x = conv_transpose_step(self.ups[i], x, cache, final)
+            if i == self.num_upsamples - 1:
+                x = self._reflection_pad_step(x, cache)
+
+            x, x_source = align_step([x, x_source], cache, (self.ups[i], 'source'))
+            x = x + x_source
+            xs = align_step([self.resblocks[i*self.num_kernels+j].step(x, s, cache, final) for j in range(self.num_kernels)], cache, (self.ups[i], 'resblocks'))
+            x = sum(xs) / self.num_kernels
+        x = F.leaky_relu(x)
+        x = conv_step(self.conv_post, x, cache, final)
+
+        def inverse(x):
+            return self.stft.inverse(torch.exp(x[:,:self.post_n_fft // 2 + 1, :]), torch.sin(x[:, self.post_n_fft // 2 + 1:, :]))
+        return conv_transpose_step(inverse, x, cache, final, geometry=(n_fft, hop, n_fft // 2, 0, 1), key=(self.stft, 'inverse'))
+
+    def _reflection_pad_step(self, x, cache):
+        #The reflection pad puts the second sample in front, the stream's first samples are held until there are two
+        if cache.get(self.reflection_pad) is True:
+            return x
+        x = torch.cat([cache.get(self.reflection_pad, x[..., :0]), x], dim=-1)
+        if x.shape[-1] < 2:
+            cache[self.reflection_pad] = x
+            return x[..., :0]
+        cache[self.reflection_pad] = True
+        return self.reflection_pad(x)
+
+    def incremental(self, x, s, f0, block=16, trim=0):
+        #step() over x and f0 in blocks of `block` steps, yields the samples of every block as soon as they are done.
+        #trim: samples left out at either end, only the steps the others see are fed
+        samples_per_step = int(np.prod(self.upsample_rates)) * self.hop_size
+        lo, hi = trim_window(x.shape[-1], samples_per_step, trim, self.context)
+        cache = {}
+        self.m_source.l_sin_gen.seek(f0, lo, cache)
+
+        def pieces():
+            for a in range(lo, hi, block):
+                b = min(a + block, hi)
+                y = self.step(x[..., a:b], s, f0[..., a:b], cache, final=b == hi)
+                if y.shape[-1]:
+                    yield y
+        yield from trim_pieces(pieces(), trim - lo*samples_per_step, hi*samples_per_step - (x.shape[-1]*samples_per_step - trim))
+
+    def trimmed(self, x, s, f0, trim, lengths=None):
+        #forward() without the first and last `trim` samples of every row: only the steps the kept samples see, self.context steps
+        #on either side, go through the generator. Rows come out padded to x's length minus both trims. The InstanceNorms don't see
+        #the steps left out: close to forward(), not identical. A row of a padded batch gets the window it would get alone
+        samples_per_step = int(np.prod(self.upsample_rates)) * self.hop_size
+        lo, hi = trim_window(x.shape[-1] if lengths is None else int(lengths.max()), samples_per_step, trim, self.context)
+        if lengths is not None:
+            lengths = trim_lengths(lengths, samples_per_step, trim, self.context) #a shorter row's own window ends before hi
+        y = self(x[..., lo:hi], s, f0[..., lo:hi], lengths, phase0=self.m_source.l_sin_gen.phase_at(f0, lo) if lo else None)
+        n_samples = max(x.shape[-1]*samples_per_step - 2*trim, 0)
+        y = y[..., trim - lo*samples_per_step:][..., :n_samples]
+        return F.pad(y, (0, n_samples - y.shape[-1]))
+
     def fw_phase(self, x, s):
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, LRELU_SLOPE)
@@ -596,7 +793,6 @@ class Generator(torch.nn.Module):
             remove_weight_norm(l)
         for l in self.resblocks:
             l.remove_weight_norm()
-        remove_weight_norm(self.conv_pre)
         remove_weight_norm(self.conv_post)
 
         
@@ -631,18 +827,21 @@ class AdainResBlk1d(nn.Module):
             x = self.conv1x1(x)
         return x
 
-    def _residual(self, x, s):
-        x = self.norm1(x, s)
+    def _residual(self, x, s, lengths=None):
+        x = self.norm1(x, s, lengths)
         x = self.actv(x)
         x = self.pool(x)
+        if lengths is not None and self.upsample_type != 'none':
+            lengths = lengths * 2
+            x = x * length_mask(x, lengths) #the transposed conv bias leaks into the padding
         x = self.conv1(self.dropout(x))
-        x = self.norm2(x, s)
+        x = self.norm2(x, s, lengths)
         x = self.actv(x)
         x = self.conv2(self.dropout(x))
         return x
 
-    def forward(self, x, s):
-        out = self._residual(x, s)
+    def forward(self, x, s, lengths=None):
+        out = self._residual(x, s, lengths)
         out = (out + self._shortcut(x)) / math.sqrt(2)
         return out
     
@@ -689,7 +888,8 @@ class Decoder(nn.Module):
                                    upsample_initial_channel, resblock_dilation_sizes, 
                                    upsample_kernel_sizes, gen_istft_n_fft, gen_istft_hop_size)
         
-    def forward(self, asr, F0_curve, N, s):
+    def forward(self, asr, F0_curve, N, s, lengths=None, trim=0):
+        #trim: samples left out at either end of every row, the generator skips the steps only they need
         if self.training:
             downlist = [0, 3, 7]
             F0_down = downlist[random.randint(0, 2)]
@@ -700,12 +900,20 @@ class Decoder(nn.Module):
             if N_down:
                 N = nn.functional.conv1d(N.unsqueeze(1), torch.ones(1, 1, N_down).to('cuda'), padding=N_down//2).squeeze(1)  / N_down
 
-        
+
+        x, lengths = self._encode(asr, F0_curve, N, s, lengths)
+        if trim:
+            return self.generator.trimmed(x, s, F0_curve, trim, lengths)
+        x = self.generator(x, s, F0_curve, lengths)
+        return x
+
+    def _encode(self, asr, F0_curve, N, s, lengths=None):
+        #Everything before the generator, at twice the frame rate after the last block
         F0 = self.F0_conv(F0_curve.unsqueeze(1))
         N = self.N_conv(N.unsqueeze(1))
         
         x = torch.cat([asr, F0, N], axis=1)
-        x = self.encode(x, s)
+        x = self.encode(x, s, lengths)
         
         asr_res = self.asr_res(asr)
         
@@ -713,11 +921,25 @@ class Decoder(nn.Module):
         for block in self.decode:
             if res:
                 x = torch.cat([x, asr_res, F0, N], axis=1)
-            x = block(x, s)
+            x = block(x, s, lengths)
             if block.upsample_type != "none":
                 res = False
-                
-        x = self.generator(x, s, F0_curve)
-        return x
+                if lengths is not None:
+                    lengths = lengths * 2
+        return x, lengths
+
+    def stream(self, asr, F0_curve, N, s, chunk=160, context=None, fade=4, parallel=1, trim=0):
+        #forward() of one unpadded sentence with the generator run on `chunk` steps (1/80 s each) at a time, `context` steps of margin
+        #on either side and `fade` steps of cross-fade per cut. Its upsampled activations no longer grow with the sentence and audio
+        #comes out before the sentence is done. The generator's InstanceNorms only see their window: close to forward(), not identical
+        x, _ = self._encode(asr, F0_curve, N, s)
+        yield from self.generator.stream(x, s, F0_curve, chunk, context, fade, parallel, trim)
+
+    def incremental(self, asr, F0_curve, N, s, block=16, trim=0):
+        #forward() of one unpadded sentence with the generator fed `block` steps (1/80 s each) at a time and its state carried
+        #between blocks (Generator.step): the first audio comes after one block and no step is decoded twice. The generator's
+        #InstanceNorms use running statistics: close to forward(), not identical
+        x, _ = self._encode(asr, F0_curve, N, s)
+        yield from self.generator.incremental(x, s, F0_curve, block, trim)
     
     
\ No newline at end of file
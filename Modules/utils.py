@@ -1,3 +1,9 @@
+import torch
+from torch.nn.utils import weight_norm, remove_weight_norm, parametrize
+from torch.nn.utils.weight_norm import WeightNorm
+from torch.nn.utils.parametrizations import _WeightNorm
+
+
 def init_weights(m, mean=0.0, std=0.01):
     classname = m.__class__.__name__
     if classname.find("Conv") != -1:
@@ -11,4 +17,228 @@ def apply_weight_norm(m):
 
 
 def get_padding(kernel_size, dilation=1):
-    return int((kernel_size*dilation - dilation)/2)
\ No newline at end of file
+    return int((kernel_size*dilation - dilation)/2)
+
+
+def remove_weight_norms(module):
+    #Folds every weight norm under module into a plain weight, handles both the hook and the parametrization style
+    count = 0
+    for m in module.modules():
+        if parametrize.is_parametrized(m, "weight") and isinstance(m.parametrizations.weight[0], _WeightNorm):
+            parametrize.remove_parametrizations(m, "weight", leave_parametrized=True)
+            #the weight_g/weight_v key renaming hook is left behind, it's a local function and would keep the module from pickling
+            for key, hook in list(m._load_state_dict_pre_hooks.items()):
+                if getattr(getattr(hook, 'hook', hook), '__name__', '') == '_weight_norm_compat_hook':
+                    del m._load_state_dict_pre_hooks[key]
+            count += 1
+        elif any(isinstance(hook, WeightNorm) for hook in m._forward_pre_hooks.values()):
+            remove_weight_norm(m)
+            count += 1
+    return count
+
+
+
+class BoundStyle:
+    """
+    A voice's style vector bound to the fc(s) output of every AdaIN1d / AdaLayerNorm of a model.
+    Pass it wherever a style tensor s is expected, the norms look their gamma/beta up instead of recomputing them.
+    """
+    def __init__(self, style, affine):
+        self.style = style
+        self.affine = affine #norm module -> fc(style)
+
+    @property
+    def device(self):
+        return self.style.device
+
+    def to(self, device):
+        if self.style.device == torch.device(device):
+            return self
+        return BoundStyle(self.style.to(device), {m: h.to(device) for m, h in self.affine.items()})
+
+
+def bind_style(style, modules):
+    affine = {}
+    with torch.no_grad():
+        for module in modules:
+            for m in module.modules():
+                if type(m).__name__ in ["AdaIN1d", "AdaLayerNorm"]:
+                    affine[m] = m.fc(style)
+    return BoundStyle(style, affine)
+
+
+def style_affine(norm, s):
+    if isinstance(s, BoundStyle):
+        h = s.affine.get(norm)
+        return h if h is not None else norm.fc(s.style)
+    return norm.fc(s)
+
+
+def style_tensor(s):
+    return s.style if isinstance(s, BoundStyle) else s
+
+
+def length_mask(x, lengths):
+    #[B, 1, T] mask of the valid steps of x, lengths are counted at x's time resolution
+    return (torch.arange(x.shape[-1], device=x.device).unsqueeze(0) < lengths.unsqueeze(1)).unsqueeze(1).to(x.dtype)
+
+
+def masked_instance_norm(x, mask, eps=1e-5):
+    #InstanceNorm1d statistics over the valid steps only, padded steps come out as 0
+    n = mask.sum(-1, keepdim=True)
+    mean = (x * mask).sum(-1, keepdim=True) / n
+    var = (((x - mean) * mask) ** 2).sum(-1, keepdim=True) / n
+    return (x - mean) / torch.sqrt(var + eps) * mask
+
+
+
+def chunk_windows(n_steps, chunk, context, fade, first=0, last=None):
+    #(lo, hi, start, end) per chunk of steps [first, last): steps [lo, hi) are decoded, [start, end) of them are kept.
+    #Kept spans overlap by 2*fade steps around every cut, a last chunk shorter than that is merged into the one before
+    last = n_steps if last is None else last
+    if last <= first:
+        return
+    cuts = list(range(first + chunk, last, chunk))
+    if cuts and last - cuts[-1] < 2*fade:
+        cuts.pop()
+    bounds = [first] + cuts + [last]
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        start, end = max(a - fade, first), min(b + fade, last)
+        yield max(start - context, 0), min(end + context, n_steps), start, end
+
+
+def trim_window(n_steps, samples_per_step, trim, context):
+    #Steps [lo, hi) the samples [trim, n_steps*samples_per_step - trim) of a decoded sequence depend on, `context` steps
+    #being the decoder's reach on either side
+    lo = max(trim // samples_per_step - context, 0)
+    hi = min(-(-(n_steps * samples_per_step - trim) // samples_per_step) + context, n_steps)
+    return lo, max(hi, lo)
+
+
+def trim_lengths(lengths, samples_per_step, trim, context):
+    #trim_window of every row of a padded batch, as lengths from the shared lo (lo doesn't depend on the row's length):
+    #a row only feeds the steps it would on its own, so its norm statistics match decoding it alone
+    lo = trim_window(0, samples_per_step, trim, context)[0]
+    his = [trim_window(int(n), samples_per_step, trim, context)[1] for n in lengths]
+    return (torch.tensor(his, device=lengths.device) - lo).clamp(min=1)
+
+
+def trim_pieces(pieces, head, tail):
+    #Drops the first `head` and last `tail` samples of a stream of waveform pieces, the last `tail` samples are held back
+    held = None
+    for piece in pieces:
+        skip = min(head, piece.shape[-1])
+        head -= skip
+        held = piece[..., skip:] if held is None else torch.cat([held, piece[..., skip:]], dim=-1)
+        if held.shape[-1] > tail:
+            yield held[..., :held.shape[-1] - tail]
+            held = held[..., held.shape[-1] - tail:]
+
+
+def crossfade(pieces, overlap):
+    #Joins consecutive waveforms sharing `overlap` samples with a linear fade, yields each part as soon as it is final
+    held = None
+    for piece in pieces:
+        if held is not None and overlap > 0:
+            ramp = torch.linspace(0, 1, overlap + 2, device=piece.device)[1:-1]
+            piece = torch.cat([held * (1 - ramp) + piece[..., :overlap] * ramp, piece[..., overlap:]], dim=-1)
+        held = piece[..., piece.shape[-1] - overlap:]
+        yield piece[..., :piece.shape[-1] - overlap]
+    if held is not None and overlap > 0:
+        yield held
+
+
+def decode_chunked(run, n_steps, samples_per_step, chunk, context, fade, parallel=1, trim=0):
+    #Decodes steps [0, n_steps) window by window, run(lo, hi) returns the (hi - lo)*samples_per_step samples of steps [lo, hi).
+    #Only `parallel` windows are in flight at a time (on a thread pool when > 1), so memory doesn't grow with n_steps.
+    #trim: samples left out at either end, the steps only they cover aren't decoded
+    chunk = max(chunk, 2*fade, 1)
+    windows = list(chunk_windows(n_steps, chunk, context, fade, trim // samples_per_step, n_steps - trim // samples_per_step))
+    grad = torch.is_grad_enabled()
+
+    def decode(window):
+        lo, hi, start, end = window
+        with torch.set_grad_enabled(grad):
+            return run(lo, hi)[..., (start - lo)*samples_per_step:(end - lo)*samples_per_step]
+
+    def pieces():
+        if parallel <= 1:
+            yield from map(decode, windows)
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = [executor.submit(decode, window) for window in windows[:parallel]]
+            for i in range(len(windows)):
+                piece = futures[i].result()
+                if i + parallel < len(windows):
+                    futures.append(executor.submit(decode, windows[i + parallel]))
+                futures[i] = None
+                yield piece
+
+    yield from trim_pieces(crossfade(pieces(), 2*fade*samples_per_step), trim % samples_per_step, trim % samples_per_step)
+
+
+def conv_step(conv, x, cache, final=False, geometry=None, key=None):
+    #conv on a stream: x is the next piece of its input, returns every output whose inputs are all in (all of them once final).
+    #The inputs the next outputs still need are kept in cache[key]. conv is a Conv1d or any callable that pads its input the
+    #same way, geometry = (kernel span, stride, padding, out channels) for the latter
+    span, stride, padding, channels = geometry or (conv.dilation[0] * (conv.kernel_size[0] - 1) + 1, conv.stride[0], conv.padding[0], conv.out_channels)
+    key = conv if key is None else key
+    state = cache.get(key) or {'buf': x[..., :0], 'start': 0, 'n_in': 0, 'n_out': 0}
+    buf = torch.cat([state['buf'], x], dim=-1)
+    n_in = state['n_in'] + x.shape[-1]
+    end = (n_in + (2*padding if final else padding) - span) // stride + 1 #outputs whose window is complete
+    if end > state['n_out']:
+        offset = state['start'] // stride
+        y = conv(buf)[..., state['n_out'] - offset:end - offset] #the window of every output kept lies inside buf, its padding only counts at the real edges
+    else:
+        y = x.new_zeros(x.shape[0], channels, 0)
+        end = state['n_out']
+    start = max(0, (end*stride - padding) // stride * stride) #first input of the next output, on the stride grid
+    cache[key] = {'buf': buf[..., start - state['start']:], 'start': start, 'n_in': n_in, 'n_out': end}
+    return y
+
+
+def conv_transpose_step(conv, x, cache, final=False, geometry=None, key=None):
+    #conv_step for a ConvTranspose1d (or a callable cropping `padding` off both ends like one, geometry = (kernel, stride,
+    #padding, output padding, out channels)). The overlap-add tail is recomputed from the last inputs kept in cache[key]
+    kernel, stride, padding, output_padding, channels = geometry or (conv.kernel_size[0], conv.stride[0], conv.padding[0], conv.output_padding[0], conv.out_channels)
+    assert kernel + output_padding >= stride + padding, 'Transposed conv crops more than its overlap'
+    key = conv if key is None else key
+    state = cache.get(key) or {'buf': x[..., :0], 'start': 0, 'n_in': 0, 'n_out': 0}
+    buf = torch.cat([state['buf'], x], dim=-1)
+    n_in = state['n_in'] + x.shape[-1]
+    end = (n_in - 1)*stride - 2*padding + kernel + output_padding if final else n_in*stride - padding #outputs no later input adds to
+    if end > state['n_out'] and buf.shape[-1] > 0:
+        offset = state['start'] * stride
+        y = conv(buf)[..., state['n_out'] - offset:end - offset]
+    else:
+        y = x.new_zeros(x.shape[0], channels, 0)
+        end = state['n_out']
+    start = max(0, -((kernel - 1 - padding - end) // stride)) #first input adding to the next output
+    cache[key] = {'buf': buf[..., start - state['start']:], 'start': start, 'n_in': n_in, 'n_out': end}
+    return y
+
+
+def align_step(pieces, cache, key):
+    #Streams of the same signal rate come out of their layers with different delays: returns the part every one of them
+    #has reached, equally long, and keeps the rest in cache[key] for the next call
+    pending = cache.get(key) or [piece[..., :0] for piece in pieces]
+    pending = [torch.cat([held, piece], dim=-1) for held, piece in zip(pending, pieces)]
+    n = min(piece.shape[-1] for piece in pending)
+    cache[key] = [piece[..., n:] for piece in pending]
+    return [piece[..., :n] for piece in pending]
+
+
+def running_instance_norm(x, cache, key, eps=1e-5):
+    #InstanceNorm1d on a stream, the statistics cover every step seen so far instead of the whole sequence
+    n, total, total_sq = cache.get(key) or (0, 0, 0)
+    n += x.shape[-1]
+    total = total + x.double().sum(-1, keepdim=True)
+    total_sq = total_sq + x.double().pow(2).sum(-1, keepdim=True)
+    cache[key] = (n, total, total_sq)
+    if n == 0:
+        return x
+    mean = total / n
+    var = (total_sq / n - mean.pow(2)).clamp(min=0)
+    return ((x - mean) / torch.sqrt(var + eps)).to(x.dtype)
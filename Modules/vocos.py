@@ -8,6 +8,7 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 from torch.nn.utils.parametrizations import weight_norm
+from .utils import style_affine, length_mask, masked_instance_norm, decode_chunked, trim_window, trim_lengths
 
 from typing import Optional, Tuple
 from scipy.signal import get_window
@@ -18,11 +19,14 @@ class AdaIN1d(nn.Module):
         self.norm = nn.InstanceNorm1d(num_features, affine=False)
         self.fc = nn.Linear(style_dim, num_features*2)
 
-    def forward(self, x, s):
-        h = self.fc(s)
+    def forward(self, x, s, lengths=None):
+        h = style_affine(self, s)
         h = h.view(h.size(0), h.size(1), 1)
         gamma, beta = torch.chunk(h, chunks=2, dim=1)
-        return (1 + gamma) * self.norm(x) + beta
+        if lengths is None:
+            return (1 + gamma) * self.norm(x) + beta
+        mask = length_mask(x, lengths) #padded batch, statistics and output only cover each row's own steps
+        return ((1 + gamma) * masked_instance_norm(x, mask, self.norm.eps) + beta) * mask
             
 class ConvNeXtBlock(nn.Module):
     """ConvNeXt Block adapted from https://github.com/facebookresearch/ConvNeXt to 1D audio signal.
@@ -53,10 +57,12 @@ class ConvNeXtBlock(nn.Module):
             else None
         )
         
-    def forward(self, x: torch.Tensor, s: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, s: torch.Tensor, lengths: Optional[torch.Tensor] = None) -> torch.Tensor:
         residual = x
+        if lengths is not None:
+            x = x * length_mask(x, lengths)
         x = self.dwconv(x)
-        x = self.norm(x, s)
+        x = self.norm(x, s, lengths)
         x = x.transpose(1, 2)  # (B, C, T) -> (B, T, C)
         x = self.pwconv1(x)
         x = self.act(x)
@@ -148,19 +154,38 @@ class Generator(Backbone):
         self.apply(self._init_weights)
         self.reflection_pad = torch.nn.ReflectionPad1d((1, 0))
         self.stft = ISTFTHead(dim=dim, n_fft=gen_istft_n_fft, hop_length=gen_istft_hop_size, padding="same")
+        self.hop_size = gen_istft_hop_size
+        self.context = num_layers * 3 + int(np.ceil(gen_istft_n_fft / gen_istft_hop_size / 2)) + 1 #7 tap depthwise convs, then the ISTFT window
 
     def _init_weights(self, m):
         if isinstance(m, (nn.Conv1d, nn.Linear)):
             nn.init.trunc_normal_(m.weight, std=0.02)
             nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, s) -> torch.Tensor:
+    def forward(self, x, s, lengths=None) -> torch.Tensor:
         for i, conv_block in enumerate(self.convnext):
-            x = conv_block(x, s)
+            x = conv_block(x, s, lengths)
         x = self.final_layer_norm(x.transpose(1, 2))
-        x = self.stft(x)
+        x = self.stft(x, lengths)
         return x
 
+    def stream(self, x, s, chunk=160, context=None, fade=4, parallel=1, trim=0):
+        #forward() in windows of `chunk` steps, yields the cross-faded waveform piece by piece
+        context = self.context if context is None else context
+        yield from decode_chunked(lambda lo, hi: self(x[..., lo:hi], s), x.shape[-1], self.hop_size, chunk, context, fade, parallel, trim)
+
+    def trimmed(self, x, s, trim, lengths=None):
+        #forward() without the first and last `trim` samples of every row: only the steps the kept samples see, self.context steps
+        #on either side, go through the generator. Rows come out padded to x's length minus both trims. The InstanceNorms don't see
+        #the steps left out: close to forward(), not identical. A row of a padded batch gets the window it would get alone
+        lo, hi = trim_window(x.shape[-1] if lengths is None else int(lengths.max()), self.hop_size, trim, self.context)
+        if lengths is not None:
+            lengths = trim_lengths(lengths, self.hop_size, trim, self.context) #a shorter row's own window ends before hi
+        y = self(x[..., lo:hi], s, lengths)
+        n_samples = max(x.shape[-1]*self.hop_size - 2*trim, 0)
+        y = y[..., trim - lo*self.hop_size:][..., :n_samples]
+        return F.pad(y, (0, n_samples - y.shape[-1]))
+
 class ISTFT(nn.Module):
     """
     Custom implementation of ISTFT since torch.istft doesn't allow custom padding (other than `center=True`) with
@@ -187,13 +212,14 @@ class ISTFT(nn.Module):
         window = torch.hann_window(win_length)
         self.register_buffer("window", window)
 
-    def forward(self, spec: torch.Tensor) -> torch.Tensor:
+    def forward(self, spec: torch.Tensor, lengths: Optional[torch.Tensor] = None) -> torch.Tensor:
         """
         Compute the Inverse Short Time Fourier Transform (ISTFT) of a complex spectrogram.
 
         Args:
             spec (Tensor): Input complex spectrogram of shape (B, N, T), where B is the batch size,
                             N is the number of frequency bins, and T is the number of time frames.
+            lengths (Tensor, optional): Valid frames of each row of a padded batch, padded frames must be silent.
 
         Returns:
             Tensor: Reconstructed time-domain signal of shape (B, L), where L is the length of the output signal.
@@ -219,6 +245,15 @@ class ISTFT(nn.Module):
             ifft, output_size=(1, output_size), kernel_size=(1, self.win_length), stride=(1, self.hop_length),
         )[:, 0, 0, pad:-pad]
 
+        if lengths is not None:
+            # Each row is normalized by the envelope of its own frames only
+            window_sq = self.window.square()[None, :, None] * length_mask(spec.real, lengths)
+            window_envelope = torch.nn.functional.fold(
+                window_sq, output_size=(1, output_size), kernel_size=(1, self.win_length), stride=(1, self.hop_length),
+            )[:, 0, 0, pad:-pad]
+            y = y / window_envelope.clamp(min=1e-11)
+            return y * length_mask(y[:, None], lengths * self.hop_length)[:, 0]
+
         # Window envelope
         window_sq = self.window.square().expand(1, T, -1).transpose(1, 2)
         window_envelope = torch.nn.functional.fold(
@@ -268,13 +303,14 @@ class ISTFTHead(FourierHead):
         self.out = torch.nn.Linear(dim, out_dim)
         self.istft = ISTFT(n_fft=n_fft, hop_length=hop_length, win_length=n_fft, padding=padding)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, lengths: Optional[torch.Tensor] = None) -> torch.Tensor:
         """
         Forward pass of the ISTFTHead module.
 
         Args:
             x (Tensor): Input tensor of shape (B, L, H), where B is the batch size,
                         L is the sequence length, and H denotes the model dimension.
+            lengths (Tensor, optional): Valid frames of each row when x is a padded batch.
 
         Returns:
             Tensor: Reconstructed time-domain audio signal of shape (B, T), where T is the length of the output signal.
@@ -283,6 +319,8 @@ class ISTFTHead(FourierHead):
         mag, p = x.chunk(2, dim=1)
         mag = torch.exp(mag)
         mag = torch.clip(mag, max=1e2)  # safeguard to prevent excessively large magnitudes
+        if lengths is not None:
+            mag = mag * length_mask(mag, lengths)
         # wrapping happens here. These two lines produce real and imaginary value
         x = torch.cos(p)
         y = torch.sin(p)
@@ -292,7 +330,7 @@ class ISTFTHead(FourierHead):
         # S = mag * torch.exp(phase * 1j)
         # better directly produce the complex value 
         S = mag * (x + 1j * y)
-        audio = self.istft(S)
+        audio = self.istft(S, lengths)
         return audio
 
     def transform(self, input_data):
@@ -335,18 +373,21 @@ class AdainResBlk1d(nn.Module):
             x = self.conv1x1(x)
         return x
 
-    def _residual(self, x, s):
-        x = self.norm1(x, s)
+    def _residual(self, x, s, lengths=None):
+        x = self.norm1(x, s, lengths)
         x = self.actv(x)
         x = self.pool(x)
+        if lengths is not None and self.upsample_type != 'none':
+            lengths = lengths * 2
+            x = x * length_mask(x, lengths) #the transposed conv bias leaks into the padding
         x = self.conv1(self.dropout(x))
-        x = self.norm2(x, s)
+        x = self.norm2(x, s, lengths)
         x = self.actv(x)
         x = self.conv2(self.dropout(x))
         return x
 
-    def forward(self, x, s):
-        out = self._residual(x, s)
+    def forward(self, x, s, lengths=None):
+        out = self._residual(x, s, lengths)
         out = (out + self._shortcut(x)) / math.sqrt(2)
         return out
     
@@ -389,7 +430,8 @@ class Decoder(nn.Module):
                                    intermediate_dim=intermediate_dim, num_layers=num_layers, 
                                    gen_istft_n_fft=gen_istft_n_fft, gen_istft_hop_size=gen_istft_hop_size)
         
-    def forward(self, asr, F0_curve, N, s):
+    def forward(self, asr, F0_curve, N, s, lengths=None, trim=0):
+        #trim: samples left out at either end of every row, the generator skips the steps only they need
         if self.training:
             downlist = [0, 3, 7]
             F0_down = downlist[random.randint(0, 2)]
@@ -400,12 +442,21 @@ class Decoder(nn.Module):
             if N_down:
                 N = nn.functional.conv1d(N.unsqueeze(1), torch.ones(1, 1, N_down).to('cuda'), padding=N_down//2).squeeze(1)  / N_down
 
-        
+
+        x, lengths = self._encode(asr, F0_curve, N, s, lengths)
+        if trim:
+            return self.generator.trimmed(x, s, trim, lengths).unsqueeze(1)
+        x = self.generator(x, s, lengths)
+        x = x.unsqueeze(1)
+        return x
+
+    def _encode(self, asr, F0_curve, N, s, lengths=None):
+        #Everything before the generator, at twice the frame rate after the last block
         F0 = self.F0_conv(F0_curve.unsqueeze(1))
         N = self.N_conv(N.unsqueeze(1))
         
         x = torch.cat([asr, F0, N], axis=1)
-        x = self.encode(x, s)
+        x = self.encode(x, s, lengths)
         
         asr_res = self.asr_res(asr)
         
@@ -413,10 +464,17 @@ class Decoder(nn.Module):
         for block in self.decode:
             if res:
                 x = torch.cat([x, asr_res, F0, N], axis=1)
-            x = block(x, s)
+            x = block(x, s, lengths)
             if block.upsample_type != "none":
                 res = False
-        
-        x = self.generator(x, s)
-        x = x.unsqueeze(1)
-        return x  
\ No newline at end of file
+                if lengths is not None:
+                    lengths = lengths * 2
+        return x, lengths
+
+    def stream(self, asr, F0_curve, N, s, chunk=160, context=None, fade=4, parallel=1, trim=0):
+        #forward() of one unpadded sentence with the generator run on `chunk` steps (1/80 s each) at a time, `context` steps of margin
+        #on either side and `fade` steps of cross-fade per cut. Its activations no longer grow with the sentence and audio comes out
+        #before the sentence is done. The generator's InstanceNorms only see their window: close to forward(), not identical
+        x, _ = self._encode(asr, F0_curve, N, s)
+        for piece in self.generator.stream(x, s, chunk, context, fade, parallel, trim):
+            yield piece.unsqueeze(1)
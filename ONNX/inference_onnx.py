@@ -152,28 +152,6 @@ class StyleTTS2(torch.nn.Module):
         self.eval()
         self.to(self.device)
     
-    def __onnx_alignment(self, pred_dur, max_length):
-        seq_length = pred_dur.sum().to(dtype=torch.int64)
-        device = pred_dur.device
-                
-        clipped_dur = torch.clamp(pred_dur, 0, seq_length)
-        
-        zero_tensor = torch.zeros(1, device=device)
-        prefix_sum = torch.cat([zero_tensor, torch.cumsum(clipped_dur[:-1], dim=0)])
-        
-        positions = torch.arange(seq_length, device=device).unsqueeze(0).expand(max_length, -1)
-        
-        start_positions = prefix_sum.unsqueeze(1)
-        
-        end_positions = torch.min(
-            start_positions + clipped_dur.unsqueeze(1),
-            start_positions.new_full(start_positions.shape, seq_length, dtype=torch.float)
-        )
-        
-        mask = (positions >= start_positions) & (positions < end_positions)
-
-        return mask.float()
-    
     def __recursive_munch(self, d):
         if isinstance(d, dict):
             return Munch((k, self.__recursive_munch(v)) for k, v in d.items())
@@ -242,20 +220,10 @@ class StyleTTS2(torch.nn.Module):
 
             pred_dur = torch.round(duration.squeeze()).clamp(min=1)
 
-            if torch.onnx.is_in_onnx_export():
-                pred_aln_trg = self.__onnx_alignment(pred_dur, input_lengths[0])
-            else:
-                pred_aln_trg = torch.zeros(input_lengths, int(pred_dur.sum().data))
-                c_frame = 0
-                for i in range(pred_aln_trg.size(0)):
-                    pred_aln_trg[i, c_frame:c_frame + int(pred_dur[i].data)] = 1
-                    c_frame += int(pred_dur[i].data)
-            alignment = pred_aln_trg.unsqueeze(0).to(device)
-
             # encode prosody
-            en = (d.transpose(2, 1) @ alignment)
+            en = length_regulator(d.transpose(2, 1), pred_dur)
             F0_pred, N_pred = self.predictor.F0Ntrain(en, s)
-            asr = (t_en @ alignment)
+            asr = length_regulator(t_en, pred_dur)
 
             out = self.decoder(asr, F0_pred, N_pred, s)
             out = out.squeeze()[4000:-4000] #Remove weird pulse and silent tokens
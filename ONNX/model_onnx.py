@@ -437,4 +437,22 @@ class DurationEncoder(nn.Module):
     def length_to_mask(self, lengths):
         mask = torch.arange(lengths.max()).unsqueeze(0).expand(lengths.shape[0], -1).type_as(lengths)
         mask = torch.gt(mask+1, lengths.unsqueeze(1))
-        return mask
\ No newline at end of file
+        return mask
+
+
+def length_regulator(x, duration):
+    """
+    Repeat every token of x [1, C, T] by its duration [T] => [1, C, F].
+    Same result as x @ alignment without the dense [T x F] matrix. The frame count stays a tensor
+    (no int() conversion), so the op traces with a dynamic length and exports to ONNX.
+    Every duration must be >= 1.
+    """
+    duration = duration.to(dtype=torch.int64)
+    frames = torch.arange(duration.sum(), device=duration.device)
+
+    #Mark the first frame of every token, a cumulative sum then gives the token index of each frame
+    starts = torch.cumsum(duration, dim=0)[:-1]
+    marks = torch.zeros_like(frames).scatter_add(0, starts, torch.ones_like(starts))
+    index = torch.cumsum(marks, dim=0)
+
+    return x.index_select(2, index)
@@ -0,0 +1,148 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import resource
+import platform
+import statistics
+import yaml
+import torch
+from munch import Munch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+from models import build_model_custom
+from Modules.diffusion.sampler import DiffusionSampler, ADPM2Sampler, KarrasSchedule
+from Modules.utils import remove_weight_norms
+
+CONFIG_PATH = os.path.join(ROOT, 'Configs', 'config_example.yaml')
+INFERENCE_MODULES = ['decoder', 'predictor', 'text_encoder', 'style_encoder', 'diffusion']
+#The decoder alternatives commented out in Configs/config_example.yaml
+DECODERS = {
+    'hifigan': {'type': 'hifigan', 'resblock_kernel_sizes': [3, 7, 11], 'upsample_rates': [10, 5, 3, 2], 'upsample_initial_channel': 512,
+                'resblock_dilation_sizes': [[1, 3, 5], [1, 3, 5], [1, 3, 5]], 'upsample_kernel_sizes': [20, 10, 6, 4]},
+    'istftnet': {'type': 'istftnet', 'resblock_kernel_sizes': [3, 7, 11], 'upsample_rates': [10, 6], 'upsample_initial_channel': 512,
+                 'resblock_dilation_sizes': [[1, 3, 5], [1, 3, 5], [1, 3, 5]], 'upsample_kernel_sizes': [20, 12],
+                 'gen_istft_n_fft': 20, 'gen_istft_hop_size': 5},
+    'vocos': {'type': 'vocos', 'intermediate_dim': 1536, 'num_layers': 8, 'gen_istft_n_fft': 1200, 'gen_istft_hop_size': 300},
+}
+SAMPLE_RATE = 24000
+SAMPLES_PER_FRAME = 600 #decoder output samples per predicted frame
+
+def recursive_munch(d):
+    if isinstance(d, dict):
+        return Munch((k, recursive_munch(v)) for k, v in d.items())
+    if isinstance(d, list):
+        return [recursive_munch(v) for v in d]
+    return d
+
+def load_config(config_path=CONFIG_PATH, decoder=None):
+    #The config with its decoder swapped for one of DECODERS, unless it already is that type
+    config = yaml.safe_load(open(config_path, "r", encoding="utf-8"))
+    if decoder is not None and config['model_params']['decoder']['type'] != decoder:
+        config['model_params']['decoder'] = dict(DECODERS[decoder])
+    return config
+
+def n_symbols(config):
+    #Same symbol dict as StyleTTS2.__init__, a symbol listed twice counts once
+    symbols = [symbol for key in ['pad', 'punctuation', 'letters', 'letters_ipa', 'extend'] for symbol in config['symbol'][key]]
+    return len(dict.fromkeys(symbols)) + 1
+
+def build_modules(config, modules=INFERENCE_MODULES, seed=0, freeze=False):
+    #{module: nn.Module} with random weights, in eval mode. freeze folds weight norm like StyleTTS2.freeze_for_inference
+    args = recursive_munch(config['model_params'])
+    args['n_token'] = n_symbols(config)
+    torch.manual_seed(seed)
+    nets = build_model_custom(args, modules)
+    nets = {key: nets[key].eval() for key in modules}
+    if freeze:
+        for net in nets.values():
+            remove_weight_norms(net)
+        for net in nets.values():
+            net.requires_grad_(False)
+    return nets
+
+def write_checkpoint(out_dir, decoder=None, seed=0, config_path=CONFIG_PATH, frames_per_token=7):
+    #A random weight checkpoint + config StyleTTS2 (and its Diffusion) can load => (config path, models path).
+    #The duration bias is set so every token lasts about frames_per_token frames, like real speech
+    config = load_config(config_path, decoder)
+    nets = build_modules(config, INFERENCE_MODULES, seed)
+    bias = -math.log(config['model_params']['max_dur'] / frames_per_token - 1) #sigmoid(bias) * max_dur = frames_per_token
+    nets['predictor'].duration_proj.linear_layer.bias.data.fill_(bias)
+    os.makedirs(out_dir, exist_ok=True)
+    name = config['model_params']['decoder']['type']
+    config_out, models_out = os.path.join(out_dir, f'{name}.yaml'), os.path.join(out_dir, f'{name}.pth')
+    with open(config_out, 'w', encoding='utf-8') as f:
+        yaml.safe_dump(config, f, allow_unicode=True)
+    torch.save({'net': {key: net.state_dict() for key, net in nets.items()}}, models_out)
+
+    #StyleTTS2 falls back to strict=False on any mismatch, random weights would then go unnoticed
+    loaded = build_modules(load_config(config_out), INFERENCE_MODULES, seed + 1)
+    params = torch.load(models_out, map_location='cpu')['net']
+    for key, net in loaded.items():
+        net.load_state_dict(params[key], strict=True)
+    return config_out, models_out
+
+def sampler(diffusion):
+    #Same sampler as inference.Diffusion
+    return DiffusionSampler(diffusion.diffusion, sampler=ADPM2Sampler(), sigma_schedule=KarrasSchedule(sigma_min=0.0001, sigma_max=3.0, rho=9.0), clamp=False)
+
+def measure(fn, warmup=1, repeats=5):
+    #Seconds per call of fn: median, min, mean, max over `repeats` calls after `warmup` untimed ones
+    cuda = torch.cuda.is_available()
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        if cuda: torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if cuda: torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return {'median': statistics.median(times), 'min': min(times), 'mean': statistics.mean(times), 'max': max(times), 'repeats': repeats}
+
+def thread_counts(cpus=None):
+    #Powers of two up to the core count, and the core count
+    cpus = cpus or os.cpu_count() or 1
+    return sorted({n for n in [1, 2, 4, 8, 16, 32, cpus] if n <= cpus})
+
+def peak_rss_mb():
+    #Peak resident memory of this process so far, Linux reports KiB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def cpu_model():
+    try:
+        with open('/proc/cpuinfo', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+def machine():
+    #What the numbers depend on besides the code
+    return {
+        'platform': platform.platform(),
+        'processor': cpu_model(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+    }
+
+def profile_name(info=None):
+    #Baseline name of a machine: its cpu model and core count, e.g. intel-xeon-platinum-8375c-cpu-2-90ghz-32cpu
+    info = info or machine()
+    slug = re.sub(r'[^a-z0-9]+', '-', info['processor'].lower()).strip('-')
+    return f"{slug}-{info['cpus']}cpu"
+
+def parse_list(value, cast=int):
+    return None if value is None else [cast(v) for v in value.split(',') if v]
+
+def write_json(path, data):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=1)
+    os.replace(path + '.tmp', path)
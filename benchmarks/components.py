@@ -0,0 +1,180 @@
+"""
+Micro-benchmarks of the inference modules, built from Configs/config_example.yaml with random weights: no checkpoint needed.
+Every component is timed on its own over a sweep of token lengths, batch sizes, thread counts and decoder types.
+
+    python benchmarks/components.py run -o bench.json
+    python benchmarks/components.py run --decoders vocos --tokens 32,128 --batch_sizes 1 --threads 4 -o vocos.json
+    python benchmarks/components.py compare before.json after.json
+
+Components: text_encoder, predictor.duration (prosody text encoder + LSTM + duration projection), predictor.F0Ntrain,
+style_encoder, decoder (per type), stft (istftnet's CustomSTFT forward + inverse) and diffusion (the style sampler).
+Frames come from a fixed number of frames per token instead of predicted durations, random weights predict nonsense.
+"""
+import os
+import sys
+import time
+import json
+import click
+import torch
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from common import (CONFIG_PATH, DECODERS, SAMPLE_RATE, SAMPLES_PER_FRAME, load_config, n_symbols, build_modules, sampler,
+                    measure, thread_counts, machine, parse_list, write_json)
+from models import length_regulator
+from Modules.istftnet import CustomSTFT
+
+COMPONENTS = ['text_encoder', 'predictor.duration', 'predictor.F0Ntrain', 'style_encoder', 'decoder', 'stft', 'diffusion']
+
+def inputs(config, tokens, batch, frames_per_token, device):
+    #Random inputs with the shapes inference produces for `tokens` tokens lasting frames_per_token frames each
+    hidden, style_dim, n_mels = config['model_params']['hidden_dim'], config['model_params']['style_dim'], config['model_params']['n_mels']
+    frames = tokens * frames_per_token
+    return {
+        'tokens': torch.randint(1, n_symbols(config), (batch, tokens), device=device),
+        'lengths': torch.full((batch,), tokens, dtype=torch.long, device=device),
+        'mask': torch.zeros(batch, tokens, dtype=torch.bool, device=device),
+        'durations': torch.full((batch, tokens), frames_per_token, dtype=torch.long, device=device),
+        't_en': torch.randn(batch, hidden, tokens, device=device),
+        's': torch.randn(batch, style_dim, device=device),
+        'mel': torch.randn(batch, 1, n_mels, 2 * frames, device=device),
+        'asr': torch.randn(batch, hidden, frames, device=device),
+        'F0': 150 + 20 * torch.randn(batch, 2 * frames, device=device), #Hz, two per frame
+        'N': torch.randn(batch, 2 * frames, device=device),
+        'wave': 0.1 * torch.randn(batch, frames * SAMPLES_PER_FRAME, device=device),
+    }
+
+def bench_front(nets, x, diffusion_steps):
+    #{component: fn} of the modules in front of the decoder
+    text_encoder, predictor, style_encoder = nets['text_encoder'], nets['predictor'], nets['style_encoder']
+
+    def duration():
+        d = predictor.text_encoder(x['t_en'], x['s'], x['lengths'], x['mask'])
+        h, _ = predictor.lstm(d)
+        return torch.sigmoid(predictor.duration_proj(h)).sum(axis=-1)
+
+    d = predictor.text_encoder(x['t_en'], x['s'], x['lengths'], x['mask'])
+    en, _ = length_regulator(d.transpose(-1, -2), x['durations'])
+    fns = {
+        'text_encoder': lambda: text_encoder(x['tokens'], x['lengths'], x['mask']),
+        'predictor.duration': duration,
+        'predictor.F0Ntrain': lambda: predictor.F0Ntrain(en, x['s']),
+        'style_encoder': lambda: style_encoder(x['mel']),
+    }
+    if 'diffusion' in nets:
+        diffusion = sampler(nets['diffusion'])
+        fns['diffusion'] = lambda: diffusion(noise=torch.randn_like(x['s']).unsqueeze(1), embedding=x['t_en'].transpose(-1, -2),
+                                             embedding_scale=1, embedding_mask_proba=0.1, num_steps=diffusion_steps)
+    return fns
+
+def sweep(config_path, decoders, tokens, batch_sizes, threads, components, frames_per_token, diffusion_steps, warmup, repeats, device, freeze, seed):
+    #One result row per (component, decoder, tokens, batch, threads)
+    rows = []
+    front = [c for c in components if c not in ('decoder', 'stft')]
+    nets = {}
+    if front:
+        modules = ['text_encoder', 'predictor', 'style_encoder'] + (['diffusion'] if 'diffusion' in front else [])
+        nets[None] = build_modules(load_config(config_path), modules, seed, freeze)
+    if 'decoder' in components:
+        for decoder in decoders:
+            nets[decoder] = build_modules(load_config(config_path, decoder), ['decoder'], seed, freeze)
+    for net in [module for group in nets.values() for module in group.values()]:
+        net.to(device)
+    stft = None
+    if 'stft' in components:
+        n_fft, hop = DECODERS['istftnet']['gen_istft_n_fft'], DECODERS['istftnet']['gen_istft_hop_size']
+        stft = CustomSTFT(filter_length=n_fft, hop_length=hop, win_length=n_fft).to(device)
+    config = load_config(config_path)
+
+    def record(component, decoder, n_tokens, batch, n_threads, fn):
+        torch.manual_seed(seed)
+        with torch.no_grad():
+            timing = measure(fn, warmup, repeats)
+        audio = batch * n_tokens * frames_per_token * SAMPLES_PER_FRAME / SAMPLE_RATE
+        row = {'component': component, 'decoder': decoder, 'tokens': n_tokens, 'frames': n_tokens * frames_per_token, 'batch': batch,
+               'threads': n_threads, **timing, 'audio_seconds': audio, 'rtf': timing['median'] / audio}
+        rows.append(row)
+        print(f"{component:<20} {decoder or '-':<9} tokens={n_tokens:<4} batch={batch:<3} threads={n_threads:<3} "
+              f"median={timing['median']*1000:9.2f} ms  rtf={row['rtf']:.4f}")
+
+    for n_threads in threads:
+        torch.set_num_threads(n_threads)
+        for n_tokens in tokens:
+            for batch in batch_sizes:
+                x = inputs(config, n_tokens, batch, frames_per_token, device)
+                with torch.no_grad():
+                    fns = bench_front(nets[None], x, diffusion_steps) if front else {}
+                for component in front:
+                    record(component, None, n_tokens, batch, n_threads, fns[component])
+                if 'decoder' in components:
+                    for decoder in decoders:
+                        net = nets[decoder]['decoder']
+                        record('decoder', decoder, n_tokens, batch, n_threads, lambda: net(x['asr'], x['F0'], x['N'], x['s']))
+                if stft is not None:
+                    record('stft', 'istftnet', n_tokens, batch, n_threads, lambda: stft.inverse(*stft.transform(x['wave'])))
+    return rows
+
+def row_key(row):
+    return (row['component'], row['decoder'], row['tokens'], row['batch'], row['threads'])
+
+@click.group()
+def cli():
+    pass
+
+@cli.command()
+@click.option('-c', '--config_path', default=CONFIG_PATH, show_default=True, help='Config the modules are built from')
+@click.option('--decoders', default='hifigan,istftnet,vocos', show_default=True)
+@click.option('--tokens', default='16,64,128', show_default=True, help='Token lengths')
+@click.option('--batch_sizes', default='1,4', show_default=True)
+@click.option('--threads', default=None, help='Thread counts [default: powers of two up to the core count]')
+@click.option('--components', default=','.join(COMPONENTS), show_default=True)
+@click.option('--frames_per_token', default=7, show_default=True, help='Frames (1/40 s) each token lasts')
+@click.option('--diffusion_steps', default=5, show_default=True)
+@click.option('--warmup', default=1, show_default=True)
+@click.option('--repeats', default=5, show_default=True)
+@click.option('--device', default='cpu', show_default=True)
+@click.option('--freeze', is_flag=True, help='Fold weight norm first, like StyleTTS2.freeze_for_inference')
+@click.option('--seed', default=0, show_default=True)
+@click.option('-o', '--output', default=None, help='Results json [default: print only]')
+def run(config_path, decoders, tokens, batch_sizes, threads, components, frames_per_token, diffusion_steps, warmup, repeats, device, freeze, seed, output):
+    components = parse_list(components, str)
+    unknown = set(components) - set(COMPONENTS)
+    if unknown:
+        raise click.BadParameter(f"unknown components {sorted(unknown)}, choose from {COMPONENTS}")
+    decoders = parse_list(decoders, str)
+    unknown = set(decoders) - set(DECODERS)
+    if unknown:
+        raise click.BadParameter(f"unknown decoders {sorted(unknown)}, choose from {list(DECODERS)}")
+    start = time.time()
+    rows = sweep(config_path, decoders, parse_list(tokens), parse_list(batch_sizes), parse_list(threads) or thread_counts(), components,
+                 frames_per_token, diffusion_steps, warmup, repeats, device, freeze, seed)
+    results = {
+        'machine': machine(),
+        'settings': {'config_path': os.path.relpath(config_path), 'frames_per_token': frames_per_token, 'diffusion_steps': diffusion_steps,
+                     'warmup': warmup, 'repeats': repeats, 'device': device, 'freeze': freeze, 'seed': seed},
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(start)),
+        'duration': time.time() - start,
+        'results': rows,
+    }
+    if output:
+        write_json(output, results)
+        print(f"Saved {len(rows)} results to {output}")
+
+@cli.command()
+@click.argument('before', type=click.Path(exists=True))
+@click.argument('after', type=click.Path(exists=True))
+def compare(before, after):
+    #Median speedup of every row both runs have, > 1 is faster
+    before = {row_key(row): row for row in json.load(open(before, encoding='utf-8'))['results']}
+    after = {row_key(row): row for row in json.load(open(after, encoding='utf-8'))['results']}
+    shared = [key for key in after if key in before]
+    if not shared:
+        print("No common rows")
+        return
+    for key in shared:
+        component, decoder, n_tokens, batch, n_threads = key
+        old, new = before[key]['median'], after[key]['median']
+        print(f"{component:<20} {decoder or '-':<9} tokens={n_tokens:<4} batch={batch:<3} threads={n_threads:<3} "
+              f"{old*1000:9.2f} -> {new*1000:9.2f} ms  x{old/new:.2f}")
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,367 @@
+"""
+Performance regression check against a stored baseline, CPU only with random weight models: no checkpoint or dataset needed.
+One baseline per machine profile (cpu model and core count) in benchmarks/baselines, check re-runs with the baseline's settings.
+
+    python benchmarks/regression.py record                     # store this machine's baseline
+    python benchmarks/regression.py check                      # exit 1 when a metric got slower/bigger than the tolerance allows
+    python benchmarks/regression.py check --tolerance 0.15 --metric_tolerance "train.*=0.3" -o current.json
+    python benchmarks/regression.py diff before.json after.json
+
+Suites, each in a fresh forked process so peak RSS only counts its own work:
+- generate: end-to-end StyleTTS2.generate latency and rtf on a paragraph of phonemes, peak RSS
+- modules: the components.py timings of every module at one token length and batch size
+- train: one iteration of train.py's loop (discriminator and generator steps of every module) on a random batch, peak RSS
+Every metric is lower-is-better: seconds (_s), real-time factor (_rtf) or MiB (_mb), except the output length
+(generate.samples) which must match the baseline exactly, other timings aren't comparable otherwise.
+"""
+import os
+import sys
+import json
+import time
+import random
+import fnmatch
+import tempfile
+import multiprocessing as mp
+import click
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from common import (CONFIG_PATH, DECODERS, SAMPLE_RATE, load_config, n_symbols, recursive_munch, write_checkpoint, measure,
+                    peak_rss_mb, machine, profile_name, parse_list, write_json)
+import components
+from thread_tuning import BENCH_TEXTS
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+SUITES = ['generate', 'modules', 'train']
+EXACT_METRICS = {'generate.samples'} #the work done, not its cost
+SETTINGS = {
+    'decoder': 'hifigan',
+    'threads': None, #torch's default when None
+    'warmup': 1,
+    'repeats': 5,
+    'seed': 0,
+    'diffusion': False, #style diffusion in generate
+    'tokens': 64, #modules suite
+    'batch': 1,
+    'train_batch': 2,
+    'max_len': 100, #frames of the training segment, config max_len
+    'train_repeats': 3,
+}
+
+def seed_all(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+def suite_generate(settings):
+    from inference import StyleTTS2
+    seed_all(settings['seed'])
+    with tempfile.TemporaryDirectory() as tmp:
+        config_path, models_path = write_checkpoint(tmp, settings['decoder'], settings['seed'])
+        diffusion = settings['diffusion'] and {'config_diff_path': config_path, 'models_diff_path': models_path} or {}
+        model = StyleTTS2(config_path, models_path, thread_profile=False, **diffusion).eval()
+        #StyleTTS2 falls back to strict=False on a mismatch, a module left random would change the output length
+        params = torch.load(models_path, map_location='cpu')['net']
+        for key in ['decoder', 'predictor', 'text_encoder', 'style_encoder']:
+            getattr(model, key).load_state_dict(params[key], strict=True)
+        if settings['diffusion']:
+            model.diffusion.model_diffusion.load_state_dict(params['diffusion'], strict=True)
+    seed_all(settings['seed'])
+    style = {'style': torch.randn(1, load_config(CONFIG_PATH)['model_params']['style_dim']), 'path': None, 'speed': 1}
+    text = ' '.join(BENCH_TEXTS)
+    samples = []
+
+    def generate():
+        #Speed stabilization draws the durations' noise from torch's RNG, the same seed every call gives the same durations
+        seed_all(settings['seed'])
+        samples.append(len(model.generate(text, style)))
+
+    timing = measure(generate, settings['warmup'], settings['repeats'])
+    #Every call must do the same work, a timing of a shorter clip is not comparable
+    if len(set(samples)) != 1:
+        raise RuntimeError(f"generate output length varies between calls: {samples}")
+    audio = samples[-1] / SAMPLE_RATE
+    return {'generate.latency_s': timing['median'], 'generate.rtf': timing['median'] / audio, 'generate.peak_rss_mb': peak_rss_mb(),
+            'generate.samples': samples[-1]}
+
+def suite_modules(settings):
+    rows = components.sweep(CONFIG_PATH, [settings['decoder']], [settings['tokens']], [settings['batch']], [torch.get_num_threads()],
+                            components.COMPONENTS, 7, 5, settings['warmup'], settings['repeats'], 'cpu', False, settings['seed'])
+    return {f"module.{row['component']}" + (f".{row['decoder']}" if row['decoder'] else '') + '_s': row['median'] for row in rows}
+
+def suite_train(settings):
+    #Same work as one iteration of train.py's loop, minus the data loading: aligner, encoders, predictor, decoder,
+    #pitch extractor, discriminator step, every loss and the generator step
+    from models import build_model
+    from losses import GeneratorLoss, DiscriminatorLoss, MultiResolutionSTFTLoss
+    from utils import maximum_path, mask_from_lens, length_to_mask, log_norm
+    from optimizers import build_optimizer
+
+    config = load_config(CONFIG_PATH, settings['decoder'])
+    args = recursive_munch(config['model_params'])
+    args['n_token'] = n_symbols(config)
+    seed_all(settings['seed'])
+    model = build_model(args)
+    loss_params = recursive_munch(config['loss_params'])
+    optimizer_params = config['optimizer_params']
+    scheduler_params = {key: {'max_lr': optimizer_params['lr'], 'pct_start': 0.0, 'epochs': 1, 'steps_per_epoch': 1000} for key in model}
+    optimizer = build_optimizer({key: model[key].parameters() for key in model}, scheduler_params_dict=scheduler_params, lr=optimizer_params['lr'])
+    gl, dl, stft_loss = GeneratorLoss(model.mpd, model.msd), DiscriminatorLoss(model.mpd, model.msd), MultiResolutionSTFTLoss()
+    n_down = model.text_aligner.n_down
+    for key in model:
+        model[key].eval()
+    for key in ['text_aligner', 'text_encoder', 'predictor', 'msd', 'mpd']:
+        model[key].train()
+
+    #Random batch: utterances twice the segment the decoder trains on, a token every 14 mel frames (7 predicted frames)
+    batch, max_len = settings['train_batch'], settings['max_len']
+    n_mels = 2 * max_len
+    texts = torch.randint(1, args.n_token, (batch, max(n_mels // 14, 3)))
+    input_lengths = torch.full((batch,), texts.shape[1], dtype=torch.long)
+    mels = torch.randn(batch, args.n_mels, n_mels) * 2 - 4
+    mel_input_length = torch.full((batch,), n_mels, dtype=torch.long)
+    waves = [0.1 * np.random.randn(n_mels * 300).astype(np.float32) for _ in range(batch)]
+
+    def step():
+        with torch.no_grad():
+            mask = length_to_mask(mel_input_length // (2 ** n_down))
+            text_mask = length_to_mask(input_lengths)
+        ppgs, s2s_pred, s2s_attn = model.text_aligner(mels, mask, texts)
+        s2s_attn = s2s_attn.transpose(-1, -2)[..., 1:].transpose(-1, -2)
+        mask_ST = mask_from_lens(s2s_attn, input_lengths, mel_input_length // (2 ** n_down))
+        s2s_attn_mono = maximum_path(s2s_attn, mask_ST)
+
+        t_en = model.text_encoder(texts, input_lengths, text_mask)
+        asr = t_en @ s2s_attn_mono
+        d_gt = s2s_attn_mono.sum(axis=-1).detach()
+        s = model.style_encoder(mels.unsqueeze(1))
+        d, p = model.predictor(t_en, s, input_lengths, s2s_attn_mono, text_mask)
+
+        mel_len = min(int(mel_input_length.min().item() / 2 - 1), max_len // 2)
+        en, gt, p_en, wav = [], [], [], []
+        for bib in range(len(mel_input_length)):
+            mel_length = int(mel_input_length[bib].item() / 2)
+            random_start = np.random.randint(0, mel_length - mel_len)
+            en.append(asr[bib, :, random_start:random_start+mel_len])
+            p_en.append(p[bib, :, random_start:random_start+mel_len])
+            gt.append(mels[bib, :, (random_start * 2):((random_start+mel_len) * 2)])
+            wav.append(torch.from_numpy(waves[bib][(random_start * 2) * 300:((random_start+mel_len) * 2) * 300]))
+        wav = torch.stack(wav).float().detach()
+        en, p_en, gt = torch.stack(en), torch.stack(p_en), torch.stack(gt).detach()
+
+        s = model.style_encoder(gt.unsqueeze(1))
+        with torch.no_grad():
+            F0_real, _, _ = model.pitch_extractor(gt.unsqueeze(1))
+            N_real = log_norm(gt.unsqueeze(1)).squeeze(1)
+            wav = wav.unsqueeze(1)
+        F0_fake, N_fake = model.predictor.F0Ntrain(p_en, s)
+        y_rec = model.decoder(en, F0_fake, N_fake, s)
+        loss_F0_rec = F.smooth_l1_loss(F0_real, F0_fake) / 10
+        loss_norm_rec = F.smooth_l1_loss(N_real, N_fake)
+
+        optimizer.zero_grad()
+        d_loss = dl(wav.detach(), y_rec.detach()).mean()
+        d_loss.backward()
+        optimizer.step('msd')
+        optimizer.step('mpd')
+
+        optimizer.zero_grad()
+        loss_mel = stft_loss(y_rec, wav)
+        loss_gen_all = gl(wav, y_rec).mean()
+        loss_ce, loss_dur = 0, 0
+        for _s2s_pred, _text_input, _text_length in zip(d, d_gt, input_lengths):
+            _s2s_pred = _s2s_pred[:_text_length, :]
+            _text_input = _text_input[:_text_length].long()
+            _s2s_trg = torch.zeros_like(_s2s_pred)
+            for i in range(_s2s_trg.shape[0]):
+                _s2s_trg[i, :_text_input[i]] = 1
+            _dur_pred = torch.sigmoid(_s2s_pred).sum(axis=1)
+            loss_dur += F.l1_loss(_dur_pred[1:_text_length-1], _text_input[1:_text_length-1])
+            loss_ce += F.binary_cross_entropy_with_logits(_s2s_pred.flatten(), _s2s_trg.flatten())
+        loss_ce /= batch
+        loss_dur /= batch
+        loss_s2s = sum(F.cross_entropy(_s2s_pred[:_text_length], _text_input[:_text_length])
+                       for _s2s_pred, _text_input, _text_length in zip(s2s_pred, texts, input_lengths)) / batch
+        loss_mono = F.l1_loss(s2s_attn, s2s_attn_mono) * 10
+        g_loss = (loss_params.lambda_mel * loss_mel + loss_params.lambda_F0 * loss_F0_rec + loss_params.lambda_ce * loss_ce +
+                  loss_params.lambda_norm * loss_norm_rec + loss_params.lambda_dur * loss_dur +
+                  loss_params.lambda_gen * loss_gen_all + loss_params.lambda_mono * loss_mono + loss_params.lambda_s2s * loss_s2s)
+        g_loss.backward()
+        for key in ['predictor', 'style_encoder', 'decoder', 'text_encoder', 'text_aligner']:
+            optimizer.step(key)
+
+    timing = measure(step, settings['warmup'], settings['train_repeats'])
+    return {'train.step_s': timing['median'], 'train.peak_rss_mb': peak_rss_mb()}
+
+SUITE_FNS = {'generate': suite_generate, 'modules': suite_modules, 'train': suite_train}
+
+def suite_main(name, settings, results):
+    try:
+        if settings['threads']:
+            torch.set_num_threads(settings['threads'])
+        results.put((SUITE_FNS[name](settings), None))
+    except Exception as e:
+        import traceback
+        results.put((None, traceback.format_exc()))
+
+def run_suite(name, settings, timeout=3600):
+    #Runs in a forked process: a fresh peak RSS and no state left over from the previous suite
+    ctx = mp.get_context('fork')
+    results = ctx.Queue()
+    process = ctx.Process(target=suite_main, args=(name, settings, results), daemon=True)
+    process.start()
+    try:
+        metrics, error = results.get(timeout=timeout)
+    finally:
+        process.join(1)
+        if process.is_alive():
+            process.terminate()
+    if error is not None:
+        raise RuntimeError(f"Suite {name} failed:\n{error}")
+    return metrics
+
+def run_all(settings, suites):
+    metrics = {}
+    for name in suites:
+        print(f"Running {name}...")
+        start = time.perf_counter()
+        metrics.update(run_suite(name, settings))
+        print(f"{name} done in {time.perf_counter() - start:.1f} s")
+    return {'machine': machine(), 'settings': settings, 'suites': suites, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'metrics': metrics}
+
+def tolerance_for(metric, tolerance, overrides):
+    #First matching pattern of --metric_tolerance wins
+    for pattern, value in overrides:
+        if fnmatch.fnmatch(metric, pattern):
+            return value
+    return tolerance
+
+def compare(baseline, current, tolerance=0.1, overrides=()):
+    #(rows, regressions), change is relative: +0.25 is 25% slower/bigger than the baseline
+    rows, regressions = [], []
+    for metric in sorted(set(baseline['metrics']) | set(current['metrics'])):
+        old, new = baseline['metrics'].get(metric), current['metrics'].get(metric)
+        limit = 0 if metric in EXACT_METRICS else tolerance_for(metric, tolerance, overrides)
+        change = None if old is None or new is None or old == 0 else new / old - 1
+        if old is None:
+            status = 'new'
+        elif new is None:
+            status = 'missing'
+        elif metric in EXACT_METRICS and new != old:
+            status = 'CHANGED'
+            regressions.append(metric)
+        elif change > limit:
+            status = 'REGRESSED'
+            regressions.append(metric)
+        elif change < -limit:
+            status = 'improved'
+        else:
+            status = 'ok'
+        rows.append({'metric': metric, 'baseline': old, 'current': new, 'change': change, 'limit': limit, 'status': status})
+    return rows, regressions
+
+def report(baseline, current, rows, regressions):
+    changed = {key: (value, current['machine'].get(key)) for key, value in baseline['machine'].items() if current['machine'].get(key) != value}
+    for key, (old, new) in changed.items():
+        print(f"Note: {key} differs from the baseline: {old} -> {new}")
+    fmt = lambda value: '-' if value is None else f"{value:.4g}"
+    width = max([len(row['metric']) for row in rows] + [6])
+    print(f"\n{'metric':<{width}}  {'baseline':>10}  {'current':>10}  {'change':>8}  {'limit':>6}  status")
+    for row in rows:
+        change = '-' if row['change'] is None else f"{row['change']*100:+.1f}%"
+        print(f"{row['metric']:<{width}}  {fmt(row['baseline']):>10}  {fmt(row['current']):>10}  {change:>8}  {row['limit']*100:>5.0f}%  {row['status']}")
+    if regressions:
+        print(f"\n{len(regressions)} metric(s) regressed beyond the tolerance or changed: {', '.join(regressions)}")
+    else:
+        print("\nNo regressions")
+
+def suite_prefix(name):
+    return {'modules': 'module.'}.get(name, name + '.')
+
+def parse_overrides(values):
+    overrides = []
+    for value in values:
+        pattern, _, limit = value.rpartition('=')
+        if not pattern:
+            raise click.BadParameter(f"expected pattern=tolerance, got {value}")
+        overrides.append((pattern, float(limit)))
+    return overrides
+
+def baseline_path(baseline, profile):
+    return baseline or os.path.join(BASELINE_DIR, f"{profile or profile_name()}.json")
+
+def load_results(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+@click.group()
+def cli():
+    pass
+
+@cli.command()
+@click.option('--suites', default=','.join(SUITES), show_default=True)
+@click.option('--decoder', default=SETTINGS['decoder'], show_default=True, type=click.Choice(list(DECODERS)))
+@click.option('--threads', default=SETTINGS['threads'], type=int, help="torch threads [default: torch's]")
+@click.option('--repeats', default=SETTINGS['repeats'], show_default=True)
+@click.option('--train_repeats', default=SETTINGS['train_repeats'], show_default=True)
+@click.option('--tokens', default=SETTINGS['tokens'], show_default=True, help='Token length of the modules suite')
+@click.option('--max_len', default=SETTINGS['max_len'], show_default=True, help='Mel frames of the training segment')
+@click.option('--diffusion', is_flag=True, help='Style diffusion in generate')
+@click.option('--profile', default=None, help='Baseline name [default: cpu model and core count]')
+@click.option('-b', '--baseline', default=None, help='Baseline path [default: benchmarks/baselines/<profile>.json]')
+def record(suites, decoder, threads, repeats, train_repeats, tokens, max_len, diffusion, profile, baseline):
+    suites = parse_list(suites, str)
+    if set(suites) - set(SUITES):
+        raise click.BadParameter(f"choose suites from {SUITES}")
+    settings = dict(SETTINGS, decoder=decoder, threads=threads, repeats=repeats, train_repeats=train_repeats, tokens=tokens, max_len=max_len,
+                    diffusion=diffusion)
+    results = run_all(settings, suites)
+    path = baseline_path(baseline, profile)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    write_json(path, results)
+    for metric, value in sorted(results['metrics'].items()):
+        print(f"{metric:<40} {value:.4g}")
+    print(f"Saved baseline to {path}")
+
+@cli.command()
+@click.option('--suites', default=None, help="Subset of the baseline's suites")
+@click.option('--tolerance', default=0.1, show_default=True, help='Allowed relative increase of every metric')
+@click.option('--metric_tolerance', multiple=True, help='pattern=tolerance for matching metrics, e.g. "module.*=0.2", repeatable')
+@click.option('--profile', default=None, help='Baseline name [default: cpu model and core count]')
+@click.option('-b', '--baseline', default=None, help='Baseline path [default: benchmarks/baselines/<profile>.json]')
+@click.option('-o', '--output', default=None, help='Save the current results too')
+def check(suites, tolerance, metric_tolerance, profile, baseline, output):
+    overrides = parse_overrides(metric_tolerance)
+    path = baseline_path(baseline, profile)
+    if not os.path.exists(path):
+        print(f"No baseline at {path}, run `python benchmarks/regression.py record` first")
+        raise SystemExit(2)
+    baseline = load_results(path)
+    suites = parse_list(suites, str) or baseline['suites']
+    current = run_all(dict(SETTINGS, **baseline['settings']), suites) #same settings as the baseline
+    if output:
+        write_json(output, current)
+    #Metrics of suites that weren't re-run aren't missing
+    baseline['metrics'] = {metric: value for metric, value in baseline['metrics'].items() if any(metric.startswith(suite_prefix(name)) for name in suites)}
+    rows, regressions = compare(baseline, current, tolerance, overrides)
+    report(baseline, current, rows, regressions)
+    if regressions:
+        raise SystemExit(1)
+
+@cli.command()
+@click.argument('before', type=click.Path(exists=True))
+@click.argument('after', type=click.Path(exists=True))
+@click.option('--tolerance', default=0.1, show_default=True)
+@click.option('--metric_tolerance', multiple=True)
+def diff(before, after, tolerance, metric_tolerance):
+    #Compares two saved results without running anything
+    baseline, current = load_results(before), load_results(after)
+    rows, regressions = compare(baseline, current, tolerance, parse_overrides(metric_tolerance))
+    report(baseline, current, rows, regressions)
+    if regressions:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,79 @@
+import os
+import json
+import hashlib
+import click
+import yaml
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+#Everything else in a training checkpoint (text_aligner, pitch_extractor, mpd, msd, optimizer...) is never used at inference
+INFERENCE_MODULES = ['decoder', 'predictor', 'text_encoder', 'style_encoder', 'diffusion']
+
+def config_hash(config):
+    #Only the sections that decide the tensor shapes
+    config = {key: config.get(key) for key in ['model_params', 'symbol']}
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def is_artifact(models_path):
+    return models_path.endswith('.safetensors')
+
+def read_manifest(models_path):
+    with safe_open(models_path, framework='pt') as f:
+        return json.loads(f.metadata()['manifest'])
+
+def load_modules(models_path, modules, config=None):
+    #Returns {module: state_dict} holding only the requested modules
+    if is_artifact(models_path):
+        params = {key: {} for key in modules}
+        with safe_open(models_path, framework='pt', device='cpu') as f: #memory-mapped, only the requested tensors are read
+            manifest = json.loads(f.metadata()['manifest'])
+            if config is not None and manifest['config_hash'] != config_hash(config):
+                print(f"\nWARNING: {models_path} was exported with a different config, loading may fail.")
+            for name in f.keys():
+                key, param = name.split('.', 1)
+                if key in params:
+                    params[key][param] = f.get_tensor(name)
+        return {key: value for key, value in params.items() if value}
+
+    try:
+        params_whole = torch.load(models_path, map_location='cpu', mmap=True) #unused modules are never paged in
+    except RuntimeError: #checkpoints saved with the legacy (non zip) format can't be memory-mapped
+        params_whole = torch.load(models_path, map_location='cpu')
+    return {key: value for key, value in params_whole['net'].items() if key in modules}
+
+def export_inference(models_path, config_path, out_path, dtype=None):
+    config = yaml.safe_load(open(config_path, "r", encoding="utf-8"))
+    params = load_modules(models_path, INFERENCE_MODULES)
+
+    tensors = {}
+    manifest = {'format': 'stts2-inference', 'version': 1, 'config_hash': config_hash(config),
+                'source': os.path.basename(models_path), 'modules': {}}
+    for key, state_dict in params.items():
+        dtypes = set()
+        n_params = 0
+        for k, v in state_dict.items():
+            if k.startswith('module.'): k = k[7:] # remove `module.`
+            if dtype is not None and v.is_floating_point(): v = v.to(dtype)
+            tensors[f"{key}.{k}"] = v.detach().clone().contiguous() #clone, safetensors refuses shared storage
+            dtypes.add(str(v.dtype).replace('torch.', ''))
+            n_params += v.numel()
+        manifest['modules'][key] = {'tensors': len(state_dict), 'params': n_params, 'dtypes': sorted(dtypes)}
+        print(key, ":", n_params)
+
+    save_file(tensors, out_path, metadata={'manifest': json.dumps(manifest)})
+    print(f"\nSaved {len(params)} modules to {out_path} ({os.path.getsize(out_path)/2**20:.1f} MB)")
+    return manifest
+
+@click.command()
+@click.option('-p', '--config_path', default='Configs/config.yaml', type=str)
+@click.option('-m', '--models_path', required=True, type=str)
+@click.option('-o', '--out_path', default=None, type=str)
+@click.option('--dtype', default=None, type=click.Choice(['float16', 'bfloat16']))
+def main(config_path, models_path, out_path, dtype):
+    if out_path is None:
+        out_path = os.path.splitext(models_path)[0] + '.safetensors'
+    export_inference(models_path, config_path, out_path, getattr(torch, dtype) if dtype else None)
+
+if __name__=="__main__":
+    main()
@@ -1,4 +1,11 @@
+import os
 import re
+import time
+import hashlib
+import asyncio
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 from munch import Munch
 import numpy as np
@@ -15,9 +22,18 @@ from Modules.diffusion.modules import Transformer1d, StyleTransformer1d
 from Modules.diffusion.diffusion import AudioDiffusionConditional
 from Modules.diffusion.sampler import DiffusionSampler, ADPM2Sampler, KarrasSchedule, KDiffusion, LogNormalDistribution
 
-from models import ProsodyPredictor, TextEncoder, StyleEncoder
+from models import ProsodyPredictor, TextEncoder, StyleEncoder, length_regulator
+from Modules.utils import remove_weight_norms, bind_style, style_tensor, BoundStyle
+from style_cache import StyleCache
+from checkpoint import load_modules
+import quantize as q8
+import thread_tuning as tt
+from pipeline import pipelined
+from instrumentation import NULL_TRACE
 
 class Preprocess:
+    def __init__(self):
+        self.to_mel = torchaudio.transforms.MelSpectrogram(n_mels=80, n_fft=2048, win_length=1200, hop_length=300)
     def __text_normalize(self, text):
         punctuation = ["，", "、", "،", ";", "(", "．", "。", "…", "!", "–", ":", "?"]
         map_to = "."
@@ -45,11 +61,11 @@ class Preprocess:
             merged[-1] = merged[-1]
         return merged
     def wave_preprocess(self, wave):
-        to_mel = torchaudio.transforms.MelSpectrogram(n_mels=80, n_fft=2048, win_length=1200, hop_length=300)
+        #[samples] => [1, n_mels, frames], a batch of equal length windows [N, samples] => [N, 1, n_mels, frames]
         mean, std = -4, 4
         wave_tensor = torch.from_numpy(wave).float()
-        mel_tensor = to_mel(wave_tensor)
-        mel_tensor = (torch.log(1e-5 + mel_tensor.unsqueeze(0)) - mean) / std
+        mel_tensor = self.to_mel(wave_tensor)
+        mel_tensor = (torch.log(1e-5 + mel_tensor.unsqueeze(-3)) - mean) / std
         return mel_tensor
     def text_preprocess(self, text, n_merge=12):
         text_norm = self.__text_normalize(text).split(".")#split by sentences.
@@ -108,11 +124,10 @@ class Diffusion(torch.nn.Module):
             clamp=False
         )
         
-        self.__load_models(models_path)
+        self.__load_models(models_path, config)
 
-    def __load_models(self, models_path):
-        params_whole = torch.load(models_path, map_location='cpu')
-        state_dict = params_whole['net']['diffusion']
+    def __load_models(self, models_path, config):
+        state_dict = load_modules(models_path, ['diffusion'], config)['diffusion']
 
         try:
             self.model_diffusion.load_state_dict(state_dict)
@@ -137,11 +152,15 @@ class Diffusion(torch.nn.Module):
     
 #For inference only
 class StyleTTS2(torch.nn.Module):
-    def __init__(self, config_path, models_path, config_diff_path=False, models_diff_path=False):
+    def __init__(self, config_path, models_path, config_diff_path=False, models_diff_path=False, style_cache=None, quantize=None, thread_profile=None, instrumentation=None):
         super().__init__()
         self.register_buffer("get_device", torch.empty(0))
         self.preprocess = Preprocess()
-        self.ref_s = None
+        self.compiled = None
+        self.compile_cache = None
+        self.executor = None #runs the async API, created on first use
+        self.style_cache = StyleCache(style_cache) if isinstance(style_cache, str) else style_cache #dir path or StyleCache
+        self.instrumentation = instrumentation #instrumentation.Instrumentation, per stage timing records, None is off
         config = yaml.safe_load(open(config_path, "r", encoding="utf-8"))
         
         try:
@@ -168,6 +187,7 @@ class StyleTTS2(torch.nn.Module):
         self.cleaner = TextCleaner(symbol_dict, debug=False)
 
         assert args.decoder.type in ['istftnet', 'hifigan', 'vocos'], 'Decoder type unknown'
+        self.decoder_type = args.decoder.type
     
         if args.decoder.type == "istftnet":
             from Modules.istftnet import Decoder
@@ -197,11 +217,24 @@ class StyleTTS2(torch.nn.Module):
         self.predictor           = ProsodyPredictor(style_dim=args.style_dim, d_hid=args.hidden_dim, nlayers=args.n_layer, max_dur=args.max_dur, dropout=args.dropout)
         self.text_encoder        = TextEncoder(channels=args.hidden_dim, kernel_size=5, depth=args.n_layer, n_symbols=args.n_token)
         self.style_encoder       = StyleEncoder(dim_in=args.dim_in, style_dim=args.style_dim, max_conv_dim=args.hidden_dim)# acoustic style encoder
-        self.__load_models(models_path)
+        self.__load_models(models_path, config)
 
         self.diffusion = False
         if config_diff_path and models_diff_path:
             self.diffusion = Diffusion(config_diff_path, models_diff_path)
+
+        if quantize: #call quantize() on an fp32 model instead to get the parity report
+            self.quantize(quantize, report=False)
+
+        #threads and worker count from tune_threads(): True applies Configs/thread_profile.yaml, a path that file, None keeps torch's defaults
+        self.thread_profile = tt.use_profile(thread_profile, self.decoder_type)
+
+    def __getstate__(self):
+        #Pickled for spawned WorkerPool workers: the style cache, instrumentation and executor hold locks or threads,
+        #compiled graphs don't cross processes. The worker gets its own copy without them, this model is left as is
+        state = self.__dict__.copy()
+        state.update(style_cache=None, instrumentation=None, executor=None, compiled=None, compile_cache=None)
+        return state
     
     def __recursive_munch(self, d):
         if isinstance(d, dict):
@@ -227,13 +260,15 @@ class StyleTTS2(torch.nn.Module):
 
         return result
         
-    def __load_models(self, models_path):
+    def __load_models(self, models_path, config):
         module_params = []
         model = {'decoder':self.decoder, 'predictor':self.predictor, 'text_encoder':self.text_encoder, 'style_encoder':self.style_encoder}
 
-        params_whole = torch.load(models_path, map_location='cpu')
-        params = params_whole['net']
-        params = {key: value for key, value in params.items() if key in model.keys()}
+        #Identifies the checkpoint in style cache keys without hashing the whole file
+        stat = os.stat(models_path)
+        self.model_id = hashlib.sha256(f"{os.path.basename(models_path)}|{stat.st_size}|{stat.st_mtime_ns}".encode('utf-8')).hexdigest()[:16]
+
+        params = load_modules(models_path, model.keys(), config)
 
         for key in model:
             try:
@@ -274,24 +309,19 @@ class StyleTTS2(torch.nn.Module):
         with torch.no_grad():
             if split_dur>0 and len(audio)/sr>=4: #Only effective if audio length is >= 4s
                 #This option will split the ref audio to multiple parts, calculate styles and average them
-                count = 0
-                ref_s = None
                 jump = sr*split_dur
                 total_len = len(audio)
-                
-                #Need to init before the loop
-                mel_tensor = self.preprocess.wave_preprocess(audio[0:jump]).to(device)
-                ref_s = self.style_encoder(mel_tensor.unsqueeze(1))
-                count += 1
-                for i in range(jump, total_len, jump):
-                    if i+jump >= total_len:
-                        left_dur = (total_len-i)/sr
-                        if left_dur >= 1: #Still count if left over dur is >= 1s
-                            mel_tensor = self.preprocess.wave_preprocess(audio[i:total_len]).to(device)
-                            ref_s += self.style_encoder(mel_tensor.unsqueeze(1))
-                            count += 1
-                        continue
-                    mel_tensor = self.preprocess.wave_preprocess(audio[i:i+jump]).to(device)
+                n_windows = total_len // jump
+
+                #All full windows go through one mel transform and one style encoder pass
+                windows = audio[:n_windows*jump].reshape(n_windows, jump)
+                mel_tensor = self.preprocess.wave_preprocess(windows).to(device)
+                ref_s = self.style_encoder(mel_tensor).sum(axis=0, keepdim=True)
+                count = n_windows
+
+                left_dur = (total_len - n_windows*jump)/sr
+                if left_dur >= 1: #Still count if left over dur is >= 1s
+                    mel_tensor = self.preprocess.wave_preprocess(audio[n_windows*jump:]).to(device)
                     ref_s += self.style_encoder(mel_tensor.unsqueeze(1))
                     count += 1
                 ref_s /= count
@@ -301,108 +331,628 @@ class StyleTTS2(torch.nn.Module):
 
         return ref_s
         
-    def __inference(self, phonem, ref_s, steps=5, embedding_scale=1, speed=1, prev_d_mean=0, t=0.1):
-        device = self.get_device.device
-        speed = min(max(speed, 0.0001), 2) #speed range [0, 2]
-        
+    def __tokenize(self, phonem):
         phonem = ' '.join(word_tokenize(phonem))
         tokens = self.cleaner(phonem)
         tokens.insert(0, 0)
         tokens.append(0)
-        tokens = torch.LongTensor(tokens).to(device).unsqueeze(0)
+        return tokens
+
+    def __smooth_duration(self, duration, speed, prev_d_mean, t):
+        device = duration.device
+        if prev_d_mean != 0:#Stabilize speaking speed between splits
+            dur_stats = torch.empty(duration.shape).normal_(mean=prev_d_mean, std=duration.std()).to(device)
+        else:
+            dur_stats = torch.empty(duration.shape).normal_(mean=duration.mean(), std=duration.std()).to(device)
+        duration = duration*(1-t) + dur_stats*t
+        duration[:,1:-2] = self.__replace_outliers_zscore(duration[:,1:-2]) #Normalize outlier
+        
+        duration /= speed
+        return duration
+
+    def __front(self, phonem, ref_s, steps=5, embedding_scale=1, speed=1, prev_d_mean=0, t=0.1, trace=NULL_TRACE):
+        #Everything before the decoder: tokenization, text encoder, durations, alignment and F0/N prediction.
+        #trace: instrumentation Trace the stage times go to
+        device = self.get_device.device
+        speed = min(max(speed, 0.0001), 2) #speed range [0, 2]
+        
+        with trace.stage('tokenize'):
+            tokens = self.__tokenize(phonem)
+            tokens = torch.LongTensor(tokens).to(device).unsqueeze(0)
         
         with torch.no_grad():
             input_lengths = torch.LongTensor([tokens.shape[-1]]).to(device)
             text_mask = self.preprocess.length_to_mask(input_lengths).to(device)
 
             # encode
-            t_en = self.text_encoder(tokens, input_lengths, text_mask)
+            with trace.stage('text_encoder'):
+                t_en = self.text_encoder(tokens, input_lengths, text_mask)
 
             if self.diffusion:
-                s = self.diffusion.get_styles(t_en, ref_s.to(device), steps=steps, embedding_scale=embedding_scale)
+                with trace.stage('diffusion'):
+                    s = self.diffusion.get_styles(t_en, style_tensor(ref_s).to(device), steps=steps, embedding_scale=embedding_scale)
             else:
                 s = ref_s.to(device)
         
             # cal alignment
-            d = self.predictor.text_encoder(t_en, s, input_lengths, text_mask)
-            x, _ = self.predictor.lstm(d)
-            duration = self.predictor.duration_proj(x)
-            duration = torch.sigmoid(duration).sum(axis=-1)
+            with trace.stage('duration'):
+                d = self.predictor.text_encoder(t_en, s, input_lengths, text_mask)
+                x, _ = self.predictor.lstm(d)
+                duration = self.predictor.duration_proj(x)
+                duration = torch.sigmoid(duration).sum(axis=-1)
+                duration = self.__smooth_duration(duration, speed, prev_d_mean, t)
+
+                pred_dur = torch.round(duration.squeeze()).clamp(min=1).unsqueeze(0)
+
+            # encode prosody
+            with trace.stage('alignment'):
+                en, _ = length_regulator(d.transpose(-1, -2), pred_dur)
+                asr, _ = length_regulator(t_en, pred_dur)
+            with trace.stage('F0Ntrain'):
+                F0_pred, N_pred = self.predictor.F0Ntrain(en, s)
+        trace.row(tokens.shape[-1], asr.shape[-1])
 
-            if prev_d_mean != 0:#Stabilize speaking speed between splits
-                dur_stats = torch.empty(duration.shape).normal_(mean=prev_d_mean, std=duration.std()).to(device)
+        return (asr, F0_pred, N_pred, s), duration.mean()
+
+    def __decode(self, asr, F0_pred, N_pred, s, trim=0, trace=NULL_TRACE):
+        #trim: samples left out at either end, the decoder skips the steps only they need
+        with torch.no_grad(), trace.stage('decoder'):
+            out = self.decoder(asr, F0_pred, N_pred, s, trim=trim)
+        with trace.stage('trim'):
+            return out.squeeze().cpu().numpy()
+
+    def __decode_stream(self, asr, F0_pred, N_pred, s, chunk, incremental=False, trim=0, trace=NULL_TRACE):
+        #__decode in generator windows of `chunk` steps (1/80 s), yields the waveform piece by piece.
+        #incremental: blocks with the generator state carried between them instead of overlapping windows
+        with torch.no_grad():
+            if incremental:
+                pieces = self.decoder.incremental(asr, F0_pred, N_pred, s, block=chunk, trim=trim)
             else:
-                dur_stats = torch.empty(duration.shape).normal_(mean=duration.mean(), std=duration.std()).to(device)
-            duration = duration*(1-t) + dur_stats*t
-            duration[:,1:-2] = self.__replace_outliers_zscore(duration[:,1:-2]) #Normalize outlier
-            
-            duration /= speed
+                pieces = self.decoder.stream(asr, F0_pred, N_pred, s, chunk=chunk, trim=trim)
+            while True:
+                with trace.stage('decoder'): #the consumer's time between pieces isn't the decoder's
+                    piece = next(pieces, None)
+                if piece is None:
+                    break
+                with trace.stage('trim'):
+                    piece = piece.reshape(-1).cpu().numpy()
+                yield piece
+
+    def __inference(self, phonem, ref_s, steps=5, embedding_scale=1, speed=1, prev_d_mean=0, t=0.1, trace=NULL_TRACE):
+        features, d_mean = self.__front(phonem, ref_s, steps=steps, embedding_scale=embedding_scale, speed=speed, prev_d_mean=prev_d_mean, t=t, trace=trace)
+        return self.__decode(*features, trace=trace), d_mean
 
-            pred_dur = torch.round(duration.squeeze()).clamp(min=1)
-            pred_aln_trg = torch.zeros(input_lengths, int(pred_dur.sum().data))
-            c_frame = 0
-            for i in range(pred_aln_trg.size(0)):
-                pred_aln_trg[i, c_frame:c_frame + int(pred_dur[i].data)] = 1
-                c_frame += int(pred_dur[i].data)
-            alignment = pred_aln_trg.unsqueeze(0).to(device)
+    def __front_batch(self, phonems, ref_s, steps=5, embedding_scale=1, speed=1, prev_d_mean=0, t=0.1, trace=NULL_TRACE):
+        #Same as __front, but all sentences are padded into one batch
+        #ref_s, speed and prev_d_mean are either one request's values, chained sentence by sentence, or lists with one entry per row
+        device = self.get_device.device
+        batch_size = len(phonems)
+        rows = isinstance(ref_s, (list, tuple))
+        speeds = speed if rows else [speed]*batch_size
+        speeds = [min(max(v, 0.0001), 2) for v in speeds] #speed range [0, 2]
+
+        with trace.stage('tokenize'):
+            tokens = [torch.LongTensor(self.__tokenize(phonem)) for phonem in phonems]
+            input_lengths = torch.LongTensor([len(token) for token in tokens]).to(device)
+            tokens = torch.nn.utils.rnn.pad_sequence(tokens, batch_first=True).to(device)
+            token_bucket = self.__bucket(tokens.shape[-1], 'tokens')
+            if token_bucket is not None:
+                tokens = torch.nn.functional.pad(tokens, (0, token_bucket - tokens.shape[-1]))
+        text_modules = self.__modules(token_bucket is not None)
+
+        with torch.no_grad():
+            text_mask = self.preprocess.length_to_mask(input_lengths).to(device)
+            text_mask = torch.nn.functional.pad(text_mask, (0, tokens.shape[-1] - text_mask.shape[-1]), value=True)
+
+            # encode
+            with trace.stage('text_encoder'):
+                t_en = text_modules['text_encoder'](tokens, input_lengths, text_mask)
+
+            if rows:
+                ref_s = torch.cat([style_tensor(ref).to(device) for ref in ref_s]) #one voice per row
+            if self.diffusion:
+                #Sampled sentence by sentence, the sampler's transformer would attend to the padded tokens
+                with trace.stage('diffusion'):
+                    s = torch.cat([self.diffusion.get_styles(t_en[i:i+1, :, :input_lengths[i]], style_tensor(ref_s)[i:i+1] if rows else style_tensor(ref_s).to(device), 
+                                                             steps=steps, embedding_scale=embedding_scale)
+                                   for i in range(batch_size)])
+            else:
+                s = ref_s.to(device) #one voice broadcasts over the batch
+            if self.compiled is not None:
+                s = style_tensor(s) #compiled graphs take the plain style, fc(s) is traced into them
+
+            # cal alignment
+            with trace.stage('duration'):
+                d = text_modules['duration_encoder'](t_en, s, input_lengths, text_mask)
+                x = torch.nn.utils.rnn.pack_padded_sequence(d, input_lengths.cpu(), batch_first=True, enforce_sorted=False)
+                x, _ = self.predictor.lstm(x)
+                x, _ = torch.nn.utils.rnn.pad_packed_sequence(x, batch_first=True, total_length=d.shape[1])
+                duration = self.predictor.duration_proj(x)
+                duration = torch.sigmoid(duration).sum(axis=-1)
+
+                #Smooth sentence by sentence so the speed stabilization chains exactly like the unbatched path
+                pred_dur = []
+                d_means = []
+                for i in range(batch_size):
+                    duration_i = self.__smooth_duration(duration[i:i+1, :input_lengths[i]], speeds[i], prev_d_mean[i] if rows else prev_d_mean, t)
+                    d_means.append(duration_i.mean())
+                    if not rows: prev_d_mean = d_means[-1]
+                    pred_dur.append(torch.round(duration_i.squeeze(0)).clamp(min=1))
+                pred_dur = torch.nn.utils.rnn.pad_sequence(pred_dur, batch_first=True) #padded tokens get 0 frames
+                pred_dur = torch.nn.functional.pad(pred_dur, (0, d.shape[1] - pred_dur.shape[1]))
+            frame_bucket = self.__bucket(int(pred_dur.sum(-1).max()), 'frames')
+            frame_modules = self.__modules(frame_bucket is not None)
 
             # encode prosody
-            en = (d.transpose(-1, -2) @ alignment)
-            F0_pred, N_pred = self.predictor.F0Ntrain(en, s)
-            asr = (t_en @ pred_aln_trg.unsqueeze(0).to(device))
+            with trace.stage('alignment'):
+                en, frame_lengths = length_regulator(d.transpose(-1, -2), pred_dur, frame_bucket)
+                asr, _ = length_regulator(t_en, pred_dur, frame_bucket)
+            lengths = frame_lengths if bool((frame_lengths < en.shape[-1]).any()) else None #nothing padded, keep the plain InstanceNorm
+            with trace.stage('F0Ntrain'):
+                F0_pred, N_pred = frame_modules['F0Ntrain'](en, s, lengths)
+        for i in range(batch_size):
+            trace.row(input_lengths[i], frame_lengths[i])
 
-            out = self.decoder(asr, F0_pred, N_pred, s)
-        
-        return out.squeeze().cpu().numpy(), duration.mean()
+        features = {
+            'asr': asr,
+            'F0_pred': F0_pred,
+            'N_pred': N_pred,
+            's': s,
+            'lengths': lengths,
+            'frame_lengths': frame_lengths,
+            'shape': (token_bucket, frame_bucket, batch_size),
+        }
+        return features, (d_means if rows else prev_d_mean)
+
+    def __decode_batch(self, features, trim=0, trace=NULL_TRACE):
+        token_bucket, frame_bucket, batch_size = features['shape']
+        asr, frame_lengths = features['asr'], features['frame_lengths']
+        decoder_trim = trim if frame_bucket is None else 0 #compiled graphs are traced per bucket, they decode it whole and are cut after
+        with torch.no_grad(), trace.stage('decoder'):
+            out = self.__modules(frame_bucket is not None)['decoder'](asr, features['F0_pred'], features['N_pred'], features['s'], features['lengths'], trim=decoder_trim)
+
+        if self.compile_cache is not None and features['shape'] not in self.compiled_shapes:
+            self.compiled_shapes.add(features['shape'])
+            self.save_compile_cache() #a restarted worker loads these kernels instead of compiling again
+
+        #Split the padded batch back into one waveform per sentence, the decoder already left out decoder_trim samples at either end
+        with trace.stage('trim'):
+            hop = (out.shape[-1] + 2*decoder_trim) // asr.shape[-1]
+            out = out.squeeze(1).cpu().numpy()
+            start = trim - decoder_trim
+            return [out[i, start:max(int(frame_lengths[i])*hop - trim - decoder_trim, start)] for i in range(batch_size)]
+
+    def __split_batch(self, features):
+        #One unpadded (asr, F0_pred, N_pred, s) per sentence of __front_batch's features
+        asr, F0_pred, N_pred, s = features['asr'], features['F0_pred'], features['N_pred'], features['s']
+        sentences = []
+        for i in range(features['shape'][2]):
+            n = int(features['frame_lengths'][i])
+            s_i = s if isinstance(s, BoundStyle) or s.shape[0] == 1 else s[i:i+1]
+            sentences.append((asr[i:i+1, :, :n], F0_pred[i:i+1, :2*n], N_pred[i:i+1, :2*n], s_i))
+        return sentences
+
+    def __inference_batch(self, phonems, ref_s, steps=5, embedding_scale=1, speed=1, prev_d_mean=0, t=0.1, trim=0, trace=NULL_TRACE):
+        #Same as __inference, but all sentences are padded into one batch and synthesized in a single forward pass
+        features, d_means = self.__front_batch(phonems, ref_s, steps=steps, embedding_scale=embedding_scale, speed=speed, prev_d_mean=prev_d_mean, t=t, trace=trace)
+        return self.__decode_batch(features, trim, trace), d_means
+
+    def inference_batch(self, phonems, styles, speeds, prev_d_means, steps=5, embedding_scale=1, t=0.1, trim=0):
+        #Independent sentences, e.g. from different requests, in one forward pass: row i has its own style, speed and
+        #speed stabilization state. Returns the waveforms without their first and last `trim` samples and each row's
+        #duration mean for its next sentence. Instrumented as one 'batch' request
+        request = self.__request('batch')
+        trace = request.trace()
+        wavs, d_means = self.__inference_batch(phonems, list(styles), steps=steps, embedding_scale=embedding_scale, 
+                                               speed=list(speeds), prev_d_mean=list(prev_d_means), t=t, trim=trim, trace=trace)
+        request.audio()
+        for i, wav in enumerate(wavs):
+            request.sentence(trace, i, len(wav), i)
+        request.finish()
+        return wavs, d_means
+
+    def __request(self, kind='generate'):
+        #RequestTrace of a new request, a no-op one while instrumentation is off
+        return NULL_TRACE if self.instrumentation is None else self.instrumentation.request(kind)
+
+    def count_tokens(self, phonem):
+        return len(self.__tokenize(phonem))
     
+    def __bucket(self, size, kind):
+        #Smallest bucket that fits, None runs eager
+        if self.compiled is None:
+            return None
+        for bucket in self.buckets[kind]:
+            if size <= bucket:
+                return bucket
+        return None
+
+    def __modules(self, compiled):
+        if compiled:
+            return self.compiled
+        return {'text_encoder': self.text_encoder, 'duration_encoder': self.predictor.text_encoder,
+                'F0Ntrain': self.predictor.F0Ntrain, 'decoder': self.decoder}
+
     def get_styles(self, speaker, denoise=0.3, avg_style=True, load_styles=False):
-        if not load_styles:
-            if avg_style:   split_dur = 3
-            else:           split_dur = 0
-            self.ref_s = self.__compute_style(speaker['path'], denoise=denoise, split_dur=split_dur)
+        #Returns the voice as a value, pass it to generate(). Safe to call from several threads on one model, nothing is kept on it.
+        #load_styles: path of a voice saved by save_styles(), loaded instead of computed from the speaker's audio
+        if load_styles is True:
+            raise Exception("load_styles takes the path of a voice saved by save_styles(), the model no longer keeps the last voice")
+        if load_styles:
+            return self.load_styles(load_styles, speaker)
+        if avg_style:   split_dur = 3
+        else:           split_dur = 0
+        if self.style_cache is not None:
+            key = self.style_cache.key(speaker['path'], denoise, avg_style, self.model_id)
+            ref_s = self.style_cache.get(key)
+            if ref_s is None:
+                ref_s = self.__compute_style(speaker['path'], denoise=denoise, split_dur=split_dur)
+                self.style_cache.put(key, ref_s, path=speaker['path'], denoise=denoise, avg_style=avg_style, model=self.model_id)
+            ref_s = ref_s.to(self.get_device.device)
         else:
-            if self.ref_s is None:
-                raise Exception("Have to compute or load the styles first!")
+            ref_s = self.__compute_style(speaker['path'], denoise=denoise, split_dur=split_dur)
         style = {
-            'style': self.ref_s,
+            'style': ref_s,
             'path': speaker['path'],
             'speed': speaker['speed'],
         }
         return style
     
-    def save_styles(self, save_dir):
-        if self.ref_s is not None:
-            torch.save(self.ref_s, save_dir)
-            print("Saved styles!")
-        else:
-            raise Exception("Have to compute the styles before saving it.")
+    def bind_voice(self, style):
+        #Precompute every AdaIN / AdaLayerNorm gamma and beta of a voice once instead of per sentence
+        bound = dict(style)
+        ref_s = style_tensor(style['style']).to(self.get_device.device)
+        bound['style'] = bind_style(ref_s, [self.predictor, self.decoder])
+        return bound
 
-    def load_styles(self, save_dir):
-        try:
-            self.ref_s = torch.load(save_dir)
-            print("Loaded styles!")
-        except Exception as e:
-            print(e)
+    def save_styles(self, save_dir, style):
+        #style: a voice from get_styles()
+        torch.save(style_tensor(style['style']), save_dir)
+        print("Saved styles!")
+
+    def load_styles(self, save_dir, speaker=None):
+        #Returns the voice like get_styles() does, speaker ({'path', 'speed'}) fills in its path and speed
+        return {
+            'style': torch.load(save_dir).to(self.get_device.device),
+            'path': None if speaker is None else speaker['path'],
+            'speed': 1 if speaker is None else speaker['speed'],
+        }
+
+    def freeze_for_inference(self, verify=True, tolerance=1e-3):
+        #Folds weight norm into plain weights and turns off dropout, the model can't be trained afterwards
+        device = self.get_device.device
+        model = {'decoder':self.decoder, 'predictor':self.predictor, 'text_encoder':self.text_encoder, 'style_encoder':self.style_encoder}
+        probe_text = "ðɪs ɪz ɐ ʃˈɔːɹt sˈɛntəns juːzd tə tʃˈɛk ðə fɹˈoʊzən mˈɑːdəl."
+
+        def probe():
+            torch.manual_seed(0) #same style, same diffusion and SineGen noise on both runs
+            with torch.no_grad():
+                ref_s = self.style_encoder(torch.randn(1, 1, 80, 240).to(device))
+            start = time.perf_counter()
+            wav, _ = self.__inference(probe_text, ref_s)
+            return wav, time.perf_counter() - start
+
+        self.eval()
+        if verify:
+            probe() #warm up
+            wav_before, time_before = probe()
+
+        removed = 0
+        for key in model:
+            removed += remove_weight_norms(model[key])
+            for m in model[key].modules():
+                if isinstance(m, torch.nn.LSTM): m.flatten_parameters()
+        self.requires_grad_(False)
+        print("Removed weight norm from", removed, "layers")
+
+        report = {'weight_norms': removed}
+        if verify:
+            wav_after, time_after = probe()
+            if wav_before.shape != wav_after.shape:
+                print(f"WARNING: Frozen model output length changed: {wav_before.shape[-1]} -> {wav_after.shape[-1]} samples")
+                max_diff = float('inf')
+            else:
+                max_diff = float(np.abs(wav_before - wav_after).max())
+                if max_diff > tolerance:
+                    print(f"WARNING: Frozen model differs by {max_diff:.2e} (tolerance {tolerance:.0e})")
+            report.update({'max_diff': max_diff, 'time_before': time_before, 'time_after': time_after, 'speedup': time_before/time_after})
+            print(f"Parity: max diff {max_diff:.2e} | {time_before*1000:.1f}ms -> {time_after*1000:.1f}ms ({time_before/time_after:.2f}x)")
+        return report
+
+    def quantize(self, mode='dynamic', voices=None, report=True):
+        #int8 CPU inference. 'dynamic': LSTM and Linear weights, 'static': also the wide decoder convs, calibrated on the voices (Demo/Audio by default)
+        assert mode in ['dynamic', 'static'], 'Quantize mode unknown'
+        assert self.get_device.device.type == 'cpu', 'int8 quantization only runs on CPU'
+        self.freeze_for_inference(verify=False) #convs can't be converted while weight norm is attached
+
+        voices = q8.demo_voices() if voices is None else voices
+        styles = []
+        if report or mode == 'static':
+            styles = [self.__compute_style(path, denoise=0, split_dur=3) for path in voices]
+
+        def synthesize():
+            wavs = []
+            start = time.perf_counter()
+            for ref_s in styles:
+                torch.manual_seed(0)
+                wav, _ = self.__inference(q8.CALIBRATION_TEXT, ref_s)
+                wavs.append(wav)
+            return wavs, time.perf_counter() - start
+
+        if report:
+            wavs_fp32, time_fp32 = synthesize()
+        if mode == 'static':
+            wrapped = q8.prepare_static_convs(self.decoder)
+            synthesize() #calibration
+            q8.convert_static_convs(self.decoder)
+            print("Calibrated", wrapped, "decoder convs on", len(styles), "voices")
+        q8.quantize_dynamic_modules([self.text_encoder, self.predictor, self.decoder])
+        print("Quantized:", mode)
+
+        if not report:
+            return None
+        wavs_int8, time_int8 = synthesize()
+        distances = {}
+        for path, wav, ref in zip(voices, wavs_int8, wavs_fp32):
+            distances[os.path.basename(path)] = q8.mel_distance(self.preprocess, wav, ref)
+            print(f"{os.path.basename(path)}: mel distance {distances[os.path.basename(path)]:.4f} | {len(ref)} -> {len(wav)} samples")
+        mean_distance = sum(distances.values())/len(distances)
+        print(f"Mean mel distance {mean_distance:.4f} | {time_fp32:.2f}s -> {time_int8:.2f}s ({time_fp32/time_int8:.2f}x)")
+        return {
+            'mode': mode,
+            'mel_distance': distances,
+            'mean_mel_distance': mean_distance,
+            'length_changed': sum(len(wav) != len(ref) for wav, ref in zip(wavs_int8, wavs_fp32)),
+            'time_fp32': time_fp32,
+            'time_int8': time_int8,
+        }
+
+    def tune_threads(self, voices=None, texts=None, thread_counts=None, worker_counts=None, repeats=2, objective='throughput', save_path=tt.PROFILE_PATH):
+        #Benchmarks __inference for every (workers, threads) pair that fits the cores and saves the best one as this decoder type's
+        #profile, which StyleTTS2, WorkerPool and the server load at startup. Workers are forked, Linux and macOS only
+        assert self.get_device.device.type == 'cpu', 'Thread tuning is for CPU inference'
+        self.freeze_for_inference(verify=False) #same weights as a WorkerPool serves
+
+        voices = q8.demo_voices()[:2] if voices is None else voices
+        texts = tt.BENCH_TEXTS if texts is None else texts
+        styles = [self.__compute_style(path, denoise=0, split_dur=3) for path in voices]
+        jobs = [(text, ref_s) for ref_s in styles for text in texts] * repeats
+
+        def synthesize(text, ref_s):
+            torch.manual_seed(0)
+            wav, _ = self.__inference(text, ref_s)
+            return len(wav) / 24000
+
+        cpus = os.cpu_count() or 1
+        results = []
+        for workers, threads in tt.thread_grid(cpus, thread_counts, worker_counts):
+            result = tt.benchmark(synthesize, jobs, workers, threads)
+            results.append(result)
+            print(f"{workers} workers x {threads} threads: {result['throughput']:.2f}x realtime | {result['latency']*1000:.0f}ms per sentence")
+
+        best = tt.recommend(results, objective)
+        profile = {'cpus': cpus, 'workers': best['workers'], 'threads': best['threads'], 'interop_threads': 1, 'objective': objective, 'results': results}
+        print(f"Best {objective} on {self.decoder_type}: {best['workers']} workers x {best['threads']} threads")
+        if save_path:
+            tt.save_profile(save_path, self.decoder_type, profile)
+            print("Saved thread profile:", save_path)
+        self.thread_profile = profile
+        return profile
+
+    def compile_for_inference(self, cache_dir=None, token_buckets=(64, 128, 256, 512), frame_buckets=(256, 512, 1024, 2048, 4096), warmup=False, batch_sizes=(1,)):
+        #Opt-in torch.compile path. Inputs are padded to the smallest bucket that fits so every module compiles once per bucket,
+        #longer inputs run eager. Compiled kernels are saved in cache_dir and reloaded here, a restarted worker doesn't compile again
+        #warmup: compile every bucket for every batch size in batch_sizes now instead of on first use, e.g. range(1, max_batch + 1)
+        #for a BatchScheduler. Other batch sizes still compile on first use
+        self.freeze_for_inference(verify=False) #the weight norm recomputation would be traced into every graph
+        self.compile_cache = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.compile_cache = os.path.join(cache_dir, 'compile_cache.bin')
+            if os.path.isfile(self.compile_cache):
+                with open(self.compile_cache, 'rb') as f:
+                    torch.compiler.load_cache_artifacts(f.read())
+                print("Loaded compile cache:", self.compile_cache)
 
-    def generate(self, phonem, style, steps=5, embedding_scale=1, n_merge=16, stabilize=True):
+        self.buckets = {'tokens': sorted(token_buckets), 'frames': sorted(frame_buckets)}
+        self.compiled_shapes = set()
+        batch_sizes = sorted(set(batch_sizes))
+        #one graph per bucket, batch size and style shape, the eager fallback kicks in past the limit
+        graphs = 2 * max(len(batch_sizes), 4) * (len(token_buckets) + len(frame_buckets))
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, graphs)
+        self.compiled = {
+            'text_encoder':     torch.compile(self.text_encoder, dynamic=False),
+            'duration_encoder': torch.compile(self.predictor.text_encoder, dynamic=False),
+            'F0Ntrain':         torch.compile(self.predictor.F0Ntrain, dynamic=False),
+            'decoder':          torch.compile(self.decoder, dynamic=False),
+        }
+
+        if warmup:
+            self.__warmup_compiled(batch_sizes)
+            self.compiled_shapes = {(t, f, b) for t in self.buckets['tokens'] for f in self.buckets['frames'] for b in batch_sizes}
+            if self.compile_cache is not None:
+                self.save_compile_cache()
+
+    def __warmup_compiled(self, batch_sizes):
+        #Same calls as __front_batch and __decode_batch: padded rows with their lengths, trim=0. The style is one row per
+        #sentence (scheduler batches) or one broadcast voice (generate with batch_size > 1). A bucket filled exactly runs
+        #F0Ntrain and the decoder without lengths, that graph is still compiled on first use
+        device = self.get_device.device
+        style_dim = self.style_encoder.unshared.out_features
+        d = self.predictor.lstm.input_size
+        hidden = self.text_encoder.embedding.embedding_dim
+        with torch.no_grad():
+            for batch_size in batch_sizes:
+                for style_rows in sorted({1, batch_size}):
+                    s = torch.zeros(style_rows, style_dim).to(device)
+                    for n_tokens in self.buckets['tokens']:
+                        print(f"Compiling batch {batch_size} x {style_rows} styles, {n_tokens} tokens")
+                        tokens = torch.zeros(batch_size, n_tokens, dtype=torch.long).to(device)
+                        lengths = torch.full((batch_size,), n_tokens - 1, dtype=torch.long).to(device)
+                        text_mask = self.preprocess.length_to_mask(lengths).to(device)
+                        text_mask = torch.nn.functional.pad(text_mask, (0, 1), value=True)
+                        t_en = self.compiled['text_encoder'](tokens, lengths, text_mask)
+                        self.compiled['duration_encoder'](t_en, s, lengths, text_mask)
+                    for n_frames in self.buckets['frames']:
+                        print(f"Compiling batch {batch_size} x {style_rows} styles, {n_frames} frames")
+                        lengths = torch.full((batch_size,), n_frames - 1, dtype=torch.long).to(device)
+                        F0_pred, N_pred = self.compiled['F0Ntrain'](torch.zeros(batch_size, d, n_frames).to(device), s, lengths)
+                        self.compiled['decoder'](torch.zeros(batch_size, hidden, n_frames).to(device), F0_pred, N_pred, s, lengths, trim=0)
+
+    def save_compile_cache(self):
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is not None:
+            with open(self.compile_cache + '.tmp', 'wb') as f:
+                f.write(artifacts[0])
+            os.replace(self.compile_cache + '.tmp', self.compile_cache)
+
+    def generate_stream(self, phonem, style, steps=5, embedding_scale=1, n_merge=16, stabilize=True, batch_size=1, pipeline=0, decoder_chunk=0, incremental=False, trace=None):
+        #Yield every sentence as soon as it is decoded, offset is the sample position inside the concatenated speech.
+        #pipeline: how many sentences the front-end (encoders, durations, F0/N) may run ahead of the decoder on a thread of its own, 0 runs them back to back.
+        #Both threads draw from torch's global RNG (front-end: speed stabilization and diffusion noise, decoder: SineGen's noise) in an order
+        #that depends on timing, so a seeded run is only reproducible with pipeline=0. Except vocos without diffusion, its decoder draws
+        #nothing and the output matches pipeline=0, and stabilize=False without diffusion, the durations then match for every decoder
+        #decoder_chunk: run the generator on windows of that many steps (1/80 s), a sentence then comes in several chunks with the same
+        #index and the decoder's peak memory no longer grows with the sentence length. Close to the whole-sentence decode, not bit-exact
+        #incremental: feed the generator decoder_chunk steps at a time with its state carried over (hifigan and istftnet), the first
+        #audio of a sentence then only waits for one block instead of the whole sentence and no step is decoded twice
+        #trace: instrumentation RequestTrace to record into, finished by the caller (generate passes its own). Made and finished here when None
         if stabilize:   smooth_value=0.2
         else:           smooth_value=0    
         
-        list_wav        = []
-        prev_d_mean     = 0
+        offset          = 0
+        if not self.diffusion and not isinstance(style['style'], BoundStyle):
+            style = self.bind_voice(style) #the style is the same for every sentence without diffusion
 
+        assert not incremental or (decoder_chunk and hasattr(self.decoder, 'incremental')), 'Incremental decoding needs a decoder_chunk and a hifigan or istftnet decoder'
         print("Generating Audio...")
         text_norm = self.preprocess.text_preprocess(phonem, n_merge=n_merge)
-        for sentence in text_norm:
-            wav, prev_d_mean = self.__inference(sentence, style['style'], 
-                                                steps=steps, 
-                                                embedding_scale=embedding_scale,
-                                                speed=style['speed'], 
-                                                prev_d_mean=prev_d_mean, 
-                                                t=smooth_value)
-            wav = wav[4000:-4000] #Remove weird pulse and silent tokens
-            list_wav.append(wav)
+        batched = batch_size > 1 or self.compiled is not None #Synthesize several sentences per forward pass, the compiled path is bucketed
+
+        request = self.__request() if trace is None else trace
+
+        def front_end():
+            prev_d_mean = 0
+            for i in range(0, len(text_norm), batch_size):
+                front = self.__front_batch if batched else self.__front
+                job_trace = request.trace()
+                features, prev_d_mean = front(text_norm[i:i+batch_size] if batched else text_norm[i], style['style'], 
+                                              steps=steps, 
+                                              embedding_scale=embedding_scale,
+                                              speed=style['speed'], 
+                                              prev_d_mean=prev_d_mean, 
+                                              t=smooth_value,
+                                              trace=job_trace)
+                yield i, features, job_trace
+
+        trim = 4000 #Remove weird pulse and silent tokens, the decoder skips the steps only they need
+
+        def decode(job):
+            i, features, job_trace = job
+            if decoder_chunk: #decoded lazily, window by window, while the chunks are consumed
+                return i, job_trace, [self.__decode_stream(*sentence, decoder_chunk, incremental, trim, job_trace) for sentence in (self.__split_batch(features) if batched else [features])]
+            wavs = self.__decode_batch(features, trim, job_trace) if batched else [self.__decode(*features, trim=trim, trace=job_trace)]
+            return i, job_trace, [[wav] for wav in wavs]
+
+        complete = False
+        try:
+            decoded = pipelined(front_end(), [decode], depth=pipeline) if pipeline else map(decode, front_end())
+            for i, job_trace, sentences in decoded:
+                for j, pieces in enumerate(sentences):
+                    samples = 0
+                    for wav in pieces:
+                        request.audio()
+                        yield {
+                            'wav': wav,
+                            'index': i + j,
+                            'offset': offset,
+                            'duration': len(wav) / 24000,
+                        }
+                        offset += len(wav)
+                        samples += len(wav)
+                    request.sentence(job_trace, j, samples, i + j)
+            complete = True
+        finally:
+            if trace is None:
+                request.finish(complete)
+
+    def generate(self, phonem, style, steps=5, embedding_scale=1, n_merge=16, stabilize=True, batch_size=1, pipeline=0, decoder_chunk=0, incremental=False):
+        request = self.__request()
+        list_wav = [chunk['wav'] for chunk in self.generate_stream(phonem, style, 
+                                                                   steps=steps, 
+                                                                   embedding_scale=embedding_scale, 
+                                                                   n_merge=n_merge, 
+                                                                   stabilize=stabilize, 
+                                                                   batch_size=batch_size,
+                                                                   pipeline=pipeline,
+                                                                   decoder_chunk=decoder_chunk,
+                                                                   incremental=incremental,
+                                                                   trace=request)]
+        
+        with request.stage('concat'):
+            final_wav = np.concatenate(list_wav)
+            final_wav = np.concatenate([np.zeros([4000]), final_wav, np.zeros([4000])], axis=0) # add padding
+        request.finish()
+        return final_wav
+
+    def __executor(self):
+        #One request per thread profile worker at a time, the model is safe to share between them
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=(self.thread_profile or {}).get('workers', 1), thread_name_prefix='styletts2')
+        return self.executor
+
+    async def __call(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.__executor(), functools.partial(fn, *args, **kwargs))
+
+    async def aget_styles(self, speaker, denoise=0.3, avg_style=True):
+        #get_styles() off the event loop, librosa.load and the style cache's torch.load included
+        return await self.__call(self.get_styles, speaker, denoise=denoise, avg_style=avg_style)
+
+    async def aload_styles(self, save_dir, speaker):
+        return await self.__call(self.load_styles, save_dir, speaker)
+
+    async def astream(self, phonem, style, steps=5, embedding_scale=1, n_merge=16, stabilize=True, batch_size=1, pipeline=0, decoder_chunk=0, incremental=False, trace=None):
+        #generate_stream() as an async iterator. Every chunk is decoded in the executor, cancelling the task or closing
+        #the iterator stops the synthesis after the sentence (or batch, or decoder_chunk window) being decoded, the rest is never computed
+        stream = self.generate_stream(phonem, style, steps=steps, embedding_scale=embedding_scale, n_merge=n_merge,
+                                      stabilize=stabilize, batch_size=batch_size, pipeline=pipeline, decoder_chunk=decoder_chunk,
+                                      incremental=incremental, trace=trace)
+        lock = threading.Lock() #a generator can't be closed while a worker thread is inside it
+        cancelled = threading.Event()
+
+        def step():
+            with lock:
+                return None if cancelled.is_set() else next(stream, None)
+
+        def close():
+            with lock:
+                stream.close()
+
+        try:
+            while True:
+                chunk = await self.__call(step)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            cancelled.set()
+            self.__executor().submit(close) #not awaited, a cancelled task returns right away
+
+    async def agenerate(self, phonem, style, steps=5, embedding_scale=1, n_merge=16, stabilize=True, batch_size=1, pipeline=0, decoder_chunk=0, incremental=False):
+        request = self.__request()
+        list_wav = [chunk['wav'] async for chunk in self.astream(phonem, style, 
+                                                                 steps=steps, 
+                                                                 embedding_scale=embedding_scale, 
+                                                                 n_merge=n_merge, 
+                                                                 stabilize=stabilize, 
+                                                                 batch_size=batch_size,
+                                                                 pipeline=pipeline,
+                                                                 decoder_chunk=decoder_chunk,
+                                                                 incremental=incremental,
+                                                                 trace=request)]
         
-        final_wav = np.concatenate(list_wav)
-        final_wav = np.concatenate([np.zeros([4000]), final_wav, np.zeros([4000])], axis=0) # add padding
-        return final_wav
\ No newline at end of file
+        with request.stage('concat'):
+            final_wav = np.concatenate(list_wav)
+            final_wav = np.concatenate([np.zeros([4000]), final_wav, np.zeros([4000])], axis=0) # add padding
+        request.finish()
+        return final_wav
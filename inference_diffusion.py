@@ -1,4 +1,5 @@
 import re
+import time
 import yaml
 from munch import Munch
 import numpy as np
@@ -15,9 +16,14 @@ from Modules.diffusion.modules import Transformer1d, StyleTransformer1d
 from Modules.diffusion.diffusion import AudioDiffusionConditional
 from Modules.diffusion.sampler import DiffusionSampler, ADPM2Sampler, KarrasSchedule, KDiffusion, LogNormalDistribution
 
-from models import ProsodyPredictor, TextEncoder, StyleEncoder
+from models import ProsodyPredictor, TextEncoder, StyleEncoder, length_regulator
+from checkpoint import load_modules
+from Modules.utils import remove_weight_norms
+import thread_tuning as tt
 
 class Preprocess:
+    def __init__(self):
+        self.to_mel = torchaudio.transforms.MelSpectrogram(n_mels=80, n_fft=2048, win_length=1200, hop_length=300)
     def __text_normalize(self, text):
         punctuation = ["，", "、", "،", ";", "(", "．", "。", "…", "!", "–", ":", "?"]
         map_to = "."
@@ -45,11 +51,11 @@ class Preprocess:
             merged[-1] = merged[-1]
         return merged
     def wave_preprocess(self, wave):
-        to_mel = torchaudio.transforms.MelSpectrogram(n_mels=80, n_fft=2048, win_length=1200, hop_length=300)
+        #[samples] => [1, n_mels, frames], a batch of equal length windows [N, samples] => [N, 1, n_mels, frames]
         mean, std = -4, 4
         wave_tensor = torch.from_numpy(wave).float()
-        mel_tensor = to_mel(wave_tensor)
-        mel_tensor = (torch.log(1e-5 + mel_tensor.unsqueeze(0)) - mean) / std
+        mel_tensor = self.to_mel(wave_tensor)
+        mel_tensor = (torch.log(1e-5 + mel_tensor.unsqueeze(-3)) - mean) / std
         return mel_tensor
     def text_preprocess(self, text, n_merge=12):
         text_norm = re.sub(r",", ".", text) #map from , to .
@@ -65,11 +71,10 @@ class Preprocess:
     
 #For inference only
 class StyleTTS2(torch.nn.Module):
-    def __init__(self, config_path, models_path):
+    def __init__(self, config_path, models_path, thread_profile=None):
         super().__init__()
         self.register_buffer("get_device", torch.empty(0))
         self.preprocess = Preprocess()
-        self.ref_s = None
         config = yaml.safe_load(open(config_path, "r", encoding="utf-8"))
         
         try:
@@ -96,6 +101,7 @@ class StyleTTS2(torch.nn.Module):
         self.cleaner = TextCleaner(symbol_dict, debug=False)
 
         assert args.decoder.type in ['istftnet', 'hifigan', 'vocos'], 'Decoder type unknown'
+        self.decoder_type = args.decoder.type
     
         if args.decoder.type == "istftnet":
             from Modules.istftnet import Decoder
@@ -157,9 +163,10 @@ class StyleTTS2(torch.nn.Module):
             sigma_schedule=KarrasSchedule(sigma_min=0.0001, sigma_max=3.0, rho=9.0), # empirical parameters
             clamp=False
         )
-        self.cache_s_prosody = None
-        self.__load_models(models_path)
-        
+        self.__load_models(models_path, config)
+
+        #threads from thread_tuning.py: True applies Configs/thread_profile.yaml, a path that file, None keeps torch's defaults
+        self.thread_profile = tt.use_profile(thread_profile, self.decoder_type)
     
     def __recursive_munch(self, d):
         if isinstance(d, dict):
@@ -185,13 +192,11 @@ class StyleTTS2(torch.nn.Module):
 
         return result
         
-    def __load_models(self, models_path):
+    def __load_models(self, models_path, config):
         module_params = []
         model = {'decoder':self.decoder, 'predictor':self.predictor, 'text_encoder':self.text_encoder, 'style_encoder':self.style_encoder, 'diffusion':self.diffusion_model}
 
-        params_whole = torch.load(models_path, map_location='cpu')
-        params = params_whole['net']
-        params = {key: value for key, value in params.items() if key in model.keys()}
+        params = load_modules(models_path, model.keys(), config)
 
         for key in model:
             try:
@@ -232,24 +237,19 @@ class StyleTTS2(torch.nn.Module):
         with torch.no_grad():
             if split_dur>0 and len(audio)/sr>=4: #Only effective if audio length is >= 4s
                 #This option will split the ref audio to multiple parts, calculate styles and average them
-                count = 0
-                ref_s = None
                 jump = sr*split_dur
                 total_len = len(audio)
-                
-                #Need to init before the loop
-                mel_tensor = self.preprocess.wave_preprocess(audio[0:jump]).to(device)
-                ref_s = self.style_encoder(mel_tensor.unsqueeze(1))
-                count += 1
-                for i in range(jump, total_len, jump):
-                    if i+jump >= total_len:
-                        left_dur = (total_len-i)/sr
-                        if left_dur >= 1: #Still count if left over dur is >= 1s
-                            mel_tensor = self.preprocess.wave_preprocess(audio[i:total_len]).to(device)
-                            ref_s += self.style_encoder(mel_tensor.unsqueeze(1))
-                            count += 1
-                        continue
-                    mel_tensor = self.preprocess.wave_preprocess(audio[i:i+jump]).to(device)
+                n_windows = total_len // jump
+
+                #All full windows go through one mel transform and one style encoder pass
+                windows = audio[:n_windows*jump].reshape(n_windows, jump)
+                mel_tensor = self.preprocess.wave_preprocess(windows).to(device)
+                ref_s = self.style_encoder(mel_tensor).sum(axis=0, keepdim=True)
+                count = n_windows
+
+                left_dur = (total_len - n_windows*jump)/sr
+                if left_dur >= 1: #Still count if left over dur is >= 1s
+                    mel_tensor = self.preprocess.wave_preprocess(audio[n_windows*jump:]).to(device)
                     ref_s += self.style_encoder(mel_tensor.unsqueeze(1))
                     count += 1
                 ref_s /= count
@@ -259,14 +259,20 @@ class StyleTTS2(torch.nn.Module):
 
         return ref_s
         
-    def __inference(self, phonem, ref_s, steps=5, embedding_scale=1, speed=1, prev_d_mean=0, t=0.1, use_diffusion=True):
-        device = self.get_device.device
-        speed = min(max(speed, 0.0001), 2) #speed range [0, 2]
-        
+    def __tokenize(self, phonem):
         phonem = ' '.join(word_tokenize(phonem))
         tokens = self.cleaner(phonem)
         tokens.insert(0, 0)
         tokens.append(0)
+        return tokens
+
+    def __inference(self, phonem, ref_s, steps=5, embedding_scale=1, speed=1, prev_d_mean=0, t=0.1, use_diffusion=True, prosody=None, trim=0):
+        #prosody: the previous sentence's sampled prosody style, blended into this one. Returned updated with the waveform
+        #trim: samples left out at either end, the decoder skips the steps only they need
+        device = self.get_device.device
+        speed = min(max(speed, 0.0001), 2) #speed range [0, 2]
+        
+        tokens = self.__tokenize(phonem)
         tokens = torch.LongTensor(tokens).to(device).unsqueeze(0)
         
         with torch.no_grad():
@@ -278,7 +284,7 @@ class StyleTTS2(torch.nn.Module):
             s = ref_s.to(device)
 
             if use_diffusion:
-                if self.cache_s_prosody is None:
+                if prosody is None:
                     s_prosody = self.sampler(  noise = torch.randn_like(s).unsqueeze(1).to(device), 
                                     embedding=t_en.transpose(-1, -2),
                                     embedding_scale=embedding_scale,
@@ -286,7 +292,7 @@ class StyleTTS2(torch.nn.Module):
                                     embedding_mask_proba=0.1,
                                     num_steps=steps).squeeze(1)
                     s = s*0.9 + s_prosody*0.1
-                    self.cache_s_prosody = s_prosody
+                    prosody = s_prosody
                 else:
                     s_prosody = self.sampler(  noise = torch.randn_like(s).unsqueeze(1).to(device), 
                                     embedding=t_en.transpose(-1, -2),
@@ -294,9 +300,9 @@ class StyleTTS2(torch.nn.Module):
                                     # features=s,
                                     embedding_mask_proba=0.1,
                                     num_steps=steps).squeeze(1)
-                    s_prosody = s_prosody*0.6 + self.cache_s_prosody*0.4
+                    s_prosody = s_prosody*0.6 + prosody*0.4
                     s         = s*0.9 + s_prosody*0.1
-                    self.cache_s_prosody = s_prosody
+                    prosody = s_prosody
             else:
                 s_prosody = ref_s.to(device)
         
@@ -315,71 +321,205 @@ class StyleTTS2(torch.nn.Module):
             
             duration /= speed
 
-            pred_dur = torch.round(duration.squeeze()).clamp(min=1)
-            pred_aln_trg = torch.zeros(input_lengths, int(pred_dur.sum().data))
-            c_frame = 0
-            for i in range(pred_aln_trg.size(0)):
-                pred_aln_trg[i, c_frame:c_frame + int(pred_dur[i].data)] = 1
-                c_frame += int(pred_dur[i].data)
-            alignment = pred_aln_trg.unsqueeze(0).to(device)
+            pred_dur = torch.round(duration.squeeze()).clamp(min=1).unsqueeze(0)
 
             # encode prosody
-            en = (d.transpose(-1, -2) @ alignment)
+            en, _ = length_regulator(d.transpose(-1, -2), pred_dur)
             F0_pred, N_pred = self.predictor.F0Ntrain(en, s_prosody)
-            asr = (t_en @ pred_aln_trg.unsqueeze(0).to(device))
+            asr, _ = length_regulator(t_en, pred_dur)
 
-            out = self.decoder(asr, F0_pred, N_pred, s)
+            out = self.decoder(asr, F0_pred, N_pred, s, trim=trim)
         
-        return out.squeeze().cpu().numpy(), duration.mean()
+        return out.squeeze().cpu().numpy(), duration.mean(), prosody
+    
+    def __inference_batch(self, phonems, ref_s, steps=5, embedding_scale=1, speed=1, use_diffusion=True, prosody=None, trim=0):
+        #Same as __inference, but all sentences are padded into one batch and synthesized in a single forward pass
+        device = self.get_device.device
+        speed = min(max(speed, 0.0001), 2) #speed range [0, 2]
+        batch_size = len(phonems)
+
+        tokens = [torch.LongTensor(self.__tokenize(phonem)) for phonem in phonems]
+        input_lengths = torch.LongTensor([len(token) for token in tokens]).to(device)
+        tokens = torch.nn.utils.rnn.pad_sequence(tokens, batch_first=True).to(device)
+
+        with torch.no_grad():
+            text_mask = self.preprocess.length_to_mask(input_lengths).to(device)
+
+            # encode
+            t_en = self.text_encoder(tokens, input_lengths, text_mask)
+            s = ref_s.to(device).expand(batch_size, -1)
+
+            if use_diffusion:
+                #Sampled sentence by sentence, the sampler's transformer would attend to the padded tokens
+                s_prosody = [self.sampler(  noise = torch.randn_like(s[i:i+1]).unsqueeze(1).to(device), 
+                                embedding=t_en[i:i+1, :, :input_lengths[i]].transpose(-1, -2),
+                                embedding_scale=embedding_scale,
+                                # features=s,
+                                embedding_mask_proba=0.1,
+                                num_steps=steps).squeeze(1) for i in range(batch_size)]
+                #Blend each sentence with the previous one in order, like the unbatched path
+                for i in range(batch_size):
+                    if prosody is not None:
+                        s_prosody[i] = s_prosody[i]*0.6 + prosody*0.4
+                    prosody = s_prosody[i]
+                s_prosody = torch.cat(s_prosody)
+                s         = s*0.9 + s_prosody*0.1
+            else:
+                s_prosody = s
+
+            # cal alignment
+            d = self.predictor.text_encoder(t_en, s_prosody, input_lengths, text_mask)
+            x = torch.nn.utils.rnn.pack_padded_sequence(d, input_lengths.cpu(), batch_first=True, enforce_sorted=False)
+            x, _ = self.predictor.lstm(x)
+            x, _ = torch.nn.utils.rnn.pad_packed_sequence(x, batch_first=True, total_length=d.shape[1])
+            duration = self.predictor.duration_proj(x)
+            duration = torch.sigmoid(duration).sum(axis=-1)
+
+            pred_dur = []
+            for i in range(batch_size):
+                duration_i = duration[i:i+1, :input_lengths[i]]
+                duration_i[:,1:-2] = self.__replace_outliers_zscore(duration_i[:,1:-2]) #Normalize outlier
+                duration_i = duration_i / speed
+                pred_dur.append(torch.round(duration_i.squeeze(0)).clamp(min=1))
+            pred_dur = torch.nn.utils.rnn.pad_sequence(pred_dur, batch_first=True) #padded tokens get 0 frames
+
+            # encode prosody
+            en, frame_lengths = length_regulator(d.transpose(-1, -2), pred_dur)
+            lengths = frame_lengths if bool((frame_lengths < en.shape[-1]).any()) else None #nothing padded, keep the plain InstanceNorm
+            F0_pred, N_pred = self.predictor.F0Ntrain(en, s_prosody, lengths)
+            asr, _ = length_regulator(t_en, pred_dur)
+
+            out = self.decoder(asr, F0_pred, N_pred, s, lengths, trim=trim)
+
+        #Split the padded batch back into one waveform per sentence, the decoder already left out `trim` samples at either end
+        hop = (out.shape[-1] + 2*trim) // asr.shape[-1]
+        out = out.squeeze(1).cpu().numpy()
+        wavs = [out[i, :max(int(frame_lengths[i])*hop - 2*trim, 0)] for i in range(batch_size)]
+        return wavs, prosody
     
     def get_styles(self, speaker, denoise=0.3, avg_style=True, load_styles=False):
-        if not load_styles:
-            if avg_style:   split_dur = 3
-            else:           split_dur = 0
-            self.ref_s = self.__compute_style(speaker['path'], denoise=denoise, split_dur=split_dur)
-        else:
-            if self.ref_s is None:
-                raise Exception("Have to compute or load the styles first!")
+        #Returns the voice as a value, pass it to generate(). Safe to call from several threads on one model, nothing is kept on it.
+        #load_styles: path of a voice saved by save_styles(), loaded instead of computed from the speaker's audio
+        if load_styles is True:
+            raise Exception("load_styles takes the path of a voice saved by save_styles(), the model no longer keeps the last voice")
+        if load_styles:
+            return self.load_styles(load_styles, speaker)
+        if avg_style:   split_dur = 3
+        else:           split_dur = 0
+        ref_s = self.__compute_style(speaker['path'], denoise=denoise, split_dur=split_dur)
         style = {
-            'style': self.ref_s,
+            'style': ref_s,
             'path': speaker['path'],
             'speed': speaker['speed'],
         }
         return style
     
-    def save_styles(self, save_dir):
-        if self.ref_s is not None:
-            torch.save(self.ref_s, save_dir)
-            print("Saved styles!")
-        else:
-            raise Exception("Have to compute the styles before saving it.")
+    def save_styles(self, save_dir, style):
+        #style: a voice from get_styles()
+        torch.save(style['style'], save_dir)
+        print("Saved styles!")
 
-    def load_styles(self, save_dir):
-        try:
-            self.ref_s = torch.load(save_dir)
-            print("Loaded styles!")
-        except Exception as e:
-            print(e)
+    def load_styles(self, save_dir, speaker=None):
+        #Returns the voice like get_styles() does, speaker ({'path', 'speed'}) fills in its path and speed
+        return {
+            'style': torch.load(save_dir).to(self.get_device.device),
+            'path': None if speaker is None else speaker['path'],
+            'speed': 1 if speaker is None else speaker['speed'],
+        }
+
+    def freeze_for_inference(self, verify=True, tolerance=1e-3):
+        #Folds weight norm into plain weights and turns off dropout, the model can't be trained afterwards
+        device = self.get_device.device
+        model = {'decoder':self.decoder, 'predictor':self.predictor, 'text_encoder':self.text_encoder, 'style_encoder':self.style_encoder, 'diffusion':self.diffusion_model}
+        probe_text = "ðɪs ɪz ɐ ʃˈɔːɹt sˈɛntəns juːzd tə tʃˈɛk ðə fɹˈoʊzən mˈɑːdəl."
 
-    def generate(self, phonem, style, steps=5, embedding_scale=1, n_merge=16, stabilize=True, use_diffusion=True):
+        def probe():
+            torch.manual_seed(0) #same style, same diffusion and SineGen noise on both runs
+            with torch.no_grad():
+                ref_s = self.style_encoder(torch.randn(1, 1, 80, 240).to(device))
+            start = time.perf_counter()
+            wav, _, _ = self.__inference(probe_text, ref_s, use_diffusion=False)
+            return wav, time.perf_counter() - start
+
+        self.eval()
+        if verify:
+            probe() #warm up
+            wav_before, time_before = probe()
+
+        removed = 0
+        for key in model:
+            removed += remove_weight_norms(model[key])
+            for m in model[key].modules():
+                if isinstance(m, torch.nn.LSTM): m.flatten_parameters()
+        self.requires_grad_(False)
+        print("Removed weight norm from", removed, "layers")
+
+        report = {'weight_norms': removed}
+        if verify:
+            wav_after, time_after = probe()
+            if wav_before.shape != wav_after.shape:
+                print(f"WARNING: Frozen model output length changed: {wav_before.shape[-1]} -> {wav_after.shape[-1]} samples")
+                max_diff = float('inf')
+            else:
+                max_diff = float(np.abs(wav_before - wav_after).max())
+                if max_diff > tolerance:
+                    print(f"WARNING: Frozen model differs by {max_diff:.2e} (tolerance {tolerance:.0e})")
+            report.update({'max_diff': max_diff, 'time_before': time_before, 'time_after': time_after, 'speedup': time_before/time_after})
+            print(f"Parity: max diff {max_diff:.2e} | {time_before*1000:.1f}ms -> {time_after*1000:.1f}ms ({time_before/time_after:.2f}x)")
+        return report
+
+    def generate_stream(self, phonem, style, steps=5, embedding_scale=1, n_merge=16, stabilize=True, use_diffusion=True, batch_size=1, prosody=None):
+        #Yield every sentence as soon as it is decoded, offset is the sample position inside the concatenated speech.
+        #Every chunk carries the prosody state after it, pass the last one as prosody to continue in the next call
         if stabilize:   smooth_value=0.2
         else:           smooth_value=0    
         
-        list_wav        = []
         prev_d_mean     = 0
+        offset          = 0
+
+        trim = 6000 #Remove weird pulse and silent tokens, the decoder skips the steps only they need
 
         print("Generating Audio...")
         text_norm = self.preprocess.text_preprocess(phonem, n_merge=n_merge)
-        for sentence in text_norm:
-            wav, prev_d_mean = self.__inference(sentence, style['style'], 
-                                                steps=steps, 
-                                                embedding_scale=embedding_scale,
-                                                speed=style['speed'], 
-                                                prev_d_mean=prev_d_mean, 
-                                                t=smooth_value,
-                                                use_diffusion=use_diffusion)
-            wav = wav[6000:-6000] #Remove weird pulse and silent tokens
-            list_wav.append(wav)
+        for i in range(0, len(text_norm), batch_size):
+            if batch_size > 1: #Synthesize several sentences per forward pass
+                wavs, prosody = self.__inference_batch(text_norm[i:i+batch_size], style['style'], 
+                                                       steps=steps, 
+                                                       embedding_scale=embedding_scale,
+                                                       speed=style['speed'], 
+                                                       use_diffusion=use_diffusion,
+                                                       prosody=prosody,
+                                                       trim=trim)
+            else:
+                wav, prev_d_mean, prosody = self.__inference(text_norm[i], style['style'], 
+                                                             steps=steps, 
+                                                             embedding_scale=embedding_scale,
+                                                             speed=style['speed'], 
+                                                             prev_d_mean=prev_d_mean, 
+                                                             t=smooth_value,
+                                                             use_diffusion=use_diffusion,
+                                                             prosody=prosody,
+                                                             trim=trim)
+                wavs = [wav]
+            for j, wav in enumerate(wavs):
+                yield {
+                    'wav': wav,
+                    'index': i + j,
+                    'offset': offset,
+                    'duration': len(wav) / 24000,
+                    'prosody': prosody,
+                }
+                offset += len(wav)
+
+    def generate(self, phonem, style, steps=5, embedding_scale=1, n_merge=16, stabilize=True, use_diffusion=True, batch_size=1, prosody=None):
+        list_wav = [chunk['wav'] for chunk in self.generate_stream(phonem, style, 
+                                                                   steps=steps, 
+                                                                   embedding_scale=embedding_scale, 
+                                                                   n_merge=n_merge, 
+                                                                   stabilize=stabilize, 
+                                                                   use_diffusion=use_diffusion, 
+                                                                   batch_size=batch_size,
+                                                                   prosody=prosody)]
         
         final_wav = np.concatenate(list_wav)
         final_wav = np.concatenate([np.zeros([4000]), final_wav, np.zeros([4000])], axis=0) # add padding
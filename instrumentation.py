@@ -0,0 +1,307 @@
+import os
+import sys
+import json
+import time
+import bisect
+import logging
+import itertools
+import threading
+from collections import defaultdict, deque
+import torch
+
+SAMPLE_RATE = 24000
+STAGES = ['tokenize', 'text_encoder', 'diffusion', 'duration', 'alignment', 'F0Ntrain', 'decoder', 'trim', 'concat']
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) #seconds, also used for real-time factors
+
+class _NullTrace:
+    #Stands in for every trace while instrumentation is off: no clock reads, nothing recorded
+    def stage(self, name):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def trace(self):
+        return self
+
+    def row(self, tokens, frames):
+        pass
+
+    def audio(self):
+        pass
+
+    def sentence(self, trace, row, samples, index):
+        pass
+
+    def finish(self, complete=True):
+        pass
+
+NULL_TRACE = _NullTrace()
+
+class _Stage:
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.trace.synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.synchronize()
+        self.trace.stages[self.name] += time.perf_counter() - self.start
+        return False
+
+class Trace:
+    #Stage seconds of one forward pass, a sentence or a batch of them, and each of its sentences' token and frame counts
+    def __init__(self, sync=False):
+        self.stages = defaultdict(float)
+        self.rows = []
+        self.sync = sync
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def synchronize(self):
+        if self.sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def row(self, tokens, frames):
+        self.rows.append({'tokens': int(tokens), 'frames': int(frames)})
+
+class RequestTrace:
+    """
+    Records of one request (a generate_stream call or an inference_batch batch), handed to the instrumentation's sinks.
+
+    - 'sentence' when a sentence's audio is complete: tokens, predicted frames, audio seconds, stage seconds and
+      rtf = stage seconds / audio seconds. The sentences of a batch share its stage seconds equally
+    - 'request' from finish(): the same totals over its sentences plus request level stages (concat), wall seconds from
+      the call to finish(), first_audio seconds until the first audio and rtf = wall / audio. A stream's wall time
+      includes the time its consumer held it, complete is False when it was closed early
+    """
+    def __init__(self, instrumentation, kind='generate'):
+        self.instrumentation = instrumentation
+        self.id = next(instrumentation.ids)
+        self.kind = kind
+        self.start = time.perf_counter()
+        self.own = Trace(instrumentation.sync) #request level stages
+        self.traces = [self.own]
+        self.sentences = []
+        self.first_audio = None
+        self.finished = False
+
+    def trace(self):
+        #Trace of the next forward pass of this request
+        trace = Trace(self.instrumentation.sync)
+        self.traces.append(trace)
+        return trace
+
+    def stage(self, name):
+        return self.own.stage(name)
+
+    def audio(self):
+        #Called whenever audio is ready to go out
+        if self.first_audio is None:
+            self.first_audio = time.perf_counter() - self.start
+
+    def sentence(self, trace, row, samples, index):
+        stages = {name: seconds / max(len(trace.rows), 1) for name, seconds in trace.stages.items()}
+        audio = samples / SAMPLE_RATE
+        seconds = sum(stages.values())
+        record = {'type': 'sentence', 'kind': self.kind, 'request': self.id, 'index': index, 'batch': len(trace.rows), **trace.rows[row],
+                  'audio': audio, 'seconds': seconds, 'rtf': seconds / audio if audio else None, 'stages': stages}
+        self.sentences.append(record)
+        self.instrumentation.emit(record)
+
+    def finish(self, complete=True):
+        if self.finished:
+            return
+        self.finished = True
+        wall = time.perf_counter() - self.start
+        stages = defaultdict(float)
+        for trace in self.traces:
+            for name, seconds in trace.stages.items():
+                stages[name] += seconds
+        audio = sum(x['audio'] for x in self.sentences)
+        self.instrumentation.emit({
+            'type': 'request',
+            'kind': self.kind,
+            'request': self.id,
+            'complete': complete,
+            'sentences': len(self.sentences),
+            'tokens': sum(x['tokens'] for x in self.sentences),
+            'frames': sum(x['frames'] for x in self.sentences),
+            'audio': audio,
+            'seconds': sum(stages.values()),
+            'wall': wall,
+            'first_audio': self.first_audio,
+            'rtf': wall / audio if audio else None,
+            'stages': dict(stages),
+        })
+
+class Instrumentation:
+    """
+    Optional per stage timing of StyleTTS2 inference, off unless the model is given one: StyleTTS2(..., instrumentation=...)
+
+    - stages: tokenize, text_encoder, diffusion, duration, alignment, F0Ntrain, decoder, trim (crop and copy to numpy)
+      and concat (generate's concatenation)
+    - a stage costs two time.perf_counter() reads. On GPU the kernels run asynchronously, sync=True waits for them at
+      every stage boundary: exact stage times, slower inference
+    - records are plain dicts passed to every sink's emit(record): LogSink, HistogramRegistry or anything with an emit
+      method. Sinks are called from the inference threads
+    - in WorkerPool workers the sinks are per worker copies: LogSink lines still arrive, a HistogramRegistry only sees
+      the records of its own worker
+    """
+    def __init__(self, sinks=(), sync=False):
+        self.sinks = list(sinks)
+        self.sync = sync
+        self.ids = itertools.count()
+
+    def request(self, kind='generate'):
+        return RequestTrace(self, kind)
+
+    def emit(self, record):
+        for sink in self.sinks:
+            sink.emit(record)
+
+    @property
+    def registry(self):
+        return next((sink for sink in self.sinks if isinstance(sink, HistogramRegistry)), None)
+
+class LogSink:
+    #One json line per record: to stdout, a file path (appended), an open stream or a logging.Logger at INFO
+    def __init__(self, target=None, types=('sentence', 'request')):
+        self.types = set(types)
+        self.logger = target if isinstance(target, logging.Logger) else None
+        self.file = open(target, 'a', encoding='utf-8') if isinstance(target, str) else target
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        if record['type'] not in self.types:
+            return
+        line = json.dumps(record)
+        if self.logger is not None:
+            self.logger.info(line)
+            return
+        with self.lock:
+            file = self.file or sys.stdout
+            file.write(line + '\n')
+            file.flush()
+
+    def close(self):
+        if self.logger is None and self.file not in (None, sys.stdout, sys.stderr):
+            self.file.close()
+
+class Histogram:
+    #Cumulative bucket counts, sum and count for Prometheus, plus the last `window` values for exact quantiles
+    def __init__(self, buckets, window):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) #last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q):
+        if not self.recent:
+            return None
+        values = sorted(self.recent)
+        return values[min(int(q * len(values)), len(values) - 1)]
+
+class HistogramRegistry:
+    """
+    In-process histograms of the records, for p50/p99 per stage and a Prometheus text exposition.
+
+    - styletts2_sentence_stage_seconds{kind, stage}, styletts2_sentence_seconds{kind}, styletts2_sentence_rtf{kind}
+    - styletts2_request_stage_seconds{kind, stage}, styletts2_request_seconds{kind} (wall), styletts2_request_rtf{kind},
+      styletts2_request_first_audio_seconds{kind}
+    - counters: styletts2_sentences_total, styletts2_requests_total, styletts2_tokens_total, styletts2_frames_total,
+      styletts2_audio_seconds_total, all by kind
+    - quantiles come from the last `window` observations of each series, the buckets cover everything since start
+    """
+    def __init__(self, buckets=BUCKETS, window=1024):
+        self.buckets = tuple(sorted(buckets))
+        self.window = window
+        self.histograms = {} #(name, labels) -> Histogram
+        self.counters = defaultdict(float) #(name, labels) -> value
+        self.lock = threading.Lock()
+
+    def __observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(self.buckets, self.window)
+        self.histograms[key].observe(value)
+
+    def emit(self, record):
+        kind, prefix = record['kind'], 'styletts2_' + record['type']
+        with self.lock:
+            for stage, seconds in record['stages'].items():
+                self.__observe(prefix + '_stage_seconds', seconds, kind=kind, stage=stage)
+            self.__observe(prefix + '_seconds', record['seconds'] if record['type'] == 'sentence' else record['wall'], kind=kind)
+            if record['rtf'] is not None:
+                self.__observe(prefix + '_rtf', record['rtf'], kind=kind)
+            if record['type'] == 'sentence':
+                self.counters[('styletts2_sentences_total', (('kind', kind),))] += 1
+                self.counters[('styletts2_tokens_total', (('kind', kind),))] += record['tokens']
+                self.counters[('styletts2_frames_total', (('kind', kind),))] += record['frames']
+                self.counters[('styletts2_audio_seconds_total', (('kind', kind),))] += record['audio']
+            else:
+                self.counters[('styletts2_requests_total', (('kind', kind),))] += 1
+                if record['first_audio'] is not None:
+                    self.__observe('styletts2_request_first_audio_seconds', record['first_audio'], kind=kind)
+
+    def quantile(self, name, q, **labels):
+        with self.lock:
+            histogram = self.histograms.get((name, tuple(sorted(labels.items()))))
+            return None if histogram is None else histogram.quantile(q)
+
+    def summary(self, quantiles=(0.5, 0.99)):
+        #{name{labels}: {'count', 'mean', 'p50', 'p99'}} of every histogram
+        with self.lock:
+            summary = {}
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                entry = {'count': histogram.count, 'mean': histogram.sum / histogram.count}
+                entry.update({f'p{q*100:g}': histogram.quantile(q) for q in quantiles})
+                summary[name + _labels(labels)] = entry
+            return summary
+
+    def prometheus(self):
+        #Text exposition format 0.0.4, serve it on /metrics or write it for node_exporter's textfile collector
+        with self.lock:
+            lines = []
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (other, labels), histogram in sorted(self.histograms.items()):
+                    if other != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(self.buckets) + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_labels(labels + (("le", str(bound)),))} {cumulative}')
+                    lines.append(f'{name}_sum{_labels(labels)} {histogram.sum!r}')
+                    lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE {name} counter')
+                lines += [f'{name}{_labels(labels)} {value!r}' for (other, labels), value in sorted(self.counters.items()) if other == name]
+            return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(self.prometheus())
+        os.replace(path + '.tmp', path)
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
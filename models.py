@@ -6,6 +6,7 @@ from torch.nn.utils import weight_norm
 from Modules.ASR.models import ASRCNN
 from Modules.JDC.model import JDCNet
 from Modules.discriminators import MultiPeriodDiscriminator, MultiResSpecDiscriminator
+from Modules.utils import style_affine, style_tensor, length_mask, masked_instance_norm
 
 from Modules.diffusion.modules import Transformer1d, StyleTransformer1d
 from Modules.diffusion.diffusion import AudioDiffusionConditional
@@ -273,7 +274,8 @@ class TextEncoder(nn.Module):
         x = nn.utils.rnn.pack_padded_sequence(
             x, input_lengths, batch_first=True, enforce_sorted=False)
 
-        self.lstm.flatten_parameters()
+        if isinstance(self.lstm, nn.LSTM): #dynamic int8 LSTMs keep no flat cuDNN weights
+            self.lstm.flatten_parameters()
         x, _ = self.lstm(x)
         x, _ = nn.utils.rnn.pad_packed_sequence(
             x, batch_first=True)
@@ -293,7 +295,8 @@ class TextEncoder(nn.Module):
         x = x.transpose(1, 2)
         x = self.cnn(x)
         x = x.transpose(1, 2)
-        self.lstm.flatten_parameters()
+        if isinstance(self.lstm, nn.LSTM):
+            self.lstm.flatten_parameters()
         x, _ = self.lstm(x)
         return x
     
@@ -310,11 +313,14 @@ class AdaIN1d(nn.Module):
         self.norm = nn.InstanceNorm1d(num_features, affine=False)
         self.fc = nn.Linear(style_dim, num_features*2)
 
-    def forward(self, x, s):
-        h = self.fc(s)
+    def forward(self, x, s, lengths=None):
+        h = style_affine(self, s)
         h = h.view(h.size(0), h.size(1), 1)
         gamma, beta = torch.chunk(h, chunks=2, dim=1)
-        return (1 + gamma) * self.norm(x) + beta
+        if lengths is None:
+            return (1 + gamma) * self.norm(x) + beta
+        mask = length_mask(x, lengths) #padded batch, statistics and output only cover each row's own steps
+        return ((1 + gamma) * masked_instance_norm(x, mask, self.norm.eps) + beta) * mask
 
 class UpSample1d(nn.Module):
     def __init__(self, layer_type):
@@ -358,18 +364,21 @@ class AdainResBlk1d(nn.Module):
             x = self.conv1x1(x)
         return x
 
-    def _residual(self, x, s):
-        x = self.norm1(x, s)
+    def _residual(self, x, s, lengths=None):
+        x = self.norm1(x, s, lengths)
         x = self.actv(x)
         x = self.pool(x)
+        if lengths is not None and self.upsample_type != 'none':
+            lengths = lengths * 2
+            x = x * length_mask(x, lengths) #the transposed conv bias leaks into the padding
         x = self.conv1(self.dropout(x))
-        x = self.norm2(x, s)
+        x = self.norm2(x, s, lengths)
         x = self.actv(x)
         x = self.conv2(self.dropout(x))
         return x
 
-    def forward(self, x, s):
-        out = self._residual(x, s)
+    def forward(self, x, s, lengths=None):
+        out = self._residual(x, s, lengths)
         out = (out + self._shortcut(x)) / math.sqrt(2)
         return out
     
@@ -385,7 +394,7 @@ class AdaLayerNorm(nn.Module):
         x = x.transpose(-1, -2)
         x = x.transpose(1, -1)
                 
-        h = self.fc(s)
+        h = style_affine(self, s)
         h = h.view(h.size(0), h.size(1), 1)
         gamma, beta = torch.chunk(h, chunks=2, dim=1)
         gamma, beta = gamma.transpose(1, -1), beta.transpose(1, -1)
@@ -433,7 +442,8 @@ class ProsodyPredictor(nn.Module):
         
         m = m.to(text_lengths.device).unsqueeze(1)
         
-        self.lstm.flatten_parameters()
+        if isinstance(self.lstm, nn.LSTM):
+            self.lstm.flatten_parameters()
         x, _ = self.lstm(x)
         x, _ = nn.utils.rnn.pad_packed_sequence(
             x, batch_first=True)
@@ -449,17 +459,31 @@ class ProsodyPredictor(nn.Module):
 
         return duration.squeeze(-1), en
     
-    def F0Ntrain(self, x, s):
-        x, _ = self.shared(x.transpose(-1, -2))
-        
+    def F0Ntrain(self, x, s, lengths=None):
+        if lengths is None:
+            x, _ = self.shared(x.transpose(-1, -2))
+        else: #padded batch, pack so the backward direction starts at each sequence's real end
+            total_length = x.shape[-1]
+            x = nn.utils.rnn.pack_padded_sequence(
+                x.transpose(-1, -2), lengths.cpu(), batch_first=True, enforce_sorted=False)
+            x, _ = self.shared(x)
+            x, _ = nn.utils.rnn.pad_packed_sequence(
+                x, batch_first=True, total_length=total_length)
+
         F0 = x.transpose(-1, -2)
+        block_lengths = lengths
         for block in self.F0:
-            F0 = block(F0, s)
+            F0 = block(F0, s, block_lengths)
+            if block_lengths is not None and block.upsample_type != 'none':
+                block_lengths = block_lengths * 2
         F0 = self.F0_proj(F0)
 
         N = x.transpose(-1, -2)
+        block_lengths = lengths
         for block in self.N:
-            N = block(N, s)
+            N = block(N, s, block_lengths)
+            if block_lengths is not None and block.upsample_type != 'none':
+                block_lengths = block_lengths * 2
         N = self.N_proj(N)
         
         return F0.squeeze(1), N.squeeze(1)
@@ -492,7 +516,7 @@ class DurationEncoder(nn.Module):
         masks = m.to(text_lengths.device)
         
         x = x.permute(2, 0, 1)
-        s = style.expand(x.shape[0], x.shape[1], -1)
+        s = style_tensor(style).expand(x.shape[0], x.shape[1], -1)
         x = torch.cat([x, s], axis=-1)
         x.masked_fill_(masks.unsqueeze(-1).transpose(0, 1), 0.0)
                 
@@ -509,7 +533,8 @@ class DurationEncoder(nn.Module):
                 x = x.transpose(-1, -2)
                 x = nn.utils.rnn.pack_padded_sequence(
                     x, input_lengths, batch_first=True, enforce_sorted=False)
-                block.flatten_parameters()
+                if isinstance(block, nn.LSTM):
+                    block.flatten_parameters()
                 x, _ = block(x)
                 x, _ = nn.utils.rnn.pad_packed_sequence(
                     x, batch_first=True)
@@ -536,6 +561,30 @@ class DurationEncoder(nn.Module):
         mask = torch.gt(mask+1, lengths.unsqueeze(1))
         return mask
 
+def length_regulator(x, duration, n_frames=None):
+    """
+    Repeat every token of x [B, C, T] by its duration [B, T] => ([B, C, F], frame lengths [B]).
+    Same result as x @ alignment without building the dense [T x F] alignment matrix.
+    Padded tokens must have a duration of 0, frames past each sequence's length are zeroed.
+    n_frames pads the output to a fixed number of frames (shape buckets), it must fit the longest sequence.
+    """
+    duration = duration.long()
+    frame_lengths = duration.sum(-1)
+    max_frames = int(frame_lengths.max()) #the only host sync, needed for the output size
+    n_frames = max_frames if n_frames is None else n_frames
+
+    #Mark the first frame of every token, a cumulative sum then gives the token index of each frame
+    starts = torch.cumsum(duration, dim=-1)[:, :-1]
+    marks = torch.zeros(x.shape[0], n_frames + 1, dtype=torch.long, device=x.device)
+    marks.scatter_add_(1, starts, torch.ones_like(starts))
+    index = torch.cumsum(marks[:, :n_frames], dim=-1)
+
+    out = torch.gather(x, 2, index.unsqueeze(1).expand(-1, x.shape[1], -1))
+    if x.shape[0] > 1 or n_frames > max_frames:
+        mask = torch.arange(n_frames, device=x.device).unsqueeze(0) < frame_lengths.unsqueeze(1)
+        out = out * mask.unsqueeze(1)
+    return out, frame_lengths
+
 def build_model(args):
     assert args.decoder.type in ['istftnet', 'hifigan', 'vocos'], 'Decoder type unknown'
     
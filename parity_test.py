@@ -0,0 +1,251 @@
+"""
+Parity checks of the inference shortcuts against the plain forward pass, on random weight modules: no checkpoint needed.
+
+python parity_test.py
+python parity_test.py hifigan vocos
+
+Decoders and encoders are compared module by module, then StyleTTS2 end to end on a random weight checkpoint.
+
+Every check prints its difference and PASS/FAIL, the script exits with 1 when one fails.
+SineGen's noise and random initial phase are zeroed while decoding, both paths would draw different noise otherwise.
+istftnet is compared by log-mel distance: its STFT phase (atan2) flips between +pi and -pi on rounding differences,
+which leaves sparse spikes in the waveform without changing what it sounds like.
+"""
+import os
+import sys
+import asyncio
+import tempfile
+import contextlib
+from unittest import mock
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+from common import DECODERS, load_config, build_modules, write_checkpoint
+from models import length_regulator
+from inference import Preprocess, StyleTTS2
+from style_cache import StyleCache
+from scheduler import BatchScheduler
+from thread_tuning import BENCH_TEXTS
+from quantize import mel_distance
+
+TOLERANCE = 1e-4 #max abs sample difference
+MEL_TOLERANCE = 5e-3 #mean abs log-mel difference, istftnet
+preprocess = Preprocess()
+failed = []
+
+def quiet():
+    #No SineGen noise or random phase
+    return mock.patch.multiple(torch, randn_like=torch.zeros_like, rand=lambda *args, **kwargs: torch.zeros(*args, **kwargs))
+
+def difference(decoder, wav, ref):
+    wav, ref = np.asarray(wav), np.asarray(ref)
+    if wav.shape != ref.shape:
+        return float('inf'), f"length {wav.shape[-1]} != {ref.shape[-1]}"
+    if decoder == 'istftnet':
+        diff = mel_distance(preprocess, wav, ref)
+        return diff / MEL_TOLERANCE, f"mel distance {diff:.2e}"
+    diff = float(np.abs(wav - ref).max()) if wav.size else 0.0
+    return diff / TOLERANCE, f"max diff {diff:.2e}"
+
+def check(name, decoder, wav, ref, length_only=False):
+    ratio, detail = difference(decoder, wav, ref)
+    if length_only and ratio != float('inf'):
+        ratio, detail = 0, f"length {len(wav)}, {detail}"
+    status = 'PASS' if ratio <= 1 else 'FAIL'
+    if status == 'FAIL':
+        failed.append(f"{name} ({decoder})")
+    print(f"{status}  {name:<40} {decoder:<9} {detail}")
+
+def inputs(config, lengths, seed=1):
+    #Random decoder inputs for a batch padded to the longest of `lengths` (frames)
+    torch.manual_seed(seed)
+    n, hidden, style_dim = max(lengths), config['model_params']['hidden_dim'], config['model_params']['style_dim']
+    batch = len(lengths)
+    return (torch.randn(batch, hidden, n), 150 + 20 * torch.randn(batch, 2 * n), torch.randn(batch, 2 * n), torch.randn(batch, style_dim),
+            torch.tensor(lengths))
+
+def row(x, i, n):
+    asr, F0, N, s, _ = x
+    return asr[i:i+1, :, :n], F0[i:i+1, :2*n], N[i:i+1, :2*n], s[i:i+1]
+
+def check_batch(decoder, net, config):
+    #Decoder on a padded batch (length masked norms) against every row decoded alone
+    lengths = [120, 75, 40]
+    x = inputs(config, lengths)
+    with torch.no_grad(), quiet():
+        batch = net(*x).squeeze(1)
+        for i, n in enumerate(lengths):
+            alone = net(*row(x, i, n)).squeeze(1)[0]
+            check(f"batch vs alone, {n} frames", decoder, batch[i, :alone.shape[-1]], alone)
+
+def check_front_batch(nets, config):
+    #Text encoder, duration encoder and F0/N predictor on a padded batch against every row alone
+    text_encoder, predictor = nets['text_encoder'], nets['predictor']
+    lengths = [30, 17, 6]
+    torch.manual_seed(2)
+    batch, n = len(lengths), max(lengths)
+    tokens = torch.randint(1, 100, (batch, n)) * (torch.arange(n) < torch.tensor(lengths).unsqueeze(1))
+    input_lengths = torch.tensor(lengths)
+    mask = preprocess.length_to_mask(input_lengths)
+    s = torch.randn(batch, config['model_params']['style_dim'])
+    frames = [7 * length for length in lengths]
+    en = torch.randn(batch, config['model_params']['hidden_dim'] + config['model_params']['style_dim'], max(frames))
+    with torch.no_grad():
+        t_en = text_encoder(tokens, input_lengths, mask)
+        d = predictor.text_encoder(t_en, s, input_lengths, mask)
+        F0, N = predictor.F0Ntrain(en, s, torch.tensor(frames))
+        for i, (length, f) in enumerate(zip(lengths, frames)):
+            t_en_i = text_encoder(tokens[i:i+1, :length], input_lengths[i:i+1], mask[i:i+1, :length])
+            check(f"text_encoder batch vs alone, {length} tokens", '-', t_en[i, :, :length], t_en_i[0])
+            d_i = predictor.text_encoder(t_en_i, s[i:i+1], input_lengths[i:i+1], mask[i:i+1, :length])
+            check(f"duration batch vs alone, {length} tokens", '-', d[i, :length], d_i[0])
+            F0_i, N_i = predictor.F0Ntrain(en[i:i+1, :, :f], s[i:i+1])
+            check(f"F0/N batch vs alone, {f} frames", '-', torch.cat([F0[i, :2*f], N[i, :2*f]]), torch.cat([F0_i[0], N_i[0]]))
+
+def check_length_regulator():
+    #Gather-based length_regulator against x @ the dense [tokens x frames] alignment it replaced, padded tokens last 0 frames
+    torch.manual_seed(3)
+    lengths = [12, 7, 3]
+    x = torch.randn(len(lengths), 16, max(lengths))
+    duration = torch.randint(1, 9, (len(lengths), max(lengths))) * (torch.arange(max(lengths)) < torch.tensor(lengths).unsqueeze(1))
+    for n_frames in [None, int(duration.sum(-1).max()) + 5]:
+        out, frame_lengths = length_regulator(x, duration, n_frames)
+        for i in range(len(lengths)):
+            alignment = torch.zeros(max(lengths), out.shape[-1])
+            frame = 0
+            for token in range(lengths[i]):
+                alignment[token, frame:frame + int(duration[i, token])] = 1
+                frame += int(duration[i, token])
+            check(f"length_regulator, row {i}{'' if n_frames is None else ' in a bucket'}", '-', out[i], x[i] @ alignment)
+            if int(frame_lengths[i]) != frame:
+                check(f"length_regulator frame length, row {i}", '-', frame_lengths[i:i+1], [frame])
+
+def check_chunked(decoder, net, config, trim=4000):
+    #Decoder.stream: one window is the trimmed decode, parallel windows are the serial ones. Smaller windows only see their
+    #own norm statistics (and cross-fade at the cuts), close to the whole decode but not exact: only the length has to match
+    x = inputs(config, [120])
+    sentence = row(x, 0, 120)
+    stream = lambda **kwargs: torch.cat(list(net.stream(*sentence, trim=trim, **kwargs)), -1).flatten()
+    with torch.no_grad(), quiet():
+        full = net(*sentence, trim=trim).squeeze(1)[0]
+        chunked = stream(chunk=60)
+        check("chunked, one window vs whole", decoder, stream(chunk=1000), full)
+        check("chunked, parallel vs serial", decoder, stream(chunk=60, parallel=2), chunked)
+        check("chunked vs whole", decoder, chunked, full, length_only=True)
+
+def check_incremental(decoder, net, config, trim=4000):
+    #Decoder.incremental (hifigan, istftnet): with the generator's AdaIN norms taken out of both paths, the carried state must
+    #give the whole decode for any block size. With the norms its statistics are running ones: only the length has to match.
+    #Kept short: forward() sums the sine phase in float32, step() in float64, the sources drift apart with the length.
+    #istftnet's STFT phase of the source is zeroed too, it is ill-conditioned in the quiet bins and the convs amplify that
+    x = inputs(config, [120])
+    sentence = row(x, 0, 120)
+    incremental = lambda sentence, block: torch.cat(list(net.incremental(*sentence, block=block, trim=trim)), -1).flatten()
+    with torch.no_grad(), quiet():
+        check("incremental vs whole", decoder, incremental(sentence, 16), net(*sentence, trim=trim).squeeze(1)[0], length_only=True)
+        sentence = row(x, 0, 30)
+        module = sys.modules[type(net).__module__]
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(mock.patch.object(module, 'running_instance_norm', lambda x, *args: x))
+            for m in net.generator.modules():
+                if isinstance(m, module.AdaIN1d):
+                    stack.enter_context(mock.patch.object(m.norm, 'forward', lambda x: x))
+            if decoder == 'istftnet':
+                stft, transform = net.generator.stft, net.generator.stft.transform
+                def magnitude_only(waveform):
+                    magnitude, phase = transform(waveform)
+                    return magnitude, torch.zeros_like(phase)
+                stack.enter_context(mock.patch.object(stft, 'transform', magnitude_only))
+            whole = net(*sentence, trim=trim).squeeze(1)[0]
+            for block in [1, 16, 50]:
+                check(f"incremental without norms, block {block}", decoder, incremental(sentence, block), whole)
+
+def check_folded(name, decoder, net, folded, run):
+    #run() on a module and on the same weights with weight norm folded into plain weights, like StyleTTS2.freeze_for_inference
+    with torch.no_grad(), quiet():
+        check(f"folded vs weight norm, {name}", decoder, run(folded), run(net))
+
+def check_trimmed(decoder, net, config, trim=4000):
+    #Decoder(trim=...): a padded batch against every row trimmed on its own (same window, same norm statistics),
+    #and against the full decode with the ends cut off (same length, the statistics of the left out steps differ)
+    lengths = [120, 75, 40]
+    x = inputs(config, lengths)
+    with torch.no_grad(), quiet():
+        batch = net(*x, trim=trim).squeeze(1)
+        for i, n in enumerate(lengths):
+            alone = net(*row(x, i, n), trim=trim).squeeze(1)[0]
+            check(f"trimmed batch vs alone, {n} frames", decoder, batch[i, :alone.shape[-1]], alone)
+            full = net(*row(x, i, n)).squeeze(1)[0]
+            #vocos' generator has no norm over time, trimming is exact. The others only have to keep the length
+            check(f"trimmed vs full, {n} frames", decoder, alone, full[trim:len(full)-trim], length_only=decoder != 'vocos')
+
+def check_generate(decoder, config_path, models_path):
+    #StyleTTS2.generate with stabilize=False (the durations don't depend on the RNG then): several sentences per batch, and
+    #the front-end running ahead of the decoder on its own thread, against one sentence at a time
+    model = StyleTTS2(config_path, models_path, thread_profile=False).eval()
+    torch.manual_seed(4)
+    style = {'style': torch.randn(1, load_config(config_path)['model_params']['style_dim']), 'path': None, 'speed': 1}
+    text = ' '.join(BENCH_TEXTS)
+    with torch.no_grad(), quiet():
+        serial = model.generate(text, style, stabilize=False)
+        check("generate, batch of 3 vs one by one", decoder, model.generate(text, style, stabilize=False, batch_size=3), serial)
+        check("generate, pipelined vs serial", decoder, model.generate(text, style, stabilize=False, pipeline=2), serial)
+        check_scheduler(decoder, model, text, [style, {**style, 'style': -style['style']}])
+
+def check_scheduler(decoder, model, text, styles):
+    #BatchScheduler.generate of two voices at once, their sentences share batches of two, against StyleTTS2.generate of each
+    async def scheduled():
+        async with BatchScheduler(model, max_batch=2) as scheduler:
+            return await asyncio.gather(*[scheduler.generate(text, style, stabilize=False) for style in styles])
+    for i, wav in enumerate(asyncio.run(scheduled())):
+        check(f"scheduler, voice {i} vs generate", decoder, wav, model.generate(text, styles[i], stabilize=False))
+
+def check_style_cache(config_path, models_path, cache_dir):
+    #get_styles through a StyleCache (computed and put, then read back by a new cache from disk) against no cache
+    speaker = {'path': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Demo', 'Audio', '1_heart.wav'), 'speed': 1}
+    model = StyleTTS2(config_path, models_path, thread_profile=False).eval()
+    with torch.no_grad():
+        computed = model.get_styles(speaker)['style']
+        model.style_cache = StyleCache(cache_dir)
+        check("style cache, miss vs no cache", '-', model.get_styles(speaker)['style'], computed)
+        model.style_cache = StyleCache(cache_dir)
+        check("style cache, from disk vs no cache", '-', model.get_styles(speaker)['style'], computed)
+        if model.style_cache.hits != 1:
+            check("style cache, read from disk", '-', [model.style_cache.hits], [1])
+
+def main(decoders):
+    config = load_config()
+    modules = ['text_encoder', 'predictor', 'style_encoder']
+    nets, folded = build_modules(config, modules, seed=0), build_modules(config, modules, seed=0, freeze=True)
+    check_length_regulator()
+    check_front_batch(nets, config)
+    tokens, lengths = torch.randint(1, 100, (1, 30)), torch.tensor([30])
+    mask = preprocess.length_to_mask(lengths)
+    s, mel = torch.randn(1, config['model_params']['style_dim']), torch.randn(1, 1, config['model_params']['n_mels'], 200)
+    en = torch.randn(1, config['model_params']['hidden_dim'] + config['model_params']['style_dim'], 100)
+    check_folded('text_encoder', '-', nets['text_encoder'], folded['text_encoder'], lambda net: net(tokens, lengths, mask))
+    check_folded('predictor F0/N', '-', nets['predictor'], folded['predictor'], lambda net: torch.cat(net.F0Ntrain(en, s), -1))
+    check_folded('style_encoder', '-', nets['style_encoder'], folded['style_encoder'], lambda net: net(mel))
+    for decoder in decoders:
+        config = load_config(decoder=decoder)
+        net, folded = build_modules(config, ['decoder'], seed=0)['decoder'], build_modules(config, ['decoder'], seed=0, freeze=True)['decoder']
+        check_batch(decoder, net, config)
+        check_trimmed(decoder, net, config)
+        check_chunked(decoder, net, config)
+        if hasattr(net, 'incremental'):
+            check_incremental(decoder, net, config)
+        x = inputs(config, [100])
+        check_folded('decoder', decoder, net, folded, lambda net: net(*row(x, 0, 100)).squeeze(1)[0])
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = write_checkpoint(tmp, decoder)
+            check_generate(decoder, *checkpoint)
+            if decoder == decoders[0]:
+                check_style_cache(*checkpoint, os.path.join(tmp, 'styles'))
+    if failed:
+        print(f"\n{len(failed)} check(s) failed: {', '.join(failed)}")
+        raise SystemExit(1)
+    print("\nAll checks passed")
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or list(DECODERS))
@@ -0,0 +1,71 @@
+import queue
+import threading
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+_DONE = object()
+
+def _put(q, item, stop):
+    #Blocks while the next stage is behind, gives up once the consumer is gone
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _produce(source, out, stop):
+    try:
+        for item in source:
+            if not _put(out, item, stop):
+                return
+    except Exception as e:
+        _put(out, _Failure(e), stop)
+        return
+    _put(out, _DONE, stop)
+
+def _work(stage, inp, out, stop):
+    while not stop.is_set():
+        try:
+            item = inp.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is not _DONE and not isinstance(item, _Failure):
+            try:
+                item = stage(item)
+            except Exception as e:
+                item = _Failure(e)
+        if not _put(out, item, stop) or item is _DONE or isinstance(item, _Failure):
+            return
+
+def pipelined(source, stages, depth=2):
+    """
+    Iterates source on one thread and runs every stage on a thread of its own, in order, like an assembly line:
+    while stage k works on item n, stage k-1 already works on item n+1.
+
+    - stages are connected by queues holding at most `depth` items, a slow stage holds back the ones before it
+    - a long input approaches the throughput of the slowest stage instead of the sum of all of them
+    - results are yielded in input order, an exception in the source or any stage is raised here
+    - closing the generator early stops every thread after the item it is working on
+    """
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=max(1, depth)) for _ in range(len(stages) + 1)]
+    threads = [threading.Thread(target=_produce, args=(source, queues[0], stop), daemon=True)]
+    threads += [threading.Thread(target=_work, args=(stage, queues[k], queues[k+1], stop), daemon=True) for k, stage in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,42 @@
+import os
+import glob
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, QuantWrapper, get_default_qconfig, prepare, convert
+
+DEMO_VOICES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Demo', 'Audio')
+CALIBRATION_TEXT = "ðə nˈɔːɹθ wˈɪnd ænd ðə sˈʌn wɜː dɪspjˈuːɾɪŋ wˈɪtʃ wʌz ðə stɹˈɑːŋɡɚ. wˈɛn ɐ tɹˈævlɚ kˈeɪm ɐlˈɑːŋ ɹˈæpt ɪn ɐ wˈɔːɹm klˈoʊk."
+
+def demo_voices(voices_dir=DEMO_VOICES):
+    return sorted(glob.glob(os.path.join(voices_dir, '*.wav')))
+
+def quantize_dynamic_modules(modules):
+    #int8 weights, activations are quantized on the fly: LSTMs, duration_proj, AdaIN fc and the vocos pointwise layers
+    for module in modules:
+        quantize_dynamic(module, {nn.LSTM, nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def prepare_static_convs(decoder, min_channels=512):
+    #Wraps the wide AdainResBlk1d convs so they quantize their input and dequantize their output, weight norm must be folded first
+    qconfig = get_default_qconfig(torch.backends.quantized.engine)
+    wrapped = 0
+    for block in decoder.modules():
+        if type(block).__name__ != 'AdainResBlk1d':
+            continue
+        for name in ['conv1', 'conv2', 'conv1x1']:
+            conv = getattr(block, name, None)
+            if isinstance(conv, nn.Conv1d) and conv.out_channels >= min_channels:
+                wrapper = QuantWrapper(conv)
+                wrapper.qconfig = qconfig
+                setattr(block, name, wrapper)
+                wrapped += 1
+    prepare(decoder, inplace=True) #observers record activation ranges until convert_static_convs
+    return wrapped
+
+def convert_static_convs(decoder):
+    convert(decoder, inplace=True)
+
+def mel_distance(preprocess, wav, ref):
+    #Mean absolute log-mel difference over the frames both waveforms share
+    mel, mel_ref = preprocess.wave_preprocess(wav), preprocess.wave_preprocess(ref)
+    n_frames = min(mel.shape[-1], mel_ref.shape[-1])
+    return (mel[..., :n_frames] - mel_ref[..., :n_frames]).abs().mean().item()
@@ -0,0 +1,249 @@
+import time
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from Modules.utils import style_tensor
+
+SAMPLES_PER_FRAME = 600 #decoder output samples per predicted frame
+TRIM = 4000 #samples left out at either end of every sentence (weird pulse and silent tokens), the decoder skips them
+
+class WorkItem:
+    def __init__(self, phonem, style, speed, prev_d_mean, n_tokens, key, future, tenant='default', deadline=None):
+        self.phonem = phonem
+        self.style = style
+        self.speed = speed
+        self.prev_d_mean = prev_d_mean
+        self.n_tokens = n_tokens
+        self.key = key #only items with the same sampling settings share a forward pass
+        self.future = future
+        self.tenant = tenant
+        self.deadline = deadline #perf_counter time the audio is due, None for best effort
+        self.enqueued = time.perf_counter()
+
+class BatchScheduler:
+    """
+    Dynamic batching in front of one StyleTTS2 model for many concurrent requests.
+
+    - every request is split into sentences, each sentence is one work item awaiting its waveform
+    - a batch is formed max_wait seconds after its oldest item was queued (or at once when max_batch items wait),
+      it takes items in rank order while they fit max_batch and the padded token and frame budgets
+    - rank: items that would miss their deadline first (earliest deadline first), then the tenant that got the least
+      decode time, then the shortest job. Waiting lowers the cost, a long document can't starve
+    - decode cost is the predicted frame count from a running frames per token estimate, seconds per frame is measured too
+    - a stream's first chunk is due `deadline` seconds after the request, every next one when the previous would finish playing
+    - the batch runs as one forward pass with one style per row, on a single worker thread so the event loop keeps queueing
+    - with stabilize, a request's next sentence needs the previous duration mean: its sentences are queued one at a time,
+      other requests still fill the batch
+    """
+    def __init__(self, model, max_batch=16, max_tokens=4096, max_frames=16384, max_wait=0.01, weights=None, aging=1000, concurrency=None):
+        self.model = model
+        self.concurrency = concurrency or getattr(model, 'concurrency', 1) #batches in flight, one per worker of a WorkerPool
+        self.max_batch = max_batch
+        self.max_tokens = max_tokens
+        self.max_frames = max_frames
+        self.max_wait = max_wait
+        self.weights = weights or {} #tenant -> share of the decode time, 1 by default
+        self.aging = aging #frames of cost forgiven per second of waiting
+        self.frames_per_token = 7.0
+        self.seconds_per_frame = 1e-3
+        self.served = defaultdict(float) #tenant -> weighted frames decoded, the fair queueing virtual time
+        self.waiting = []
+        self.wakeup = None
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency) #one model never runs two batches at once
+        self.slots = None
+        self.task = None
+        self.stopping = False
+        self.batches = 0
+        self.rows = 0
+        self.missed = 0 #items finished after their deadline
+
+    async def start(self):
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.slots = asyncio.Semaphore(self.concurrency)
+            self.stopping = False
+            self.task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        #Everything already submitted is still served
+        if self.task is not None:
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    def estimate_frames(self, n_tokens, speed=1):
+        return n_tokens * self.frames_per_token / min(max(speed, 0.0001), 2)
+
+    async def call(self, fn, *args, **kwargs):
+        #Runs fn on the model thread, e.g. get_styles, so it never overlaps a forward pass
+        return await asyncio.get_running_loop().run_in_executor(self.executor, lambda: fn(*args, **kwargs))
+
+    async def submit(self, phonem, style, speed=1, prev_d_mean=0, steps=5, embedding_scale=1, t=0.1, tenant='default', deadline=None):
+        #One sentence, returns (waveform without its first and last TRIM samples, duration mean). deadline is an absolute time.perf_counter() value
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        item = WorkItem(phonem, style_tensor(style), speed, prev_d_mean, self.model.count_tokens(phonem), (steps, embedding_scale, t), future,
+                        tenant=tenant, deadline=deadline)
+        if all(x.tenant != tenant for x in self.waiting): #an idle tenant doesn't bank credit, it rejoins at the current virtual time
+            active = [self.served[x.tenant] for x in self.waiting]
+            self.served[tenant] = max(self.served[tenant], min(active) if active else 0)
+        self.waiting.append(item)
+        self.wakeup.set()
+        return await future
+
+    async def generate_stream(self, phonem, style, steps=5, embedding_scale=1, n_merge=16, stabilize=True, tenant='default', deadline=None, ahead=None):
+        #Same chunks as StyleTTS2.generate_stream. deadline: seconds until the first chunk is due, None for best effort.
+        #ahead: without stabilize, how many sentences are queued past the one being consumed (None: all), a slow consumer then holds back decoding.
+        #Closing the generator early (cancelled request) drops its queued sentences
+        if stabilize:   smooth_value=0.2
+        else:           smooth_value=0
+        kw = dict(speed=style['speed'], steps=steps, embedding_scale=embedding_scale, t=smooth_value, tenant=tenant)
+
+        text_norm = self.model.preprocess.text_preprocess(phonem, n_merge=n_merge)
+        due = None if deadline is None else time.perf_counter() + deadline
+        futures = []
+
+        def queue_next():
+            #no state between sentences, the later ones are due after the estimated audio before them
+            nonlocal due
+            text = text_norm[len(futures)]
+            futures.append(asyncio.ensure_future(self.submit(text, style['style'], deadline=due, **kw)))
+            if due is not None:
+                due += self.estimate_frames(self.model.count_tokens(text), style['speed']) * SAMPLES_PER_FRAME / 24000
+
+        offset = 0
+        prev_d_mean = 0
+        try:
+            for i, text in enumerate(text_norm):
+                if stabilize:
+                    wav, prev_d_mean = await self.submit(text, style['style'], prev_d_mean=prev_d_mean, deadline=due, **kw)
+                else:
+                    while len(futures) < len(text_norm) and (ahead is None or len(futures) <= i + ahead):
+                        queue_next()
+                    wav, _ = await futures[i]
+                if stabilize and due is not None:
+                    due = max(due, time.perf_counter()) + len(wav) / 24000
+                yield {
+                    'wav': wav,
+                    'index': i,
+                    'offset': offset,
+                    'duration': len(wav) / 24000,
+                }
+                offset += len(wav)
+        finally:
+            for future in futures:
+                future.cancel()
+
+    async def generate(self, phonem, style, steps=5, embedding_scale=1, n_merge=16, stabilize=True, tenant='default', deadline=None):
+        list_wav = [chunk['wav'] async for chunk in self.generate_stream(phonem, style, steps=steps, embedding_scale=embedding_scale,
+                                                                          n_merge=n_merge, stabilize=stabilize, tenant=tenant, deadline=deadline)]
+        final_wav = np.concatenate(list_wav)
+        final_wav = np.concatenate([np.zeros([4000]), final_wav, np.zeros([4000])], axis=0) # add padding
+        return final_wav
+
+    def __rank(self, item, now):
+        cost = self.estimate_frames(item.n_tokens, item.speed)
+        if item.deadline is not None:
+            slack = item.deadline - now - cost * self.seconds_per_frame
+            if slack <= self.max_wait: #at risk, earliest deadline first
+                return (0, item.deadline, 0, 0)
+        return (1, 0, self.served[item.tenant], cost - (now - item.enqueued) * self.aging)
+
+    def __fits(self, batch, item):
+        if item.key != batch[0].key or len(batch) >= self.max_batch:
+            return False
+        n_tokens = max(item.n_tokens, max(x.n_tokens for x in batch))
+        return (len(batch) + 1) * n_tokens <= self.max_tokens and \
+               (len(batch) + 1) * self.estimate_frames(n_tokens, min(x.speed for x in batch + [item])) <= self.max_frames
+
+    def __select(self):
+        now = time.perf_counter()
+        self.waiting = [x for x in self.waiting if not x.future.done()] #cancelled while waiting
+        if not self.waiting:
+            return []
+        ranked = sorted(self.waiting, key=lambda x: self.__rank(x, now))
+        batch = [ranked[0]]
+        urgent = self.__rank(batch[0], now)[0] == 0
+        for item in ranked[1:]:
+            if urgent and item.n_tokens > 2*batch[0].n_tokens: #padding to a long row would delay the at risk one
+                continue
+            if self.__fits(batch, item):
+                batch.append(item)
+        selected = set(map(id, batch))
+        self.waiting = [x for x in self.waiting if id(x) not in selected]
+        return batch
+
+    async def __gather(self):
+        #Waits until a batch is worth running: max_wait after the oldest item, a full batch, an at risk deadline or stop()
+        while not self.waiting:
+            if self.stopping:
+                return False
+            self.wakeup.clear()
+            await self.wakeup.wait()
+        while not self.stopping and len(self.waiting) < self.max_batch:
+            now = time.perf_counter()
+            timeout = min(x.enqueued for x in self.waiting) + self.max_wait - now
+            if timeout <= 0 or any(self.__rank(x, now)[0] == 0 for x in self.waiting):
+                break
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+        return True
+
+    def __forward(self, batch):
+        steps, embedding_scale, t = batch[0].key
+        start = time.perf_counter()
+        wavs, d_means = self.model.inference_batch([x.phonem for x in batch], [x.style for x in batch], [x.speed for x in batch],
+                                                   [x.prev_d_mean for x in batch], steps=steps, embedding_scale=embedding_scale, t=t, trim=TRIM)
+        return wavs, d_means, time.perf_counter() - start
+
+    async def __run(self):
+        running = set()
+        while True:
+            await self.slots.acquire() #the batch is only put together once a worker is free for it
+            batch = self.__select() if await self.__gather() else None
+            if batch is None:
+                self.slots.release()
+                break
+            if not batch:
+                self.slots.release()
+                continue
+            task = asyncio.create_task(self.__execute(batch))
+            running.add(task)
+            task.add_done_callback(running.discard)
+        await asyncio.gather(*running)
+
+    async def __execute(self, batch):
+        try:
+            wavs, d_means, elapsed = await asyncio.get_running_loop().run_in_executor(self.executor, self.__forward, batch)
+        except Exception as e:
+            for item in batch:
+                if not item.future.done(): item.future.set_exception(e)
+            return
+        finally:
+            self.slots.release()
+        self.batches += 1
+        self.rows += len(batch)
+        n_frames = [(len(wav) + 2*TRIM) / SAMPLES_PER_FRAME for wav in wavs]
+        n_tokens = sum(x.n_tokens / min(max(x.speed, 0.0001), 2) for x in batch)
+        #running estimates at speed 1
+        self.frames_per_token = 0.9*self.frames_per_token + 0.1*sum(n_frames)/n_tokens
+        self.seconds_per_frame = 0.9*self.seconds_per_frame + 0.1*elapsed/sum(n_frames)
+        now = time.perf_counter()
+        for item, wav, d_mean, frames in zip(batch, wavs, d_means, n_frames):
+            self.served[item.tenant] += frames / self.weights.get(item.tenant, 1)
+            if item.deadline is not None and now > item.deadline:
+                self.missed += 1
+            if not item.future.done(): item.future.set_result((wav, d_mean))
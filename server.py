@@ -0,0 +1,484 @@
+import os
+import io
+import json
+import time
+import wave
+import glob
+import base64
+import signal
+import struct
+import hashlib
+import asyncio
+import urllib.request
+import click
+import numpy as np
+
+from scheduler import BatchScheduler
+
+#Self-contained serving surface, standard library only:
+#   GET  /health            -> {"status": "ok", ...}
+#   GET  /voices            -> {"voices": [...]}
+#   GET  /metrics           -> Prometheus text of the per stage latency histograms, when serving with --metrics
+#   POST /tts   (json)      -> audio/wav of the whole clip
+#   GET  /stream (websocket)-> send one json request, receive {"event": "start"}, then per sentence a {"event": "chunk"}
+#                              message followed by the pcm_s16le audio as binary frames, then {"event": "done"}.
+#                              Send {"event": "cancel"} or close the socket to stop decoding mid-document.
+#Request json: phonemes (or text + lang when phonemizer is installed), voice, speed, denoise, avg_style, stabilize, n_merge,
+#steps, embedding_scale, tenant, deadline (seconds until the first audio is due). Unknown fields or wrong types get a 400 (PARAMS)
+
+SAMPLE_RATE = 24000
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+STATUS = {101: 'Switching Protocols', 200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+          413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+OP_CONT, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+
+#Request json fields: (type, default), a None default is optional
+PARAMS = {
+    'phonemes': (str, None), 'text': (str, None), 'lang': (str, 'en-us'), 'voice': (str, None), 'tenant': (str, 'default'),
+    'speed': (float, 1.0), 'denoise': (float, 0.3), 'embedding_scale': (float, 1.0), 'deadline': (float, None),
+    'steps': (int, 5), 'n_merge': (int, 16), 'avg_style': (bool, True), 'stabilize': (bool, True),
+}
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def parse_params(params):
+    #Checked request json with the defaults filled in, HTTPError 400 before anything is submitted.
+    #Types are strict: "false" is not a bool and "5" is not a number
+    if not isinstance(params, dict):
+        raise HTTPError(400, "Request must be a json object")
+    unknown = sorted(set(params) - set(PARAMS))
+    if unknown:
+        raise HTTPError(400, f"Unknown parameters {unknown}, expected some of {sorted(PARAMS)}")
+    parsed = {}
+    for name, (kind, default) in PARAMS.items():
+        value = params.get(name)
+        if value is None:
+            parsed[name] = default
+            continue
+        if kind is float:
+            valid = isinstance(value, (int, float)) and not isinstance(value, bool) and np.isfinite(value)
+        elif kind is int:
+            valid = isinstance(value, int) and not isinstance(value, bool)
+        else:
+            valid = isinstance(value, kind)
+        if not valid:
+            expected = {float: 'a number', int: 'an integer', bool: 'true or false', str: 'a string'}[kind]
+            raise HTTPError(400, f"'{name}' must be {expected}, got {json.dumps(value)}")
+        parsed[name] = kind(value)
+    for name in ['speed', 'steps', 'n_merge']:
+        if parsed[name] <= 0:
+            raise HTTPError(400, f"'{name}' must be positive")
+    for name in ['denoise', 'embedding_scale', 'deadline']:
+        if parsed[name] is not None and parsed[name] < 0:
+            raise HTTPError(400, f"'{name}' can't be negative")
+    return parsed
+
+def to_pcm16(wav):
+    return (np.clip(wav, -1, 1) * 32767).astype('<i2').tobytes()
+
+def to_wav(wav):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(to_pcm16(wav))
+    return buffer.getvalue()
+
+def phonemize(text, lang):
+    try:
+        import phonemizer
+    except ImportError:
+        raise HTTPError(400, "phonemizer is not installed, send 'phonemes' instead of 'text'")
+    backend = phonemizer.backend.EspeakBackend(language=lang, preserve_punctuation=True, with_stress=True, language_switch='remove-flags')
+    return backend.phonemize([text])[0]
+
+async def read_request(reader, max_body):
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    method, path, _ = lines[0].split(' ', 2)
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > max_body:
+        raise HTTPError(413, f"Body over {max_body} bytes")
+    body = await reader.readexactly(length) if length else b''
+    return method, path.split('?', 1)[0], headers, body
+
+async def write_response(writer, status, body, content_type='application/json', headers=None):
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body).encode('utf-8')
+    head = [f"HTTP/1.1 {status} {STATUS.get(status, '')}", f"Content-Type: {content_type}", f"Content-Length: {len(body)}", "Connection: close"]
+    head += [f"{key}: {value}" for key, value in (headers or {}).items()]
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+
+# WebSocket framing (RFC 6455), client frames are masked, server frames are not
+def ws_accept(key):
+    return base64.b64encode(hashlib.sha1((key + WS_GUID).encode('latin-1')).digest()).decode('latin-1')
+
+def ws_frame(opcode, payload, mask=False):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    head = bytes([0x80 | opcode])
+    mask_bit = 0x80 if mask else 0
+    if len(payload) < 126:
+        head += bytes([mask_bit | len(payload)])
+    elif len(payload) < 1 << 16:
+        head += bytes([mask_bit | 126]) + struct.pack('>H', len(payload))
+    else:
+        head += bytes([mask_bit | 127]) + struct.pack('>Q', len(payload))
+    if mask:
+        key = os.urandom(4)
+        payload = bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+        head += key
+    return head + payload
+
+async def ws_read(reader, max_size=1 << 24):
+    #One message, continuation frames are joined. Returns (opcode, payload)
+    message, message_opcode = b'', None
+    while True:
+        b0, b1 = await reader.readexactly(2)
+        fin, opcode, masked, length = b0 & 0x80, b0 & 0x0F, b1 & 0x80, b1 & 0x7F
+        if length == 126:
+            length = struct.unpack('>H', await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('>Q', await reader.readexactly(8))[0]
+        if length > max_size:
+            raise HTTPError(413, f"Frame over {max_size} bytes")
+        key = await reader.readexactly(4) if masked else None
+        payload = await reader.readexactly(length)
+        if key is not None:
+            payload = (np.frombuffer(payload, np.uint8) ^ np.resize(np.frombuffer(key, np.uint8), length)).tobytes()
+        if opcode >= OP_CLOSE: #control frames may come in between fragments
+            return opcode, payload
+        if opcode != OP_CONT:
+            message_opcode = opcode
+        message += payload
+        if fin:
+            return message_opcode, message
+
+class TTSServer:
+    """
+    HTTP + WebSocket front end of one StyleTTS2 model, all requests share a BatchScheduler.
+
+    - voices: every wav in voices_dir, the voice id is the file name without extension. Styles are computed once per
+      (voice, denoise, avg_style) on the model thread, model.style_cache keeps them across restarts
+    - cancellation: a closed connection or a cancel message cancels the request, its queued sentences are dropped
+    - backpressure: audio is written with drain() and only `ahead` sentences are queued past the one being sent,
+      a slow client holds back its own decoding instead of buffering the whole document
+    - shutdown: stop accepting, let running requests finish for up to `grace` seconds, cancel the rest, drain the scheduler
+    """
+    def __init__(self, model, voices_dir, scheduler=None, max_body=1 << 20, chunk_bytes=1 << 15, ahead=2, grace=30, metrics=None):
+        self.model = model
+        self.metrics = metrics #instrumentation.HistogramRegistry the model's records go to
+        self.scheduler = scheduler or BatchScheduler(model)
+        self.voices = {os.path.splitext(os.path.basename(path))[0]: path for path in sorted(glob.glob(os.path.join(voices_dir, '*.wav')))}
+        self.styles = {}
+        self.max_body = max_body
+        self.chunk_bytes = chunk_bytes
+        self.ahead = ahead
+        self.grace = grace
+        self.requests = set()
+        self.served = 0
+
+    async def style(self, params):
+        voice = params['voice']
+        if voice not in self.voices:
+            raise HTTPError(404, f"Unknown voice {voice!r}")
+        key = (voice, params['denoise'], params['avg_style'])
+        if key not in self.styles:
+            speaker = {'path': self.voices[voice], 'speed': 1}
+            style = await self.scheduler.call(self.model.get_styles, speaker, key[1], key[2])
+            self.styles[key] = style['style'].detach().cpu()
+        return {'style': self.styles[key], 'path': self.voices[voice], 'speed': params['speed']}
+
+    async def chunks(self, params):
+        #params: from parse_params
+        if params['phonemes'] is not None:
+            phonemes = params['phonemes']
+        elif params['text'] is not None:
+            phonemes = await asyncio.get_running_loop().run_in_executor(None, phonemize, params['text'], params['lang'])
+        else:
+            raise HTTPError(400, "Missing 'phonemes'")
+        style = await self.style(params)
+        async for chunk in self.scheduler.generate_stream(phonemes, style,
+                                                          steps=params['steps'],
+                                                          embedding_scale=params['embedding_scale'],
+                                                          n_merge=params['n_merge'],
+                                                          stabilize=params['stabilize'],
+                                                          tenant=params['tenant'],
+                                                          deadline=params['deadline'],
+                                                          ahead=self.ahead):
+            yield chunk
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.requests.add(task)
+        try:
+            method, path, headers, body = await read_request(reader, self.max_body)
+            if path == '/health':
+                await write_response(writer, 200, {'status': 'ok', 'batches': self.scheduler.batches, 'rows': self.scheduler.rows,
+                                                   'waiting': len(self.scheduler.waiting), 'served': self.served})
+            elif path == '/voices':
+                await write_response(writer, 200, {'voices': list(self.voices)})
+            elif path == '/metrics':
+                if self.metrics is None:
+                    raise HTTPError(404, "Metrics are off, serve with --metrics")
+                await write_response(writer, 200, self.metrics.prometheus().encode('utf-8'), 'text/plain; version=0.0.4')
+            elif path == '/tts':
+                if method != 'POST':
+                    raise HTTPError(405, "POST a json request")
+                await self.tts(reader, writer, body)
+            elif path == '/stream':
+                if headers.get('upgrade', '').lower() != 'websocket' or 'sec-websocket-key' not in headers:
+                    raise HTTPError(400, "Expected a websocket upgrade")
+                await self.stream(reader, writer, headers)
+            else:
+                raise HTTPError(404, f"No route {path}")
+        except HTTPError as e:
+            await write_response(writer, e.status, {'error': str(e)})
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass #client went away or shutdown
+        except Exception as e:
+            print("Request failed:", repr(e))
+            try:
+                await write_response(writer, 500, {'error': repr(e)})
+            except ConnectionError:
+                pass
+        finally:
+            self.requests.discard(task)
+            writer.close()
+
+    async def tts(self, reader, writer, body):
+        try:
+            params = json.loads(body or b'{}')
+        except ValueError:
+            raise HTTPError(400, "Body is not json")
+        params = parse_params(params)
+
+        async def synthesize():
+            wavs = [chunk['wav'] async for chunk in self.chunks(params)]
+            return np.concatenate([np.zeros([4000]), *wavs, np.zeros([4000])]) #same padding as StyleTTS2.generate
+
+        start = time.perf_counter()
+        job = asyncio.ensure_future(synthesize())
+        hangup = asyncio.ensure_future(reader.read(1)) #EOF: the client closed the connection, stop decoding
+        done, _ = await asyncio.wait([job, hangup], return_when=asyncio.FIRST_COMPLETED)
+        if job not in done and hangup.result() == b'':
+            job.cancel()
+            return
+        hangup.cancel()
+        wav = await job
+        self.served += 1
+        await write_response(writer, 200, to_wav(wav), 'audio/wav', {'X-Audio-Duration': f"{len(wav)/SAMPLE_RATE:.3f}",
+                                                                     'X-Synthesis-Time': f"{time.perf_counter() - start:.3f}"})
+
+    async def stream(self, reader, writer, headers):
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {ws_accept(headers['sec-websocket-key'])}\r\n\r\n").encode('latin-1'))
+        writer.transport.set_write_buffer_limits(high=4*self.chunk_bytes) #drain() blocks once a slow client is this far behind
+        await writer.drain()
+
+        async def send(opcode, payload):
+            writer.write(ws_frame(opcode, payload))
+            await writer.drain()
+
+        opcode, payload = await ws_read(reader)
+        if opcode != OP_TEXT:
+            await send(OP_CLOSE, struct.pack('>H', 1003))
+            return
+        try:
+            params = parse_params(json.loads(payload))
+        except (ValueError, HTTPError) as e:
+            await send(OP_TEXT, json.dumps({'event': 'error', 'message': str(e) if isinstance(e, HTTPError) else "Request is not json"}))
+            await send(OP_CLOSE, struct.pack('>H', 1007))
+            return
+
+        async def produce():
+            start = time.perf_counter()
+            await send(OP_TEXT, json.dumps({'event': 'start', 'sample_rate': SAMPLE_RATE, 'format': 'pcm_s16le'}))
+            n_chunks, duration = 0, 0
+            async for chunk in self.chunks(params):
+                pcm = to_pcm16(chunk['wav'])
+                await send(OP_TEXT, json.dumps({'event': 'chunk', 'index': chunk['index'], 'offset': chunk['offset'],
+                                                'duration': chunk['duration'], 'bytes': len(pcm),
+                                                'elapsed': time.perf_counter() - start}))
+                for i in range(0, len(pcm), self.chunk_bytes):
+                    await send(OP_BINARY, pcm[i:i+self.chunk_bytes])
+                n_chunks += 1
+                duration += chunk['duration']
+            await send(OP_TEXT, json.dumps({'event': 'done', 'chunks': n_chunks, 'duration': duration, 'elapsed': time.perf_counter() - start}))
+
+        async def listen():
+            #Returns once the client cancels or closes, pings are answered on the way
+            while True:
+                opcode, payload = await ws_read(reader)
+                if opcode == OP_PING:
+                    await send(OP_PONG, payload)
+                elif opcode == OP_CLOSE:
+                    return
+                elif opcode == OP_TEXT:
+                    try:
+                        event = json.loads(payload).get('event')
+                    except (ValueError, AttributeError): #not json or not an object, malformed control frames are ignored
+                        continue
+                    if event == 'cancel':
+                        return
+
+        job = asyncio.ensure_future(produce())
+        control = asyncio.ensure_future(listen())
+        try:
+            done, _ = await asyncio.wait([job, control], return_when=asyncio.FIRST_COMPLETED)
+            if job in done:
+                job.result()
+                self.served += 1
+            else:
+                job.cancel()
+                await asyncio.gather(job, return_exceptions=True)
+                await send(OP_TEXT, json.dumps({'event': 'cancelled'}))
+        except Exception as e: #the socket is already upgraded, errors go back as events
+            await send(OP_TEXT, json.dumps({'event': 'error', 'message': str(e) if isinstance(e, HTTPError) else repr(e)}))
+        finally:
+            job.cancel()
+            control.cancel()
+        try:
+            await send(OP_CLOSE, struct.pack('>H', 1000))
+        except ConnectionError:
+            pass
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError): #not available on Windows or outside the main thread
+                pass
+        await self.scheduler.start()
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving on http://{host}:{port} with {len(self.voices)} voices")
+        async with server:
+            await stop.wait()
+            print("Shutting down...")
+            server.close() #no new connections
+            running = [task for task in self.requests]
+            if running:
+                _, pending = await asyncio.wait(running, timeout=self.grace)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        await self.scheduler.stop()
+        print("Stopped")
+
+# Local client
+def request_tts(url, params, out_path):
+    request = urllib.request.Request(url.rstrip('/') + '/tts', data=json.dumps(params).encode('utf-8'), headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        audio = response.read()
+    with open(out_path, 'wb') as f:
+        f.write(audio)
+    return {'bytes': len(audio), 'elapsed': time.perf_counter() - start}
+
+async def request_stream(url, params, out_path=None, cancel_after=None):
+    #Streams one request over the websocket, returns the chunk events with the client side time of their arrival
+    host, port = url.split('://', 1)[-1].rstrip('/').split(':')
+    reader, writer = await asyncio.open_connection(host, int(port))
+    key = base64.b64encode(os.urandom(16)).decode('latin-1')
+    writer.write((f"GET /stream HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                  f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode('latin-1'))
+    head = await reader.readuntil(b'\r\n\r\n')
+    if b' 101 ' not in head.split(b'\r\n', 1)[0] or ws_accept(key).encode('latin-1') not in head:
+        raise ConnectionError(head.decode('latin-1'))
+
+    start = time.perf_counter()
+    writer.write(ws_frame(OP_TEXT, json.dumps(params), mask=True))
+    events, pcm = [], bytearray()
+    while True:
+        opcode, payload = await ws_read(reader)
+        if opcode == OP_BINARY:
+            pcm += payload
+            continue
+        if opcode == OP_CLOSE:
+            break
+        event = json.loads(payload)
+        event['received'] = time.perf_counter() - start
+        events.append(event)
+        if event['event'] == 'chunk' and cancel_after is not None and sum(e['event'] == 'chunk' for e in events) >= cancel_after:
+            writer.write(ws_frame(OP_TEXT, json.dumps({'event': 'cancel'}), mask=True))
+    writer.write(ws_frame(OP_CLOSE, struct.pack('>H', 1000), mask=True))
+    writer.close()
+    if out_path is not None:
+        with open(out_path, 'wb') as f:
+            f.write(to_wav(np.frombuffer(bytes(pcm), '<i2') / 32767))
+    return events
+
+@click.group()
+def main():
+    pass
+
+@main.command()
+@click.option('-p', '--config_path', default='Configs/config.yaml', type=str)
+@click.option('-m', '--models_path', required=True, type=str)
+@click.option('--voices_dir', default=os.path.join('Demo', 'Audio'), type=str)
+@click.option('--style_cache', default=None, type=str)
+@click.option('--host', default='127.0.0.1', type=str)
+@click.option('--port', default=8000, type=int)
+@click.option('--max_batch', default=16, type=int)
+@click.option('--max_wait', default=0.01, type=float)
+@click.option('--device', default='cpu', type=str)
+@click.option('--workers', default=None, type=int, help='CPU worker processes sharing the weights, 0 runs the model in the server process. Default: thread profile')
+@click.option('--threads', default=None, type=int, help='torch threads per worker. Default: thread profile')
+@click.option('--metrics', is_flag=True, default=False, help='per stage latency histograms on /metrics, in-process model only')
+@click.option('--log_records', default=None, type=str, help='json lines file of the per sentence and per request timing records')
+def serve(config_path, models_path, voices_dir, style_cache, host, port, max_batch, max_wait, device, workers, threads, metrics, log_records):
+    from inference import StyleTTS2
+    from instrumentation import Instrumentation, HistogramRegistry, LogSink
+    model = StyleTTS2(config_path, models_path, style_cache=style_cache, thread_profile=(device == 'cpu')).eval().to(device)
+    if workers is None: #one process unless thread_tuning.py found that more workers serve faster
+        workers = (model.thread_profile or {}).get('workers', 1) if device == 'cpu' else 0
+        workers = workers if workers > 1 else 0
+    if workers == 0 and threads:
+        import torch
+        torch.set_num_threads(threads)
+    registry = HistogramRegistry() if metrics and workers == 0 else None
+    if metrics and workers > 0:
+        print("WARNING: --metrics needs the model in the server process (--workers 0), /metrics is off")
+    sinks = [sink for sink in [registry, log_records and LogSink(log_records)] if sink]
+    if sinks:
+        model.instrumentation = Instrumentation(sinks, sync=device != 'cpu') #workers inherit it
+    if workers > 0:
+        from worker_pool import WorkerPool
+        model = WorkerPool(model, workers=workers, threads=threads)
+    server = TTSServer(model, voices_dir, BatchScheduler(model, max_batch=max_batch, max_wait=max_wait), metrics=registry)
+    asyncio.run(server.serve(host, port))
+    if workers > 0:
+        model.close()
+
+@main.command()
+@click.option('--url', default='http://127.0.0.1:8000', type=str)
+@click.option('--phonemes', default=None, type=str)
+@click.option('--text', default=None, type=str)
+@click.option('--voice', required=True, type=str)
+@click.option('--speed', default=1.0, type=float)
+@click.option('-o', '--out_path', default='audio.wav', type=str)
+@click.option('--stream', is_flag=True, default=False)
+@click.option('--cancel_after', default=None, type=int)
+def client(url, phonemes, text, voice, speed, out_path, stream, cancel_after):
+    params = {'voice': voice, 'speed': speed}
+    params.update({'phonemes': phonemes} if phonemes else {'text': text})
+    if not stream:
+        print(request_tts(url, params, out_path))
+        return
+    for event in asyncio.run(request_stream(url, params, out_path, cancel_after)):
+        print(event)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,101 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import torch
+
+class StyleCache:
+    """
+    Two tier cache for computed voice styles.
+
+    - memory: LRU of style tensors, holds at most `max_items` voices
+    - disk (optional): one small tensor file per voice in `cache_dir` plus an index.json describing them
+    - key: sha256 of the reference audio bytes + denoise + avg_style + model checkpoint id,
+      so renaming a file still hits while re-recording it or changing the checkpoint misses
+    """
+    def __init__(self, cache_dir=None, max_items=256):
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.digests = {} #(path, size, mtime) -> audio digest, avoids re-hashing unchanged files
+        self.index = {}
+        self.hits = 0
+        self.misses = 0
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            index_path = os.path.join(self.cache_dir, 'index.json')
+            if os.path.isfile(index_path):
+                with open(index_path, 'r', encoding='utf-8') as f:
+                    self.index = json.load(f)
+
+    def __audio_digest(self, path):
+        stat = os.stat(path)
+        file_id = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        digest = self.digests.get(file_id)
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+            digest = sha.hexdigest()
+            self.digests[file_id] = digest
+        return digest
+
+    def __save_index(self):
+        index_path = os.path.join(self.cache_dir, 'index.json')
+        with open(index_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(index_path + '.tmp', index_path) #atomic, readers never see a half written index
+
+    def key(self, path, denoise, avg_style, model_id):
+        audio = self.__audio_digest(path)
+        key = f"{audio}|{float(denoise):.4f}|{bool(avg_style)}|{model_id}"
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+            entry = self.index.get(key)
+        if entry is not None:
+            style_path = os.path.join(self.cache_dir, entry['file'])
+            if os.path.isfile(style_path):
+                style = torch.load(style_path, map_location='cpu')
+                with self.lock:
+                    self.__remember(key, style)
+                    self.hits += 1
+                return style
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, style, **meta):
+        style = style.detach().cpu()
+        with self.lock:
+            self.__remember(key, style)
+            if self.cache_dir is not None:
+                file = key + '.pt'
+                torch.save(style, os.path.join(self.cache_dir, file))
+                self.index[key] = {'file': file, **meta}
+                self.__save_index()
+
+    def __remember(self, key, style):
+        self.memory[key] = style
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def clear(self, disk=False):
+        with self.lock:
+            self.memory.clear()
+            if disk and self.cache_dir is not None:
+                for entry in self.index.values():
+                    style_path = os.path.join(self.cache_dir, entry['file'])
+                    if os.path.isfile(style_path):
+                        os.remove(style_path)
+                self.index = {}
+                self.__save_index()
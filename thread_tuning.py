@@ -0,0 +1,130 @@
+import os
+import time
+import yaml
+import click
+import numpy as np
+import torch
+import multiprocessing as mp
+
+PROFILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Configs', 'thread_profile.yaml')
+BENCH_TEXTS = [
+    "ðɪs ɪz ɐ ʃˈɔːɹt wˈʌn.",
+    "ðə nˈɔːɹθ wˈɪnd ænd ðə sˈʌn wɜː dɪspjˈuːɾɪŋ wˈɪtʃ wʌz ðə stɹˈɑːŋɡɚ.",
+    "wˈɛn ɐ tɹˈævlɚ kˈeɪm ɐlˈɑːŋ ɹˈæpt ɪn ɐ wˈɔːɹm klˈoʊk, ðeɪ ɐɡɹˈiːd ðæt ðə wˈʌn hˌuː fˈɜːst səksˈiːdᵻd ɪn mˌeɪkɪŋ ðə tɹˈævlɚ tˈeɪk hɪz klˈoʊk ˈɔf ʃˌʊd biː kənsˈɪdɚd stɹˈɑːŋɡɚ ðɐn ðɪ ˈʌðɚ.",
+]
+
+def thread_grid(cpus, thread_counts=None, worker_counts=None):
+    #(workers, threads) pairs that don't oversubscribe the cores
+    thread_counts = thread_counts or sorted({n for n in [1, 2, 4, 8, 16, 32, cpus] if n <= cpus})
+    worker_counts = worker_counts or sorted({n for n in [1, 2, 4, 8, 16, 32, cpus] if n <= cpus})
+    return [(workers, threads) for workers in worker_counts for threads in thread_counts if workers*threads <= cpus]
+
+def bench_worker(synthesize, jobs, threads, barrier, results):
+    torch.set_num_threads(threads)
+    try:
+        synthesize(*jobs[0]) #warm up
+        barrier.wait()
+        latencies = []
+        audio = 0
+        start = time.perf_counter()
+        for job in jobs:
+            job_start = time.perf_counter()
+            audio += synthesize(*job)
+            latencies.append(time.perf_counter() - job_start)
+        results.put((time.perf_counter() - start, audio, latencies, None))
+    except Exception as e:
+        barrier.abort()
+        results.put((0, 0, [], repr(e)))
+
+def benchmark(synthesize, jobs, workers, threads, timeout=600):
+    #Every worker runs all jobs at the same time, like `workers` busy processes of a WorkerPool.
+    #synthesize(*job) returns seconds of audio. Forked, so synthesize can be a bound method of the loaded model
+    ctx = mp.get_context('fork')
+    barrier = ctx.Barrier(workers)
+    results = ctx.Queue()
+    processes = [ctx.Process(target=bench_worker, args=(synthesize, jobs, threads, barrier, results), daemon=True) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        outcomes = [results.get(timeout=timeout) for _ in processes]
+    finally:
+        for process in processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+    errors = [error for *_, error in outcomes if error is not None]
+    if errors:
+        raise RuntimeError(f"Benchmark worker failed: {errors[0]}")
+    wall = max(elapsed for elapsed, *_ in outcomes)
+    latencies = [latency for _, _, worker_latencies, _ in outcomes for latency in worker_latencies]
+    return {
+        'workers': workers,
+        'threads': threads,
+        'throughput': sum(audio for _, audio, _, _ in outcomes) / wall, #seconds of audio per second, all workers
+        'latency': float(np.median(latencies)), #seconds per sentence
+    }
+
+def recommend(results, objective='throughput'):
+    assert objective in ['throughput', 'latency'], 'Objective unknown'
+    if objective == 'throughput':
+        return max(results, key=lambda x: x['throughput'])
+    return min(results, key=lambda x: x['latency'])
+
+def load_profile(path, decoder_type):
+    #Profile of this decoder type, None when there is none or it was tuned on a box with another core count
+    if not path or not os.path.isfile(path):
+        return None
+    profiles = yaml.safe_load(open(path, "r", encoding="utf-8")) or {}
+    profile = profiles.get(decoder_type)
+    if profile is None:
+        return None
+    if profile['cpus'] != os.cpu_count():
+        print(f"WARNING: Thread profile {path} was tuned on {profile['cpus']} cpus, this box has {os.cpu_count()}. Ignored, tune again.")
+        return None
+    return profile
+
+def save_profile(path, decoder_type, profile):
+    profiles = {}
+    if os.path.isfile(path):
+        profiles = yaml.safe_load(open(path, "r", encoding="utf-8")) or {}
+    profiles[decoder_type] = profile
+    with open(path + '.tmp', 'w', encoding="utf-8") as f:
+        yaml.safe_dump(profiles, f, sort_keys=False)
+    os.replace(path + '.tmp', path)
+
+def use_profile(thread_profile, decoder_type):
+    #Model constructors: True loads PROFILE_PATH, a path loads that file, None/False leaves torch's threads alone.
+    #Opt-in since applying sets torch's process-wide thread counts
+    if not thread_profile:
+        return None
+    path = PROFILE_PATH if thread_profile is True else thread_profile
+    profile = load_profile(path, decoder_type)
+    if profile:
+        apply_profile(profile)
+        print(f"Thread profile: {profile['workers']} workers x {profile['threads']} threads")
+    return profile
+
+def apply_profile(profile):
+    torch.set_num_threads(profile['threads'])
+    try:
+        torch.set_num_interop_threads(profile['interop_threads'])
+    except RuntimeError: #only settable once and before any inter-op work
+        pass
+
+@click.command()
+@click.option('-p', '--config_path', default='Configs/config.yaml', type=str)
+@click.option('-m', '--models_path', required=True, type=str)
+@click.option('-o', '--profile_path', default=PROFILE_PATH, type=str)
+@click.option('--threads', default=None, type=str, help='comma separated thread counts, powers of two up to the core count by default')
+@click.option('--workers', default=None, type=str, help='comma separated worker counts, powers of two up to the core count by default')
+@click.option('--repeats', default=2, type=int)
+@click.option('--objective', default='throughput', type=click.Choice(['throughput', 'latency']))
+def main(config_path, models_path, profile_path, threads, workers, repeats, objective):
+    from inference import StyleTTS2
+    model = StyleTTS2(config_path, models_path, thread_profile=False).eval()
+    model.tune_threads(thread_counts=threads and [int(n) for n in threads.split(',')],
+                       worker_counts=workers and [int(n) for n in workers.split(',')],
+                       repeats=repeats, objective=objective, save_path=profile_path)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,177 @@
+import os
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import Future
+import multiprocessing as mp
+from multiprocessing.connection import wait
+import numpy as np
+import torch
+
+def worker_main(model, tasks, results, threads, index):
+    torch.set_num_threads(threads)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, phonems, styles, speeds, prev_d_means, kwargs = task
+        try:
+            styles = [torch.from_numpy(style) for style in styles]
+            wavs, d_means = model.inference_batch(phonems, styles, speeds, prev_d_means, **kwargs)
+            results.put((index, task_id, ([np.asarray(wav) for wav in wavs], [float(d_mean) for d_mean in d_means]), None))
+        except Exception as e:
+            results.put((index, task_id, None, repr(e)))
+
+class WorkerPool:
+    """
+    N worker processes sharing one copy of the weights, for many-core CPU boxes where a single model
+    doesn't use the cores well (LSTMs and small convs scale poorly with intra-op threads).
+
+    - the parent loads the model once, freezes it and moves every parameter and buffer to shared memory,
+      workers attach to the same pages: forked ones inherit them, spawned ones receive shared memory handles
+    - every worker runs torch.set_num_threads(threads). workers and threads default to the model's thread profile,
+      without one threads is cpu_count // workers
+    - routing: the parent hands each batch to an idle worker through that worker's own queue, so the next batch always
+      goes to a free worker and the parent knows which batch every worker holds
+    - a worker that dies (OOM kill, crash in a native op) fails its batch's future with RuntimeError and is replaced
+    - drop-in for the model in BatchScheduler / TTSServer: inference_batch, count_tokens, preprocess, get_styles,
+      and `concurrency` tells the scheduler to keep one batch in flight per worker
+    - get_styles runs in the parent, the reference audio path only needs the style encoder
+    """
+    def __init__(self, model, workers=None, threads=None, start_method='fork', freeze=True):
+        cpus = os.cpu_count() or 1
+        profile = getattr(model, 'thread_profile', None) or {} #from StyleTTS2.tune_threads
+        self.workers = workers or profile.get('workers') or max(1, cpus // (threads or 4))
+        self.threads = threads or profile.get('threads') or max(1, cpus // self.workers)
+        self.concurrency = self.workers
+        self.model = model
+        if freeze:
+            model.freeze_for_inference(verify=False)
+        model.share_memory()
+
+        self.ctx = mp.get_context(start_method)
+        self.results = self.ctx.Queue()
+        self.pending = {}
+        self.backlog = deque() #tasks waiting for an idle worker
+        self.assigned = {} #worker index -> task id it is running
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.closing = False
+
+        self.queues = [None] * self.workers
+        self.processes = [None] * self.workers
+        for index in range(self.workers):
+            self.__start(index)
+        self.idle = list(range(self.workers))
+        self.receiver = threading.Thread(target=self.__receive, daemon=True)
+        self.receiver.start()
+        self.monitor = threading.Thread(target=self.__monitor, daemon=True)
+        self.monitor.start()
+        print(f"Started {self.workers} workers x {self.threads} threads")
+
+    def __start(self, index):
+        #A fresh queue too, a task the previous worker never took must not run again
+        self.queues[index] = self.ctx.Queue()
+        #Spawned workers get the model through StyleTTS2.__getstate__, which leaves out the style cache
+        process = self.ctx.Process(target=worker_main, args=(self.model, self.queues[index], self.results, self.threads, index), daemon=True)
+        process.start()
+        self.processes[index] = process
+
+    @property
+    def preprocess(self):
+        return self.model.preprocess
+
+    def count_tokens(self, phonem):
+        return self.model.count_tokens(phonem)
+
+    def get_styles(self, *args, **kwargs):
+        return self.model.get_styles(*args, **kwargs)
+
+    def __dispatch(self):
+        #Called with the lock held
+        while self.backlog and self.idle:
+            index = self.idle.pop()
+            task = self.backlog.popleft()
+            self.assigned[index] = task[0]
+            self.queues[index].put(task)
+
+    def __receive(self):
+        while True:
+            message = self.results.get()
+            if message is None:
+                break
+            index, task_id, result, error = message
+            with self.lock:
+                future = self.pending.pop(task_id, None)
+                if self.assigned.get(index) == task_id:
+                    del self.assigned[index]
+                    self.idle.append(index)
+                    self.__dispatch()
+            if future is None: #already failed by the monitor
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(f"Worker failed: {error}"))
+
+    def __monitor(self):
+        #Waits on the process sentinels, a dead worker's batch would otherwise never resolve
+        while not self.closing:
+            sentinels = {process.sentinel: index for index, process in enumerate(self.processes)}
+            for sentinel in wait(list(sentinels), timeout=1.0):
+                if self.closing:
+                    return
+                index = sentinels[sentinel]
+                self.processes[index].join(1) #reaps it, exitcode is None until then
+                exitcode = self.processes[index].exitcode
+                with self.lock:
+                    task_id = self.assigned.pop(index, None)
+                    future = self.pending.pop(task_id, None)
+                    if index in self.idle:
+                        self.idle.remove(index)
+                    self.__start(index)
+                    self.idle.append(index)
+                    self.__dispatch()
+                print(f"Worker {index} died (exit code {exitcode}), restarted")
+                if future is not None:
+                    future.set_exception(RuntimeError(f"Worker {index} died (exit code {exitcode}) while running the batch"))
+
+    def submit_batch(self, phonems, styles, speeds, prev_d_means, **kwargs):
+        future = Future()
+        styles = [style.detach().cpu().numpy() for style in styles] #plain arrays, tensors would each be moved to shared memory
+        with self.lock:
+            if self.closing:
+                raise RuntimeError("Worker pool closed")
+            task_id = next(self.ids)
+            self.pending[task_id] = future
+            self.backlog.append((task_id, list(phonems), styles, list(speeds), [float(d) for d in prev_d_means], kwargs))
+            self.__dispatch()
+        return future
+
+    def inference_batch(self, phonems, styles, speeds, prev_d_means, **kwargs):
+        #Same as StyleTTS2.inference_batch, runs on whichever worker is free, blocks until it's done
+        return self.submit_batch(phonems, styles, speeds, prev_d_means, **kwargs).result()
+
+    def close(self, timeout=30):
+        with self.lock:
+            self.closing = True
+        self.monitor.join()
+        for tasks in self.queues:
+            tasks.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self.results.put(None)
+        self.receiver.join()
+        with self.lock:
+            for future in self.pending.values():
+                future.set_exception(RuntimeError("Worker pool closed"))
+            self.pending.clear()
+            self.backlog.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()